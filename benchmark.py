@@ -0,0 +1,657 @@
+#!/usr/bin/env python
+
+"""Performance benchmarks for the classification pipeline.
+
+Three benchmarks are provided. The classifier comparison trains each
+classifier backend on synthetic featuresets. The tokeniser comparison
+builds the case-folded token set of ENML note text with each tokeniser
+mode. The pipeline suite generates a
+synthetic Evernote account, serves it through a fake NoteStore and measures
+each stage of the demo pipeline: sync, content download, tokenisation,
+feature extraction, training and prediction. Each stage runs in its own
+process so that its peak RSS can be measured, and results can be saved as a
+baseline and compared against later runs.
+"""
+
+import argparse
+import bisect
+import json
+import multiprocessing
+import os
+import pickle
+import Queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from StringIO import StringIO
+import numpy
+from lxml import etree
+import features
+from classifier import SvmClassifier
+from linear import LinearClassifier
+from encache import ENCache
+from tokeniser import Tokeniser, TokenSet
+from evernote.edam.notestore.ttypes import SyncChunk
+from evernote.edam.type.ttypes import Note, Notebook, NoteAttributes, User
+from prettytable import PrettyTable
+
+BACKENDS = [("libsvm", SvmClassifier, "-t 0 -q"),
+            ("linear", LinearClassifier, "-c 1")]
+
+# Ways to build the distinct, case-folded tokens of a text.
+TOKENISERS = [("split", lambda text: set(token.lower() for token in
+                                         Tokeniser.split(text))),
+              ("unique", lambda text: set(Tokeniser.unique(text)))]
+
+
+def synthetic_featuresets(count, labels=10, vocabulary=20000,
+                          features_per_note=100, signal=0.3, seed=0):
+    """Generate random featuresets with some label-specific structure.
+
+    Each label owns a slice of the vocabulary. A fraction signal of each
+    featureset's features is drawn from its label's slice and the rest from
+    the whole vocabulary.
+
+    Args:
+        count: Number of featuresets.
+        labels: Number of distinct labels.
+        vocabulary: Number of distinct features.
+        features_per_note: Number of feature draws per featureset.
+        signal: Fraction of draws taken from the label's own slice.
+        seed: Random seed.
+
+    Returns:
+        List of featuresets.
+    """
+    rand = random.Random(seed)
+    width = vocabulary // labels
+    featuresets = []
+    for _ in xrange(count):
+        label = rand.randrange(labels)
+        featuredict = {"DEFAULT": 1}
+        for _ in xrange(features_per_note):
+            if rand.random() < signal:
+                token = label * width + rand.randrange(width)
+            else:
+                token = rand.randrange(vocabulary)
+            featuredict["CONTENT-TOKEN-w%d" % token] = 1
+        featuresets.append((featuredict, "notebook%d" % label))
+    return featuresets
+
+
+def compare_classifiers(featuresets_tr, featuresets_t, backends=BACKENDS):
+    """Time training and classification with each classifier backend.
+
+    Args:
+        featuresets_tr: Training featuresets.
+        featuresets_t: Test featuresets.
+        backends: List of (name, class, params) tuples.
+
+    Returns:
+        List of (name, train seconds, classify seconds, accuracy) tuples.
+    """
+    results = []
+    for name, cls, params in backends:
+        start = time.time()
+        classifier = cls.train(featuresets_tr, params)
+        train_time = time.time() - start
+        start = time.time()
+        labels = classifier.classify(featuresets_t)
+        classify_time = time.time() - start
+        correct = sum(1 for label, (_, actual) in zip(labels, featuresets_t)
+                      if label == actual)
+        results.append((name, train_time, classify_time,
+                        float(correct) / len(featuresets_t)))
+    return results
+
+
+def enml_text(path):
+    """Read the text of an ENML (or HTML) file, without markup.
+
+    Args:
+        path: File path or file object.
+
+    Returns:
+        A unicode string.
+    """
+    root = etree.parse(path, etree.HTMLParser(encoding="utf-8")).getroot()
+    if root is None:
+        return u""
+    return u" ".join(unicode(text) for text in root.itertext())
+
+
+def compare_tokenisers(texts, tokenisers=TOKENISERS, repeat=5):
+    """Time building the token set of each text with each tokeniser.
+
+    Args:
+        texts: List of unicode strings.
+        tokenisers: List of (name, function) tuples. Each function takes a
+            text and returns a set of tokens.
+        repeat: Number of passes over the texts. The fastest is reported.
+
+    Returns:
+        List of (name, seconds, characters per second, tokens) tuples, where
+        tokens is the total size of the token sets.
+    """
+    chars = sum(len(text) for text in texts)
+    results = []
+    for name, tokenise in tokenisers:
+        best = None
+        for _ in xrange(repeat):
+            start = time.time()
+            tokens = sum(len(tokenise(text)) for text in texts)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results.append((name, best, chars / max(best, 1e-9), tokens))
+    return results
+
+
+class SyntheticAccount(object):
+    """A reproducible, randomly generated Evernote account.
+
+    Each notebook owns a slice of the vocabulary, and a fraction of the
+    words of each note is drawn from its notebook's slice, so notes can be
+    classified into notebooks. Note content is generated on demand from a
+    per-note seed rather than held in memory. With the "cjk" script, each
+    word is rendered as one to three CJK ideographs and words are not
+    separated by spaces, as in Chinese and Japanese text. The "mixed"
+    script renders a quarter of the words as space-separated Latin words
+    among the CJK ones, as in notes that mix the two.
+
+    By default words, and the ideographs of CJK words, are drawn uniformly.
+    Natural language is far more skewed: with zipf set, the frequency of
+    the word of rank r is proportional to r ** -zipf, both overall and
+    within each notebook's slice, and the ideographs of CJK words follow
+    the same law.
+
+    Attributes:
+        notebooks: List of Notebook objects, with USNs 1 to len(notebooks).
+        notes: List of Note objects, with USNs following the notebooks.
+        update_count: The highest USN in the account.
+    """
+
+    def __init__(self, notes=1000, notebooks=10, words=200,
+                 vocabulary=20000, signal=0.3, seed=0, script="latin",
+                 zipf=None):
+        """Generate the account metadata.
+
+        Args:
+            notes: Number of notes.
+            notebooks: Number of notebooks.
+            words: Mean number of words of note content.
+            vocabulary: Number of distinct words.
+            signal: Fraction of words drawn from the notebook's slice.
+            seed: Random seed.
+            script: "latin", "cjk" or "mixed".
+            zipf: Zipf exponent for word and ideograph frequencies, e.g.
+                1.0, or None for uniform frequencies.
+        """
+        self.words = words
+        self.script = script
+        self.zipf = zipf
+        self._separator = " " if script == "latin" else ""
+        self._cjk_words = {}
+        self._cdfs = {}
+        self._ranks = None
+        if zipf is not None:
+            self._ranks = range(vocabulary)
+            random.Random(seed).shuffle(self._ranks)
+        self.vocabulary = vocabulary
+        self.signal = signal
+        self.seed = seed
+        rand = random.Random(seed)
+        self.notebooks = [Notebook(guid="nb%d" % i, name="Notebook %d" % i,
+                                   updateSequenceNum=i + 1)
+                          for i in xrange(notebooks)]
+        self.notes = []
+        for i in xrange(notes):
+            notebook = rand.randrange(notebooks)
+            title = self._separator.join(self._word(rand, notebook)
+                                         for _ in xrange(4))
+            self.notes.append(Note(
+                guid="n%d" % i, title=title,
+                notebookGuid=self.notebooks[notebook].guid,
+                contentHash="%016x" % rand.getrandbits(64),
+                updated=1300000000000 + i * 1000,
+                updateSequenceNum=notebooks + i + 1,
+                attributes=NoteAttributes()))
+        self.update_count = notebooks + notes
+        self._note_index = dict((note.guid, i)
+                                for i, note in enumerate(self.notes))
+        self._notebook_index = dict((notebook.guid, i)
+                                    for i, notebook in
+                                    enumerate(self.notebooks))
+
+    def _rank(self, rand, n):
+        """Draw a rank below n, uniformly or by the Zipf law."""
+        if self.zipf is None:
+            return rand.randrange(n)
+        cdf = self._cdfs.get(n)
+        if cdf is None:
+            cdf = self._cdfs[n] = list(numpy.cumsum(
+                numpy.arange(1, n + 1, dtype=float) ** -self.zipf))
+        return min(bisect.bisect(cdf, rand.random() * cdf[-1]), n - 1)
+
+    def _word(self, rand, notebook):
+        """Draw a word for a note in the given notebook."""
+        if rand.random() < self.signal:
+            width = self.vocabulary // len(self.notebooks)
+            index = notebook * width + self._rank(rand, width)
+        elif self.zipf is None:
+            index = rand.randrange(self.vocabulary)
+        else:
+            # Shuffle the ranks so that the common words are spread over
+            # the notebooks' slices.
+            index = self._ranks[self._rank(rand, self.vocabulary)]
+        if self.script == "latin" or (self.script == "mixed" and
+                                      rand.random() < 0.25):
+            return " w%d " % index if self.script == "mixed" else "w%d" % index
+        word = self._cjk_words.get(index)
+        if word is None:
+            word_rand = random.Random(index)
+            word = u"".join(unichr(0x4e00 + self._rank(word_rand, 3000))
+                            for _ in xrange(word_rand.choice((1, 2, 2, 3))))
+            word = self._cjk_words[index] = word.encode("utf-8")
+        return word
+
+    def content(self, guid):
+        """Generate the ENML content of a note.
+
+        Args:
+            guid: Note GUID.
+
+        Returns:
+            A string.
+        """
+        index = self._note_index[guid]
+        rand = random.Random("%d:%d" % (self.seed, index))
+        notebook = self._notebook_index[self.notes[index].notebookGuid]
+        count = rand.randrange(self.words // 2, self.words * 3 // 2 + 1)
+        paragraphs = []
+        for start in xrange(0, count, 20):
+            paragraphs.append("<div>%s</div>" % self._separator.join(
+                self._word(rand, notebook)
+                for _ in xrange(min(20, count - start))))
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<!DOCTYPE en-note SYSTEM '
+                '"http://xml.evernote.com/pub/enml2.dtd">'
+                '<en-note>%s</en-note>' % "".join(paragraphs))
+
+
+class FakeUserStore(object):
+    """UserStore that serves a SyntheticAccount."""
+
+    def getUser(self, auth_token):
+        return User(id=1)
+
+    def getNoteStoreUrl(self, auth_token):
+        return "synthetic"
+
+
+class FakeNoteStore(object):
+    """NoteStore that serves a SyntheticAccount.
+
+    Attributes:
+        chunk_times: Time at which each sync chunk was requested.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.chunk_times = []
+
+    def getFilteredSyncChunk(self, auth_token, after_usn, max_entries,
+                             sync_filter):
+        self.chunk_times.append(time.time())
+        account = self.account
+        objects = [obj for obj in account.notebooks + account.notes
+                   if obj.updateSequenceNum > after_usn][:max_entries]
+        chunk = SyncChunk(updateCount=account.update_count,
+                          currentTime=int(time.time() * 1000))
+        if objects:
+            chunk.chunkHighUSN = objects[-1].updateSequenceNum
+            chunk.notebooks = [obj for obj in objects
+                               if isinstance(obj, Notebook)]
+            chunk.notes = [obj for obj in objects if isinstance(obj, Note)]
+        return chunk
+
+    def getNoteContent(self, auth_token, guid):
+        return self.account.content(guid)
+
+
+class SyntheticCache(ENCache):
+    """ENCache connected to a SyntheticAccount instead of the service."""
+
+    def __init__(self, account, cache_root):
+        """Open the cache.
+
+        Args:
+            account: SyntheticAccount object.
+            cache_root: Path to cache root directory.
+        """
+        self.account = account
+        ENCache.__init__(self, "token", "synthetic", cache_root)
+
+    def new_userstore(self, host):
+        return FakeUserStore()
+
+    def new_notestore(self):
+        return FakeNoteStore(self.account)
+
+
+def _peak_rss():
+    """Get the peak resident set size of this process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1048576.0
+    return peak / 1024.0
+
+
+def _timed(function, items):
+    """Call function on each item, returning the per-item latencies."""
+    latencies = []
+    for item in items:
+        start = time.time()
+        function(item)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def _stage_sync(account, workdir):
+    cache = SyntheticCache(account, workdir)
+    start = time.time()
+    cache.sync()
+    elapsed = time.time() - start
+    times = cache.notestore.chunk_times
+    return len(account.notes), elapsed, numpy.diff(times + [start + elapsed])
+
+
+def _stage_content(account, workdir):
+    cache = SyntheticCache(account, workdir)
+    notes = list(cache.notes)
+    latencies = _timed(lambda note: cache.note_content(note).read(), notes)
+    return len(notes), sum(latencies), latencies
+
+
+def _stage_tokenise(account, workdir):
+    # Tokenise the note text without markup into a TokenSet, as feature
+    # extraction does. Parsing is timed by the extract stage.
+    cache = SyntheticCache(account, workdir)
+    texts = [enml_text(cache.note_content(note)) for note in cache.notes]
+    latencies = _timed(lambda text: TokenSet().update(text), texts)
+    return len(texts), sum(latencies), latencies
+
+
+def _stage_extract(account, workdir):
+    cache = SyntheticCache(account, workdir)
+    notes = list(cache.notes)
+    featuresets = []
+    latencies = _timed(lambda note: featuresets.append(
+        (features.note_featuredict(note, cache.note_content(note)),
+         note.notebookGuid)), notes)
+    with open(os.path.join(workdir, "featuresets.pkl"), "wb") as handle:
+        pickle.dump(featuresets, handle, pickle.HIGHEST_PROTOCOL)
+    return len(notes), sum(latencies), latencies
+
+
+def _load_split(workdir):
+    """Load the extracted featuresets as a (training, test) split."""
+    with open(os.path.join(workdir, "featuresets.pkl"), "rb") as handle:
+        featuresets = pickle.load(handle)
+    split = len(featuresets) * 4 // 5
+    return featuresets[:split], featuresets[split:]
+
+
+def _stage_train(account, workdir):
+    featuresets_tr, _ = _load_split(workdir)
+    start = time.time()
+    classifier = SvmClassifier.train(featuresets_tr)
+    elapsed = time.time() - start
+    classifier.save(os.path.join(workdir, "model"))
+    return len(featuresets_tr), elapsed, [elapsed]
+
+
+def _stage_predict(account, workdir):
+    _, featuresets_t = _load_split(workdir)
+    classifier = SvmClassifier.load(os.path.join(workdir, "model"))
+    latencies = _timed(lambda featureset: classifier.classify_proba(
+        [featureset], k=1), featuresets_t)
+    start = time.time()
+    classifier.classify_proba(featuresets_t, k=1)
+    return len(featuresets_t), time.time() - start, latencies
+
+
+# Pipeline stages, in order. Each takes the account and a working directory
+# shared with earlier stages, and returns the number of items processed,
+# the elapsed seconds and a list of per-item latencies in seconds.
+STAGES = [("sync", _stage_sync), ("content", _stage_content),
+          ("tokenise", _stage_tokenise), ("extract", _stage_extract),
+          ("train", _stage_train), ("predict", _stage_predict)]
+
+
+def _run_stage(stage, config, workdir, queue):
+    """Run a stage in a child process and report its measurements."""
+    try:
+        account = SyntheticAccount(**config)
+        items, elapsed, latencies = stage(account, workdir)
+        latencies = numpy.asarray(latencies) * 1000
+        queue.put({"items": items,
+                   "throughput": items / max(elapsed, 1e-9),
+                   "p50_ms": numpy.percentile(latencies, 50),
+                   "p95_ms": numpy.percentile(latencies, 95),
+                   "p99_ms": numpy.percentile(latencies, 99),
+                   "peak_rss_mb": _peak_rss()})
+    except Exception:
+        queue.put({"error": traceback.format_exc()})
+
+
+def _stage_result(process, queue, timeout):
+    """Wait for the measurements of a stage running in a child process.
+
+    The queue is polled rather than read with a blocking get, so a child
+    that dies without reporting, e.g. killed for running out of memory or
+    crashed in LIBSVM, is detected.
+
+    Args:
+        process: The started multiprocessing.Process.
+        queue: The queue passed to _run_stage.
+        timeout: Maximum seconds to wait, or None.
+
+    Returns:
+        The dictionary put on the queue by _run_stage.
+
+    Raises:
+        RuntimeError: The child exited without reporting, or timed out.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Queue.Empty:
+            pass
+        if not process.is_alive():
+            # The result may have arrived just before the child exited.
+            try:
+                return queue.get(timeout=1)
+            except Queue.Empty:
+                raise RuntimeError("exited with code %s" % process.exitcode)
+        if deadline is not None and time.time() > deadline:
+            process.terminate()
+            raise RuntimeError("timed out after %ds" % timeout)
+
+
+def run_suite(config, workdir=None, timeout=None):
+    """Run every pipeline stage on a synthetic account.
+
+    Args:
+        config: Dictionary of SyntheticAccount keyword arguments.
+        workdir: Directory for the cache and intermediate files, or None to
+            use a temporary directory that is removed afterwards.
+        timeout: Maximum seconds for each stage, or None.
+
+    Returns:
+        List of (stage name, measurements) tuples, where measurements is a
+        dictionary with the keys "items", "throughput" (items per second),
+        "p50_ms", "p95_ms", "p99_ms" and "peak_rss_mb".
+
+    Raises:
+        RuntimeError: A stage failed, its process died or it timed out.
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp()
+    try:
+        results = []
+        for name, stage in STAGES:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_run_stage, args=(stage, config, workdir, queue))
+            process.start()
+            try:
+                result = _stage_result(process, queue, timeout)
+            except RuntimeError as exc:
+                raise RuntimeError("stage %s failed: %s" % (name, exc))
+            finally:
+                process.join()
+            if "error" in result:
+                raise RuntimeError("stage %s failed:\n%s" %
+                                   (name, result["error"]))
+            results.append((name, result))
+        return results
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir)
+
+
+def find_regressions(results, baseline, tolerance=0.25):
+    """Compare suite results against a baseline.
+
+    A stage regresses if its throughput falls, or its p95 latency or peak
+    RSS rises, by more than the tolerance.
+
+    Args:
+        results: As returned by run_suite.
+        baseline: Dictionary mapping stage names to measurements, as saved
+            by the command line with --save-baseline.
+        tolerance: Allowed relative change, e.g. 0.25 for 25%.
+
+    Returns:
+        List of strings describing each regression.
+    """
+    regressions = []
+    for name, result in results:
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append("%s: throughput %.1f/s, baseline %.1f/s" %
+                               (name, result["throughput"],
+                                base["throughput"]))
+        for key in ("p95_ms", "peak_rss_mb"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append("%s: %s %.1f, baseline %.1f" %
+                                   (name, key, result[key], base[key]))
+    return regressions
+
+
+def run_cli():
+    """Process a command line execution."""
+    parser = argparse.ArgumentParser(description="Classifier benchmarks")
+    parser.add_argument("-n", help="number of notes (default: 2000)",
+                        type=int, default=2000)
+    parser.add_argument("-l", help="number of notebooks (default: 10)",
+                        type=int, default=10)
+    parser.add_argument("-t", help="test set fraction (default: 0.2)",
+                        type=float, default=0.2)
+    parser.add_argument("-s", action="store_true",
+                        help="run the pipeline suite instead of the "
+                        "classifier comparison")
+    parser.add_argument("-w", help="mean words per note in the suite "
+                        "(default: 200)", type=int, default=200)
+    parser.add_argument("-v", help="vocabulary size in the suite "
+                        "(default: 20000)", type=int, default=20000)
+    parser.add_argument("-c", action="store_true",
+                        help="write the suite's notes in CJK ideographs")
+    parser.add_argument("-m", action="store_true",
+                        help="write the suite's notes in CJK ideographs "
+                        "mixed with Latin words")
+    parser.add_argument("-z", type=float,
+                        help="Zipf exponent of word frequencies in the "
+                        "suite, e.g. 1.0 (default: uniform)")
+    parser.add_argument("--baseline", help="compare the suite against this "
+                        "baseline file and exit with status 1 on regression")
+    parser.add_argument("--save-baseline", help="save the suite results to "
+                        "this baseline file")
+    parser.add_argument("--timeout", help="maximum seconds per suite stage "
+                        "(default: none)", type=float)
+    parser.add_argument("--tolerance", help="allowed relative regression "
+                        "(default: 0.25)", type=float, default=0.25)
+    parser.add_argument("-e", nargs="*", metavar="ENML",
+                        help="compare tokenisers on the text of these ENML "
+                        "files (default: the suite's synthetic notes)")
+    args = parser.parse_args()
+    config = {"notes": args.n, "notebooks": args.l, "words": args.w,
+              "vocabulary": args.v}
+    if args.c:
+        config["script"] = "cjk"
+    elif args.m:
+        config["script"] = "mixed"
+    if args.z is not None:
+        config["zipf"] = args.z
+    if args.e is not None:
+        if args.e:
+            texts = [enml_text(path) for path in args.e]
+        else:
+            account = SyntheticAccount(**config)
+            texts = [enml_text(StringIO(account.content(note.guid)))
+                     for note in account.notes]
+        table = PrettyTable(["tokeniser", "seconds", "chars/s", "tokens"])
+        for name, seconds, rate, tokens in compare_tokenisers(texts):
+            table.add_row([name, "%.4f" % seconds, "%.0f" % rate, tokens])
+        print table
+        return
+    if not args.s:
+        featuresets = synthetic_featuresets(args.n, labels=args.l)
+        split = int(len(featuresets) * (1 - args.t))
+        table = PrettyTable(["backend", "train (s)", "classify (s)",
+                             "accuracy"])
+        for name, train_time, classify_time, accuracy in \
+                compare_classifiers(featuresets[:split],
+                                    featuresets[split:]):
+            table.add_row([name, "%.3f" % train_time,
+                           "%.3f" % classify_time, "%.3f" % accuracy])
+        print table
+        return
+    results = run_suite(config, timeout=args.timeout)
+    table = PrettyTable(["stage", "items", "items/s", "p50 (ms)",
+                         "p95 (ms)", "p99 (ms)", "peak RSS (MB)"])
+    for name, result in results:
+        table.add_row([name, result["items"],
+                       "%.1f" % result["throughput"],
+                       "%.2f" % result["p50_ms"], "%.2f" % result["p95_ms"],
+                       "%.2f" % result["p99_ms"],
+                       "%.1f" % result["peak_rss_mb"]])
+    print table
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as handle:
+            json.dump({"config": config, "stages": dict(results)}, handle,
+                      indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        if baseline["config"] != config:
+            print "baseline was recorded with %s" % baseline["config"]
+            exit(2)
+        regressions = find_regressions(results, baseline["stages"],
+                                       args.tolerance)
+        for regression in regressions:
+            print "REGRESSION %s" % regression
+        if regressions:
+            exit(1)
+
+if __name__ == "__main__":
+    run_cli()
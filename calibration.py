@@ -0,0 +1,172 @@
+"""Score calibration and ranking for classifier decision values.
+
+Classifiers score each featureset against every label with a decision
+value, a signed distance from a separating hyperplane. Decision values rank
+labels but are not comparable between classifiers or between labels, so
+they make poor routing thresholds. Platt scaling fits a sigmoid per label
+that maps decision values to probabilities, following the numerically
+robust procedure of Lin, Lin and Weng (2007), "A Note on Platt's
+Probabilistic Outputs for Support Vector Machines".
+"""
+
+import numpy
+
+
+def _objective(scores, targets, a, b):
+    """Negative log likelihood of the targets under sigmoid(a, b)."""
+    fapb = scores * a + b
+    positive = fapb >= 0
+    return (numpy.where(positive, targets * fapb, (targets - 1) * fapb) +
+            numpy.log1p(numpy.exp(-numpy.abs(fapb)))).sum()
+
+
+def fit_sigmoid(scores, positive, max_iter=100, min_step=1e-10,
+                sigma=1e-12, eps=1e-5):
+    """Fit Platt's sigmoid P(positive | score) = 1 / (1 + exp(A score + B)).
+
+    Uses Newton's method with a backtracking line search on regularised
+    targets, as given in pseudo-code by Lin, Lin and Weng (2007).
+
+    Args:
+        scores: Array of decision values.
+        positive: Boolean array, True where the instance is positive.
+        max_iter: Maximum number of Newton iterations.
+        min_step: Smallest line search step before giving up.
+        sigma: Hessian regularisation.
+        eps: Stopping tolerance on the gradient.
+
+    Returns:
+        2-tuple (A, B).
+    """
+    scores = numpy.asarray(scores, dtype=numpy.float64)
+    prior1 = float(numpy.count_nonzero(positive))
+    prior0 = len(scores) - prior1
+    targets = numpy.where(positive, (prior1 + 1) / (prior1 + 2),
+                          1 / (prior0 + 2))
+    a = 0.0
+    b = numpy.log((prior0 + 1) / (prior1 + 1))
+    fval = _objective(scores, targets, a, b)
+    for _ in xrange(max_iter):
+        fapb = scores * a + b
+        # p = 1 / (1 + exp(fapb)), computed without overflow.
+        ex = numpy.exp(-numpy.abs(fapb))
+        p = numpy.where(fapb >= 0, ex / (1 + ex), 1 / (1 + ex))
+        d2 = p * (1 - p)
+        h11 = sigma + (scores * scores * d2).sum()
+        h22 = sigma + d2.sum()
+        h21 = (scores * d2).sum()
+        d1 = targets - p
+        g1 = (scores * d1).sum()
+        g2 = d1.sum()
+        if abs(g1) < eps and abs(g2) < eps:
+            break
+        det = h11 * h22 - h21 * h21
+        da = -(h22 * g1 - h21 * g2) / det
+        db = -(-h21 * g1 + h11 * g2) / det
+        gd = g1 * da + g2 * db
+        step = 1.0
+        while step >= min_step:
+            new_a = a + step * da
+            new_b = b + step * db
+            new_f = _objective(scores, targets, new_a, new_b)
+            if new_f < fval + 0.0001 * step * gd:
+                a, b, fval = new_a, new_b, new_f
+                break
+            step /= 2
+        else:
+            break
+    return a, b
+
+
+class PlattCalibrator(object):
+    """Maps one-vs-rest decision values to label probabilities.
+
+    Attributes:
+        a: Array of the sigmoid slope for each label column.
+        b: Array of the sigmoid offset for each label column.
+    """
+
+    def __init__(self, a, b):
+        """Accept the sigmoid parameters.
+
+        Args:
+            a: Sequence of slopes, one per label column.
+            b: Sequence of offsets, one per label column.
+        """
+        self.a = numpy.asarray(a, dtype=numpy.float64)
+        self.b = numpy.asarray(b, dtype=numpy.float64)
+
+    @classmethod
+    def fit(cls, scores, columns):
+        """Fit a sigmoid for each label column.
+
+        The scores should come from featuresets that the classifier was not
+        trained on, otherwise the probabilities will be overconfident.
+
+        Args:
+            scores: Array of shape (instances, labels) of decision values.
+            columns: Integer array giving the correct column of each
+                instance, or -1 if its label is unknown to the classifier.
+
+        Returns:
+            PlattCalibrator object.
+        """
+        columns = numpy.asarray(columns)
+        params = [fit_sigmoid(scores[:, j], columns == j)
+                  for j in xrange(scores.shape[1])]
+        return cls([a for a, _ in params], [b for _, b in params])
+
+    def probabilities(self, scores):
+        """Map decision values to probabilities.
+
+        Each column is mapped by its sigmoid and each row is then normalised
+        to sum to one.
+
+        Args:
+            scores: Array of shape (instances, labels) of decision values.
+
+        Returns:
+            Array of the same shape.
+        """
+        fapb = scores * self.a + self.b
+        ex = numpy.exp(-numpy.abs(fapb))
+        probs = numpy.where(fapb >= 0, ex / (1 + ex), 1 / (1 + ex))
+        totals = probs.sum(axis=1)
+        totals[totals == 0] = 1
+        probs /= totals[:, numpy.newaxis]
+        return probs
+
+    def to_json(self):
+        """Get a JSON-serialisable representation."""
+        return {"a": self.a.tolist(), "b": self.b.tolist()}
+
+    @classmethod
+    def from_json(cls, obj):
+        """Create a calibrator from the output of to_json."""
+        return cls(obj["a"], obj["b"])
+
+
+def rank_labels(scores, labels, k=None):
+    """Get the best scoring labels for each row of a score matrix.
+
+    Args:
+        scores: Array of shape (instances, labels).
+        labels: Sequence of the label for each column.
+        k: Maximum number of labels per instance, or None for all.
+
+    Returns:
+        List with one list per instance of (label, score) pairs, best first.
+    """
+    if k is None or k > scores.shape[1]:
+        k = scores.shape[1]
+    if k < scores.shape[1]:
+        top = numpy.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        top = numpy.tile(numpy.arange(k), (scores.shape[0], 1))
+    top_scores = scores[numpy.arange(scores.shape[0])[:, numpy.newaxis], top]
+    order = numpy.argsort(-top_scores, axis=1, kind="mergesort")
+    rows = numpy.arange(scores.shape[0])[:, numpy.newaxis]
+    top = top[rows, order].tolist()
+    top_scores = top_scores[rows, order].tolist()
+    return [[(labels[j], score) for j, score in zip(columns, row_scores)]
+            for columns, row_scores in zip(top, top_scores)]
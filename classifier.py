@@ -1,4 +1,48 @@
 import svmutil
+import vectoriser
+import os
+import json
+import shutil
+import tempfile
+import multiprocessing
+import features
+import metrics
+from vectoriser import FeatureHasher
+try:
+    import numpy
+    from calibration import PlattCalibrator, rank_labels
+except ImportError:
+    numpy = None
+
+# Set in each worker process by _init_binary_worker.
+_binary_shared = None
+
+
+def _init_binary_worker(shared):
+    """Make the training vectors available to a worker process."""
+    global _binary_shared
+    _binary_shared = shared
+
+
+def _train_binary(job):
+    """Train the one-vs-rest model for one label.
+
+    Args:
+        job: 2-tuple of the label index and either a path to save the model
+            to, or None to return it.
+
+    Returns:
+        The LIBSVM model, or the path it was saved to.
+    """
+    label, path = job
+    vectors, labels, params = _binary_shared
+    targets = [1 if value == label else -1 for value in labels]
+    prob = svmutil.svm_problem(targets, vectors)
+    model = svmutil.svm_train(prob, svmutil.svm_parameter(params))
+    if path is None:
+        return model
+    svmutil.svm_save_model(path, model)
+    return path
 
 
 class SvmClassifier(object):
@@ -19,30 +63,52 @@ class SvmClassifier(object):
     The LIBSVM representation requires that feature dictionaries and
     lists of labels be passed as separate parameters. It also requires that
     feature names and labels be integers rather than strings.
+
+    By default a single LIBSVM model is trained, which LIBSVM builds from
+    k(k-1)/2 one-vs-one binary models for k labels in a single thread. In
+    one-vs-rest mode, one binary model per label separates it from all the
+    others. The models are trained in parallel processes and a featureset
+    is given the label whose model scores it highest, so training time grows
+    linearly with the number of labels and shrinks with the number of cores.
     """
 
-    def __init__(self, featureindex, labelindex, model):
+    def __init__(self, featureindex, labelindex, model, calibrator=None):
         """Accept the label index, feature index and trained model.
 
         This is not designed to be called directly. Use the train method
         instead.
 
         Args:
-            featureindex: Dictionary mapping feature names to integers.
+            featureindex: Dictionary mapping feature names to integers, or an
+                object with a vector method such as FeatureHasher or
+                vectoriser.CompactFeatureIndex.
             labelindex: Dictionary mapping labels to integers.
-            model: LIBSVM model as returned by svmutils.svm_train.
+            model: LIBSVM model as returned by svmutils.svm_train, or, for a
+                one-vs-rest classifier, a list of binary models, one per
+                label in label index order.
+            calibrator: PlattCalibrator object, or None.
         """
         self.labelindex = labelindex
         self.featureindex = featureindex
         self.labelindex_rev = dict((v, k) for k, v in labelindex.iteritems())
         self.model = model
+        self.calibrator = calibrator
+        self._weights = None
+        self._pairs = None
+
+    @property
+    def one_vs_rest(self):
+        """Whether the classifier holds one binary model per label."""
+        return isinstance(self.model, list)
 
     @classmethod
     def featuresets_to_svm(cls, featureindex, labelindex, featuresets):
         """Map featuresets to LIBSVM vector and label representations.
 
         Args:
-            featureindex: Dictionary mapping feature names to integers.
+            featureindex: Dictionary mapping feature names to integers, or
+                an object such as FeatureHasher with a vector method that
+                maps a featuredict to a LIBSVM vector.
             labelindex: Dictionary mapping labels to integers.
             featuresets: List of featuresets.
 
@@ -52,9 +118,12 @@ class SvmClassifier(object):
         vectors = []
         labels = []
         for featuredict, label in featuresets:
-            vector = dict([(featureindex[ftr], ftrval)
-                           for ftr, ftrval in featuredict.items()
-                           if ftr in featureindex])
+            if isinstance(featureindex, dict):
+                vector = dict([(featureindex[ftr], ftrval)
+                               for ftr, ftrval in featuredict.items()
+                               if ftr in featureindex])
+            else:
+                vector = featureindex.vector(featuredict)
             vectors.append(vector)
             if label in labelindex:
                 labels.append(labelindex[label])
@@ -62,6 +131,30 @@ class SvmClassifier(object):
                 labels.append(-1)
         return vectors, labels
 
+    @classmethod
+    def vectorise(cls, featureindex, labelindex, featuresets):
+        """Map featuresets to the most efficient representation LIBSVM
+        accepts.
+
+        If numpy and scipy are installed and the LIBSVM Python interface
+        supports scipy matrices, this is a CSR matrix built by
+        vectoriser.featuresets_to_csr. Otherwise it is the list of dicts
+        built by featuresets_to_svm.
+
+        Args:
+            featureindex: As for featuresets_to_svm.
+            labelindex: Dictionary mapping labels to integers.
+            featuresets: List of featuresets.
+
+        Returns:
+            2-tuple of feature vectors and labels.
+        """
+        if (vectoriser.sparse is not None and
+                getattr(svmutil, "sparse", None) is not None):
+            return vectoriser.featuresets_to_csr(featureindex, labelindex,
+                                                 featuresets)
+        return cls.featuresets_to_svm(featureindex, labelindex, featuresets)
+
     def classify(self, featuresets):
         """Classify a list of featuresets.
 
@@ -71,36 +164,364 @@ class SvmClassifier(object):
         Returns:
             List of labels, one per featureset.
         """
-        vectors, labels = self.featuresets_to_svm(self.featureindex,
-                                                  self.labelindex,
-                                                  featuresets)
-        p_label, _, _ = svmutil.svm_predict(labels, vectors,
-                                            self.model)
+        if self.one_vs_rest:
+            scores = self.decision_function(featuresets)
+            return [self.labelindex_rev[int(column) + 1]
+                    for column in scores.argmax(axis=1)]
+        vectors, labels = self.vectorise(self.featureindex, self.labelindex,
+                                         featuresets)
+        with metrics.timer("svm_predict_seconds"):
+            p_label, _, _ = svmutil.svm_predict(labels, vectors,
+                                                self.model)
+        metrics.increment("svm_predict_notes_total", len(featuresets))
         return [self.labelindex_rev[int(label)] for label in p_label]
 
+    def _pair_matrix(self):
+        """Get the matrix that aggregates one-vs-one decision values.
+
+        LIBSVM trains a binary classifier for each pair of labels i < j, in
+        the order of model.get_labels(), with positive decision values
+        favouring label i. The score of a label is the mean decision value
+        in its favour over the pairs it takes part in.
+
+        The matrix is built on first use and cached.
+
+        Returns:
+            scipy.sparse.csr_matrix of shape (number of pairs, number of
+            labels), with two nonzeros per row.
+        """
+        if self._pairs is None:
+            model_labels = [int(label) for label in self.model.get_labels()]
+            count = len(model_labels)
+            first, second = numpy.triu_indices(count, 1)
+            labels = numpy.asarray(model_labels) - 1
+            rows = numpy.arange(len(first)).repeat(2)
+            columns = numpy.column_stack((labels[first],
+                                          labels[second])).ravel()
+            data = numpy.tile([1.0, -1.0], len(first)) / (count - 1)
+            self._pairs = vectoriser.sparse.csr_matrix(
+                (data, (rows, columns)),
+                shape=(len(first), len(self.labelindex)))
+        return self._pairs
+
+    def decision_function(self, featuresets):
+        """Score a list of featuresets against every label.
+
+        Args:
+            featuresets: List of featuresets.
+
+        Returns:
+            Array of shape (featuresets, labels). Column j holds the scores
+            of the label with index j + 1. Higher is better.
+
+        Raises:
+            ImportError: numpy is not installed.
+        """
+        if numpy is None:
+            raise ImportError("decision_function requires numpy")
+        if not featuresets or len(self.labelindex) < 2:
+            return numpy.zeros((len(featuresets), len(self.labelindex)))
+        vectors, labels = self.vectorise(self.featureindex, self.labelindex,
+                                         featuresets)
+        if self.one_vs_rest:
+            return self._binary_scores(vectors, labels)
+        with metrics.timer("svm_predict_seconds"):
+            _, _, values = svmutil.svm_predict(labels, vectors, self.model,
+                                               "-q")
+        metrics.increment("svm_predict_notes_total", len(featuresets))
+        values = numpy.asarray(values, dtype=numpy.float64)
+        values = values.reshape(len(featuresets), -1)
+        return numpy.asarray(self._pair_matrix().T.dot(values.T).T)
+
+    def _linear_weights(self):
+        """Collapse linear-kernel one-vs-rest models into a weight matrix.
+
+        A linear model's decision value is the sum of its support vectors
+        weighted by their coefficients, dotted with the instance, less rho.
+        Summing the support vectors once turns scoring into one sparse
+        matrix product instead of a LIBSVM call per label.
+
+        Returns:
+            2-tuple of a sparse matrix of shape (features, labels) and an
+            array of offsets, or None if any model has a non-linear kernel.
+        """
+        if self._weights is None:
+            if any(model.param.kernel_type != svmutil.LINEAR
+                   for model in self.model):
+                self._weights = False
+                return None
+            rows, columns, data = [], [], []
+            offsets = numpy.empty(len(self.model))
+            for j, model in enumerate(self.model):
+                sign = 1 if int(model.get_labels()[0]) == 1 else -1
+                for coef, vector in zip(model.get_sv_coef(),
+                                        model.get_SV()):
+                    for index, value in vector.iteritems():
+                        if index > 0:
+                            rows.append(index - 1)
+                            columns.append(j)
+                            data.append(sign * coef[0] * value)
+                offsets[j] = -sign * model.rho[0]
+            matrix = vectoriser.sparse.csr_matrix(
+                (data, (rows, columns)),
+                shape=(len(self.featureindex), len(self.model)))
+            self._weights = (matrix, offsets)
+        return self._weights or None
+
+    def _binary_scores(self, vectors, labels):
+        """Score vectors with each one-vs-rest model.
+
+        A binary model's decision values favour the first label it saw in
+        training, which may be either +1 (this label) or -1 (the rest).
+
+        Returns:
+            Array of shape (vectors, labels).
+        """
+        if vectoriser.sparse is not None and \
+                vectoriser.sparse.issparse(vectors):
+            weights = self._linear_weights()
+            if weights is not None:
+                matrix, offsets = weights
+                with metrics.timer("svm_predict_seconds"):
+                    scores = (vectors * matrix).toarray() + offsets
+                metrics.increment("svm_predict_notes_total", len(labels))
+                return scores
+        scores = numpy.empty((len(labels), len(self.model)))
+        with metrics.timer("svm_predict_seconds"):
+            for j, model in enumerate(self.model):
+                _, _, values = svmutil.svm_predict(labels, vectors, model,
+                                                   "-q")
+                sign = 1 if int(model.get_labels()[0]) == 1 else -1
+                scores[:, j] = sign * numpy.asarray(
+                    values, dtype=numpy.float64).reshape(-1)
+        metrics.increment("svm_predict_notes_total", len(labels))
+        return scores
+
+    def calibrate(self, featuresets):
+        """Fit a PlattCalibrator to held-out featuresets.
+
+        Args:
+            featuresets: List of featuresets not used in training.
+        """
+        columns = [self.labelindex.get(label, 0) - 1
+                   for _, label in featuresets]
+        self.calibrator = PlattCalibrator.fit(
+            self.decision_function(featuresets), columns)
+
+    def classify_proba(self, featuresets, k=None):
+        """Rank the labels for a list of featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+            k: Maximum number of labels per featureset, or None for all.
+
+        Returns:
+            List with one list per featureset of (label, score) pairs, best
+            first. Scores are probabilities if the classifier has been
+            calibrated and decision values otherwise.
+        """
+        scores = self.decision_function(featuresets)
+        if self.calibrator is not None:
+            scores = self.calibrator.probabilities(scores)
+        labels = [self.labelindex_rev[i + 1]
+                  for i in xrange(len(self.labelindex))]
+        return rank_labels(scores, labels, k)
+
     @classmethod
-    def train(cls, featuresets, params="-t 0 -q"):
-        """Train a classifier using the given featuresets.
+    def build_indices(cls, featuresets, hash_dim=None, selector=None):
+        """Build the feature and label indices for a training set.
+
+        By default, a feature index is built from every feature in the
+        featuresets. If a selector is given, the index only includes the
+        features it selects, and all other features are ignored both in
+        training and classification. If hash_dim is given, features are
+        instead mapped by a signed FeatureHasher with that many dimensions,
+        so memory use no longer grows with the vocabulary.
 
         Args:
             featuresets: List of featuresets.
-            params: Parameter string to pass to svmutil.svm_parameter.
+            hash_dim: Number of hashed feature dimensions, e.g. 2 ** 20, or
+                None to build a feature index.
+            selector: FeatureSelector object, or None to use all features.
 
         Returns:
-            SvmClassifier object.
+            2-tuple of the feature index and the label index.
+
+        Raises:
+            ValueError: Both hash_dim and selector were given.
         """
-        all_features = set()
+        if hash_dim and selector:
+            raise ValueError("feature selection requires a feature index")
         all_labels = set()
-        for featuredict, label in featuresets:
-            all_features.update(set(featuredict.keys()))
-            all_labels.add(label)
+        if hash_dim:
+            featureindex = FeatureHasher(hash_dim)
+            for featuredict, label in featuresets:
+                all_labels.add(label)
+        else:
+            all_features = set()
+            for featuredict, label in featuresets:
+                all_features.update(set(featuredict.keys()))
+                all_labels.add(label)
+            if selector:
+                all_features &= selector.select(featuresets)
+            all_features = sorted(all_features)
+            featureindex = dict(zip(all_features,
+                                    range(1, len(all_features) + 1)))
         all_labels = sorted(all_labels)
-        all_features = sorted(all_features)
-        featureindex = dict(zip(all_features, range(1, len(all_features) + 1)))
         labelindex = dict(zip(all_labels, range(1, len(all_labels) + 1)))
-        vectors, labels = cls.featuresets_to_svm(featureindex, labelindex,
-                                                 featuresets)
+        return featureindex, labelindex
+
+    @classmethod
+    def train(cls, featuresets, params="-t 0 -q", hash_dim=None,
+              selector=None, one_vs_rest=False, processes=1):
+        """Train a classifier using the given featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+            params: Parameter string to pass to svmutil.svm_parameter.
+            hash_dim: As for build_indices.
+            selector: As for build_indices.
+            one_vs_rest: Whether to train one binary model per label rather
+                than a single multi-class model. Ignored if there are fewer
+                than three labels.
+            processes: Number of processes training one-vs-rest models.
+
+        Returns:
+            SvmClassifier object.
+
+        Raises:
+            ValueError: Both hash_dim and selector were given.
+        """
+        featureindex, labelindex = cls.build_indices(featuresets, hash_dim,
+                                                     selector)
+        vectors, labels = cls.vectorise(featureindex, labelindex,
+                                        featuresets)
+        if one_vs_rest and len(labelindex) > 2:
+            with metrics.timer("svm_train_seconds"):
+                models = cls._train_binary_models(
+                    vectors, labels, params, len(labelindex), processes)
+            return cls(featureindex, labelindex, models)
         prob = svmutil.svm_problem(labels, vectors)
         param = svmutil.svm_parameter(params)
-        model = svmutil.svm_train(prob, param)
+        with metrics.timer("svm_train_seconds"):
+            model = svmutil.svm_train(prob, param)
         return cls(featureindex, labelindex, model)
+
+    @classmethod
+    def _train_binary_models(cls, vectors, labels, params, count,
+                             processes):
+        """Train a one-vs-rest model for each label index.
+
+        Workers inherit the vectors when they are forked. LIBSVM models
+        cannot be pickled, so each worker saves its model to a temporary
+        file that is loaded here.
+
+        Returns:
+            List of LIBSVM models in label index order.
+        """
+        shared = (vectors, labels, params)
+        if processes == 1:
+            _init_binary_worker(shared)
+            try:
+                return [_train_binary((label, None))
+                        for label in xrange(1, count + 1)]
+            finally:
+                _init_binary_worker(None)
+        tmpdir = tempfile.mkdtemp(prefix="ovr")
+        pool = multiprocessing.Pool(processes, _init_binary_worker, (shared,))
+        try:
+            jobs = [(label, os.path.join(tmpdir, "model-%d.svm" % label))
+                    for label in xrange(1, count + 1)]
+            paths = pool.map(_train_binary, jobs, chunksize=1)
+            pool.close()
+            return [svmutil.svm_load_model(path) for path in paths]
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(tmpdir)
+
+    def save(self, path):
+        """Save the classifier to a directory.
+
+        The directory holds the LIBSVM model file, 'model.svm', or for a
+        one-vs-rest classifier 'model-<label index>.svm' for each label, a
+        JSON file, 'classifier.json', with the labels in index order, the
+        feature index type and any calibration parameters, and, for a
+        feature index dictionary, the arrays written by
+        vectoriser.save_feature_table. No pickling is involved. Feature keys
+        that are (namespace id, value) pairs are saved by name and restored
+        as pairs.
+
+        Args:
+            path: Directory path. It is created if necessary.
+
+        Raises:
+            IOError: File access error.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        meta = {"format": 1,
+                "labels": [self.labelindex_rev[i]
+                           for i in sorted(self.labelindex_rev)]}
+        if isinstance(self.featureindex, FeatureHasher):
+            meta["hasher"] = {"dim": self.featureindex.dim,
+                              "signed": self.featureindex.signed}
+        else:
+            vectoriser.save_feature_table(self.featureindex, path)
+            first = next(iter(self.featureindex.iteritems()), (None, None))
+            meta["ids"] = isinstance(first[0], tuple)
+        if self.calibrator is not None:
+            meta["calibration"] = self.calibrator.to_json()
+        if self.one_vs_rest:
+            meta["one_vs_rest"] = True
+            for label, model in enumerate(self.model, 1):
+                svmutil.svm_save_model(
+                    os.path.join(path, "model-%d.svm" % label), model)
+        else:
+            svmutil.svm_save_model(os.path.join(path, "model.svm"),
+                                   self.model)
+        with open(os.path.join(path, "classifier.json"), "w") as handle:
+            json.dump(meta, handle)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """Load a classifier saved by save.
+
+        Args:
+            path: Directory path.
+            mmap: Whether to memory-map a saved feature index dictionary as
+                a vectoriser.CompactFeatureIndex rather than read it into a
+                dict. This loads almost instantly and lets several processes
+                share one copy of the index.
+
+        Returns:
+            SvmClassifier object.
+
+        Raises:
+            IOError: File access error.
+        """
+        with open(os.path.join(path, "classifier.json")) as handle:
+            meta = json.load(handle)
+        labels = meta["labels"]
+        labelindex = dict(zip(labels, range(1, len(labels) + 1)))
+        if "hasher" in meta:
+            featureindex = FeatureHasher(meta["hasher"]["dim"],
+                                         meta["hasher"]["signed"])
+        elif mmap:
+            featureindex = vectoriser.CompactFeatureIndex(path)
+        else:
+            featureindex = vectoriser.load_feature_table(path)
+            if meta.get("ids"):
+                featureindex = dict((features.feature_key(ftr), index)
+                                    for ftr, index in
+                                    featureindex.iteritems())
+        calibrator = None
+        if "calibration" in meta:
+            calibrator = PlattCalibrator.from_json(meta["calibration"])
+        if meta.get("one_vs_rest"):
+            model = [svmutil.svm_load_model(
+                os.path.join(path, "model-%d.svm" % label))
+                for label in xrange(1, len(labels) + 1)]
+        else:
+            model = svmutil.svm_load_model(os.path.join(path, "model.svm"))
+        return cls(featureindex, labelindex, model, calibrator)
@@ -0,0 +1,398 @@
+"""Note content stores for ENCache.
+
+A content store holds the ENML content of a user's notes, keyed by note
+GUID. ENCache drives a store through a small set of methods:
+
+    has(guid): Membership test.
+    open(guid): A file-like object containing the content.
+    put(guid, content): Add or replace content. Safe to call from several
+        threads at once, and readers never see partial content.
+    delete(guid): Remove content, if present.
+    flush(): Make everything put so far durable.
+    close(): Release any resources.
+
+Stores are constructed with the path to the user's cache directory.
+Content can always be downloaded again, so losing the most recent puts in a
+crash is harmless as long as no corrupt content is returned.
+"""
+
+import os
+import mmap
+import struct
+import thread
+import threading
+import zlib
+import logging
+from StringIO import StringIO
+
+
+class FileContentStore(object):
+    """Stores each note's content in a flat file named with its GUID.
+
+    Every note is a file directly in the cache directory, so this suits
+    small accounts only.
+
+    Attributes:
+        cache_path: Path to the cache directory for the user.
+    """
+
+    def __init__(self, cache_path):
+        """Use the given cache directory.
+
+        Args:
+            cache_path: Path to the cache directory for the user.
+        """
+        self.cache_path = cache_path
+
+    def _fname(self, guid):
+        """Get the filename for a note's content."""
+        return os.path.join(self.cache_path, guid)
+
+    def has(self, guid):
+        """Check whether a note's content is in the store."""
+        return os.path.exists(self._fname(guid))
+
+    def open(self, guid):
+        """Open a note's content.
+
+        Raises:
+            IOError: The content is not in the store, or cache access error.
+        """
+        return open(self._fname(guid))
+
+    def _write(self, fname, data):
+        """Write data to a temporary file and rename it into place."""
+        tmp_fname = "%s.%d.tmp" % (fname, thread.get_ident())
+        handle = open(tmp_fname, "wb")
+        handle.write(data)
+        handle.close()
+        os.rename(tmp_fname, fname)
+
+    def put(self, guid, content):
+        """Add or replace a note's content.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        self._write(self._fname(guid), content)
+
+    def delete(self, guid):
+        """Remove a note's content, if present."""
+        try:
+            os.unlink(self._fname(guid))
+        except OSError:
+            pass
+
+    def flush(self):
+        """Do nothing: each put is complete when it returns."""
+        pass
+
+    def close(self):
+        """Do nothing: no resources are held."""
+        pass
+
+
+class ShardedContentStore(FileContentStore):
+    """Stores each note's content zlib-compressed, in sharded directories.
+
+    Content is kept under 'content/<first two characters of GUID>/<GUID>',
+    which spreads notes over up to 256 directories for hexadecimal GUIDs,
+    so no directory grows too large to search quickly. Compression saves
+    space on notes spanning several disk blocks, but every note still
+    costs at least one block and one inode. PackedContentStore avoids both.
+
+    Attributes:
+        cache_path: Path to the cache directory for the user.
+        level: zlib compression level.
+    """
+
+    DIRECTORY_NAME = "content"
+
+    def __init__(self, cache_path, level=6):
+        """Use the given cache directory.
+
+        Args:
+            cache_path: Path to the cache directory for the user.
+            level: zlib compression level, from 1 (fastest) to 9 (smallest).
+        """
+        super(ShardedContentStore, self).__init__(cache_path)
+        self.level = level
+        self._root = os.path.join(cache_path, self.DIRECTORY_NAME)
+
+    def _fname(self, guid):
+        return os.path.join(self._root, guid[:2], guid)
+
+    def open(self, guid):
+        """Open a note's content.
+
+        Raises:
+            IOError: The content is not in the store, or cache access error.
+        """
+        with open(self._fname(guid), "rb") as handle:
+            return StringIO(zlib.decompress(handle.read()))
+
+    def put(self, guid, content):
+        """Add or replace a note's content.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        fname = self._fname(guid)
+        directory = os.path.dirname(fname)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another thread created it first.
+                if not os.path.isdir(directory):
+                    raise
+        self._write(fname, zlib.compress(content, self.level))
+
+
+class PackedContentStore(object):
+    """Packs zlib-compressed content into append-only segment files.
+
+    Content is appended to numbered segment files in the 'packed'
+    directory, which are read through mmap. A new segment is started once
+    the current one exceeds SEGMENT_BYTES. Each record is a header
+    (compressed length, CRC32 of the compressed data, flags, GUID length)
+    followed by the GUID and the compressed content. A deletion appends a
+    record with the TOMBSTONE flag and no content.
+
+    On open, the record headers of every segment are scanned to rebuild the
+    offset index, a dictionary from GUID to the segment, offset, length and
+    CRC32 of the latest record for each note. A short record at the end of
+    the last segment, e.g. one torn by a crash, is truncated. Replaced and
+    deleted content is dead space, which flush reclaims by rewriting the
+    live records once it exceeds both COMPACT_MIN_BYTES and the live size.
+
+    Attributes:
+        directory: Path to the segment directory.
+    """
+
+    DIRECTORY_NAME = "packed"
+    SEGMENT_BYTES = 64 << 20
+    COMPACT_MIN_BYTES = 16 << 20
+    TOMBSTONE = 1
+    _HEADER = struct.Struct(">IiBH")
+
+    def __init__(self, cache_path, level=6):
+        """Open the segments and build the offset index.
+
+        Args:
+            cache_path: Path to the cache directory for the user.
+            level: zlib compression level, from 1 (fastest) to 9 (smallest).
+
+        Raises:
+            IOError: Cache access error.
+        """
+        self.directory = os.path.join(cache_path, self.DIRECTORY_NAME)
+        self.level = level
+        self.logger = logging.getLogger("ENCache")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._lock = threading.Lock()
+        self._index = {}
+        self._maps = {}
+        self._live_bytes = 0
+        self._dead_bytes = 0
+        segments = self._segments()
+        for segment in segments:
+            self._scan(segment, segment == segments[-1])
+        self._segment = segments[-1] if segments else 0
+        self._open_writer()
+
+    def _segments(self):
+        """Get the numbers of the segment files, in ascending order."""
+        return sorted(int(name[:-5]) for name in os.listdir(self.directory)
+                      if name.endswith(".pack"))
+
+    def _segment_path(self, segment):
+        """Get the path of a segment file."""
+        return os.path.join(self.directory, "%06d.pack" % segment)
+
+    def _open_writer(self):
+        """Open the current segment for appending."""
+        self._writer = open(self._segment_path(self._segment), "ab")
+        self._writer.seek(0, os.SEEK_END)
+
+    def _record_size(self, guid, length):
+        """Get the size on disk of a record."""
+        return self._HEADER.size + len(guid) + length
+
+    def _scan(self, segment, last):
+        """Add the records of a segment to the index.
+
+        Args:
+            segment: Segment number.
+            last: Whether this is the segment being appended to, whose torn
+                tail, if any, is truncated.
+        """
+        path = self._segment_path(segment)
+        good = 0
+        with open(path, "rb") as handle:
+            while True:
+                header = handle.read(self._HEADER.size)
+                if len(header) < self._HEADER.size:
+                    break
+                length, crc, flags, guid_length = self._HEADER.unpack(header)
+                guid = handle.read(guid_length)
+                offset = handle.tell()
+                handle.seek(length, os.SEEK_CUR)
+                if len(guid) < guid_length or handle.tell() > \
+                        os.fstat(handle.fileno()).st_size:
+                    break
+                self._forget(guid)
+                if flags & self.TOMBSTONE:
+                    self._dead_bytes += self._record_size(guid, 0)
+                else:
+                    self._index[guid] = (segment, offset, length, crc)
+                    self._live_bytes += self._record_size(guid, length)
+                good = handle.tell()
+        if good != os.path.getsize(path):
+            if not last:
+                raise IOError("corrupt content segment %s" % path)
+            self.logger.debug("discarding torn content record")
+            with open(path, "r+b") as handle:
+                handle.truncate(good)
+
+    def _forget(self, guid):
+        """Count the current record of a GUID, if any, as dead space."""
+        entry = self._index.pop(guid, None)
+        if entry is not None:
+            size = self._record_size(guid, entry[2])
+            self._live_bytes -= size
+            self._dead_bytes += size
+
+    def _append(self, guid, data, flags):
+        """Append a record to the current segment. Call with the lock held.
+
+        Returns:
+            2-tuple of the segment and the offset of the data.
+        """
+        if self._writer.tell() > self.SEGMENT_BYTES:
+            self._writer.close()
+            self._segment += 1
+            self._open_writer()
+        self._writer.write(self._HEADER.pack(len(data), zlib.crc32(data),
+                                             flags, len(guid)))
+        self._writer.write(guid)
+        offset = self._writer.tell()
+        self._writer.write(data)
+        self._writer.flush()
+        return self._segment, offset
+
+    def _map(self, segment, end):
+        """Get a read-only map of a segment covering at least end bytes.
+
+        Call with the lock held.
+        """
+        view = self._maps.get(segment)
+        if view is None or len(view) < end:
+            if view is not None:
+                view.close()
+            with open(self._segment_path(segment), "rb") as handle:
+                view = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = view
+        return view
+
+    def has(self, guid):
+        """Check whether a note's content is in the store."""
+        return guid in self._index
+
+    def open(self, guid):
+        """Open a note's content.
+
+        Raises:
+            IOError: The content is not in the store, is corrupt, or cache
+                access error.
+        """
+        with self._lock:
+            entry = self._index.get(guid)
+            if entry is None:
+                raise IOError("no content for note %s" % guid)
+            segment, offset, length, crc = entry
+            data = self._map(segment, offset + length)[offset:offset + length]
+        if zlib.crc32(data) != crc:
+            raise IOError("corrupt content for note %s" % guid)
+        return StringIO(zlib.decompress(data))
+
+    def put(self, guid, content):
+        """Add or replace a note's content.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        data = zlib.compress(content, self.level)
+        with self._lock:
+            segment, offset = self._append(guid, data, 0)
+            self._forget(guid)
+            self._index[guid] = (segment, offset, len(data), zlib.crc32(data))
+            self._live_bytes += self._record_size(guid, len(data))
+
+    def delete(self, guid):
+        """Remove a note's content, if present.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        with self._lock:
+            if guid not in self._index:
+                return
+            self._append(guid, "", self.TOMBSTONE)
+            self._forget(guid)
+            self._dead_bytes += self._record_size(guid, 0)
+
+    def flush(self):
+        """Make the segments durable, compacting them if mostly dead.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        if (self._dead_bytes > self.COMPACT_MIN_BYTES and
+                self._dead_bytes > self._live_bytes):
+            self.compact()
+        with self._lock:
+            os.fsync(self._writer.fileno())
+
+    def compact(self):
+        """Rewrite the live records into new segments and delete the old.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        self.logger.debug("compacting content segments")
+        with self._lock:
+            old_segments = self._segments()
+            entries = sorted(self._index.iteritems(),
+                             key=lambda item: item[1][:2])
+            self._writer.close()
+            self._segment += 1
+            self._open_writer()
+            index = {}
+            for guid, (segment, offset, length, crc) in entries:
+                data = self._map(segment, offset + length)[offset:
+                                                           offset + length]
+                index[guid] = self._append(guid, data, 0) + (length, crc)
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._index = index
+            self._dead_bytes = 0
+            for segment in old_segments:
+                view = self._maps.pop(segment, None)
+                if view is not None:
+                    view.close()
+                try:
+                    os.unlink(self._segment_path(segment))
+                except OSError:
+                    pass
+
+    def close(self):
+        """Make the segments durable and release the maps."""
+        with self._lock:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._writer.close()
+            for view in self._maps.values():
+                view.close()
+            self._maps = {}
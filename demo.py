@@ -3,35 +3,25 @@
 """Evernote notebook classifier demo."""
 
 from encache import ENCache
+from featurecache import FeatureCache
 import argparse
 import logging
 import random
 import features
+import metrics
+import evaluation
 from classifier import SvmClassifier
+from linear import LinearClassifier, OnlineClassifier
+from selection import FeatureSelector
 from prettytable import PrettyTable
 from datetime import datetime
 import os
 
 
-def note_featuredict(note, content):
-    """Generate a featuredict.
-
-    Args:
-        note: Note object.
-        content: File-like object containing the note content.
-
-    Returns:
-        A dictionary where keys are feature names and values are feature
-        values.
-    """
-    featuredict = {"DEFAULT": 1}
-    features.add_metadata_features(featuredict, note)
-    if note.attributes.contentClass is None:
-        features.add_content_features(featuredict, content)
-    return featuredict
-
-
-def execute(auth_token, host, do_randomise, test_set_size, cache_dir):
+def execute(auth_token, host, do_randomise, test_set_size, cache_dir,
+            workers=4, processes=1, hash_bits=None, max_features=None,
+            use_linear=False, model_dir=None, metrics_path=None,
+            cv_folds=None, one_vs_rest=False, online_path=None):
     """Execute the demo and print output to the console.
 
     Args:
@@ -41,13 +31,42 @@ def execute(auth_token, host, do_randomise, test_set_size, cache_dir):
             of notes before creating training and test sets.
         test_set_size: Number of notes to reserve for the test set.
         cache_dir: Root location for the Evernote cache.
+        workers: Number of concurrent content downloads.
+        processes: Number of processes for feature extraction,
+            cross-validation and one-vs-rest training.
+        hash_bits: If given, hash features into 2 ** hash_bits dimensions
+            instead of building a feature index.
+        max_features: If given, keep only this many features, selected by
+            Bi-Normal Separation.
+        use_linear: Whether to train a LinearClassifier rather than an
+            SvmClassifier.
+        model_dir: If given, save the trained SvmClassifier to this
+            directory for use by server.py.
+        metrics_path: If given, record pipeline metrics and write them to
+            this file, in the Prometheus text format if the name ends in
+            '.prom' and as JSON otherwise.
+        cv_folds: If given, evaluate a grid of C values by stratified
+            cross-validation with this many folds, using every note, instead
+            of classifying a test set.
+        one_vs_rest: Whether to train one LIBSVM model per notebook, in
+            parallel over the given number of processes, rather than a
+            single multi-class model.
+        online_path: If given, instead of training a new classifier, load
+            the OnlineClassifier checkpoint at this path, update it with the
+            notes added or changed by this run's sync, save it and classify
+            the test set with it. The checkpoint is created from every note
+            if it does not exist.
     """
     if not os.path.exists(cache_dir):
         print "directory %s does not exist" % cache_dir
         exit(1)
     logging.basicConfig(format='%(message)s', level=logging.DEBUG)
+    if metrics_path:
+        metrics.enable()
     encache = ENCache(auth_token, host, cache_root=cache_dir)
-    encache.sync()
+    fcache = FeatureCache(encache.cache_path)
+    encache.invalidation_listeners.append(fcache.invalidate)
+    changes = encache.sync()
     notes = list(encache.notes)
     print "%d notes in account" % len(encache.notes)
     if len(notes) <= test_set_size:
@@ -56,14 +75,46 @@ def execute(auth_token, host, do_randomise, test_set_size, cache_dir):
     if do_randomise:
         print "shuffling notes"
         random.shuffle(notes)
+    featuredicts = [fcache.get(note) for note in notes]
+    missing = [note for note, featuredict in zip(notes, featuredicts)
+               if featuredict is None]
+    print "%d cached featuredicts" % fcache.hits
+    encache.prefetch(missing, workers=workers, resources=True)
+    extracted = features.extract_batch(
+        missing, encache.note_content, processes=processes,
+        resource_source=encache.resource_text)
     featuresets = []
-    for note in notes:
-        featureset = (note_featuredict(note, encache.note_content(note)),
-                      note.notebookGuid)
-        featuresets.append(featureset)
+    for note, featuredict in zip(notes, featuredicts):
+        if featuredict is None:
+            featuredict = next(extracted)
+            fcache.put(note, featuredict)
+        featuresets.append((featuredict, note.notebookGuid))
+    fcache.close()
+    if cv_folds:
+        cross_validate(featuresets, cv_folds, processes, hash_bits,
+                       max_features, use_linear, encache.notebook_map)
+        if metrics_path:
+            write_metrics(metrics_path)
+        return
     featuresets_tr = featuresets[:-test_set_size]
     featuresets_t = featuresets[-test_set_size:]
-    classifier = SvmClassifier.train(featuresets_tr)
+    hash_dim = 2 ** hash_bits if hash_bits else None
+    selector = None
+    if max_features:
+        selector = FeatureSelector("bns", k=max_features)
+    if online_path:
+        classifier = update_online(online_path, changes, notes, featuresets,
+                                   hash_dim)
+    elif use_linear:
+        classifier = LinearClassifier.train(featuresets_tr, hash_dim=hash_dim,
+                                            selector=selector)
+    else:
+        classifier = SvmClassifier.train(featuresets_tr, hash_dim=hash_dim,
+                                         selector=selector,
+                                         one_vs_rest=one_vs_rest,
+                                         processes=processes)
+        if model_dir:
+            classifier.save(model_dir)
     print "using %d features" % len(classifier.featureindex)
     labels = classifier.classify(featuresets_t)
     nb_map = encache.notebook_map
@@ -72,7 +123,8 @@ def execute(auth_token, host, do_randomise, test_set_size, cache_dir):
     for note, label in zip(notes[-test_set_size:], labels):
         dtime = datetime.fromtimestamp(note.updated / 1000)
         updated = dtime.strftime("%Y%m%d %H:%M")
-        row = [note.title, nb_map[note.notebookGuid], nb_map[label]]
+        row = [note.title, nb_map[note.notebookGuid],
+               nb_map.get(label, "(none)")]
         for i, value in enumerate(row):
             # Work around EDAM encoding bug.
             row[i] = unicode(value, encoding="utf-8")
@@ -81,6 +133,95 @@ def execute(auth_token, host, do_randomise, test_set_size, cache_dir):
         row.append(updated)
         table.add_row(row)
     print table
+    if metrics_path:
+        write_metrics(metrics_path)
+
+
+def update_online(path, changes, notes, featuresets, hash_dim=None):
+    """Bring an OnlineClassifier checkpoint up to date with a sync.
+
+    Only the notes added or updated by the sync are learned, so the cost is
+    proportional to the changes rather than to the size of the account.
+    Changes synced by a run that did not save the checkpoint are not
+    learned.
+
+    Args:
+        path: Checkpoint file path. If it does not exist, a classifier is
+            trained on every note and saved there.
+        changes: SyncChanges object returned by ENCache.sync.
+        notes: List of every Note in the cache.
+        featuresets: List of labelled featuresets, one per note.
+        hash_dim: Number of hashed feature dimensions for a new classifier,
+            or None for the default.
+
+    Returns:
+        OnlineClassifier object.
+    """
+    if os.path.exists(path):
+        classifier = OnlineClassifier.load(path)
+        guids = changes.added | changes.updated
+        updates = [featureset for note, featureset in zip(notes, featuresets)
+                   if note.guid in guids]
+        print "updating online classifier with %d notes" % len(updates)
+        classifier.update(updates)
+        classifier.discard_labels(changes.expunged_notebooks)
+    else:
+        print "training online classifier on %d notes" % len(featuresets)
+        classifier = OnlineClassifier.train(featuresets,
+                                            hash_dim=hash_dim or 2 ** 18)
+    classifier.save(path)
+    return classifier
+
+
+def write_metrics(path):
+    """Write the recorded metrics to a file.
+
+    Args:
+        path: File path. The Prometheus text format is used if the name
+            ends in '.prom', and JSON otherwise.
+    """
+    with open(path, "w") as handle:
+        if path.endswith(".prom"):
+            handle.write(metrics.to_prometheus())
+        else:
+            handle.write(metrics.to_json())
+
+
+def cross_validate(featuresets, folds, processes, hash_bits, max_features,
+                   use_linear, nb_map):
+    """Cross-validate a grid of C values and print the results.
+
+    Args:
+        featuresets: List of labelled featuresets.
+        folds: Number of folds.
+        processes: Number of evaluation processes.
+        hash_bits: As for execute.
+        max_features: As for execute.
+        use_linear: As for execute.
+        nb_map: Mapping from Notebook GUIDs to titles.
+    """
+    params = "-c %g" if use_linear else "-t 0 -q -c %g"
+    grid = {"params": [params % c for c in (0.1, 1, 10)],
+            "hash_dim": [2 ** hash_bits if hash_bits else None],
+            "max_features": [max_features]}
+    results = evaluation.cross_validate(
+        featuresets, grid, folds, processes,
+        LinearClassifier if use_linear else SvmClassifier)
+    table = PrettyTable(["params", "accuracy", "precision", "recall",
+                         "seconds"])
+    for result in results:
+        table.add_row([result.config["params"], "%.3f" % result.accuracy,
+                       "%.3f" % result.macro_precision,
+                       "%.3f" % result.macro_recall, "%.1f" % result.seconds])
+    print table
+    best = max(results, key=lambda result: result.accuracy)
+    print "per-notebook results for %s" % best.config["params"]
+    table = PrettyTable(["notebook", "notes", "precision", "recall"])
+    for label in sorted(best.support, key=best.support.get, reverse=True):
+        table.add_row([unicode(nb_map[label], encoding="utf-8"),
+                       best.support[label], "%.3f" % best.precision[label],
+                       "%.3f" % best.recall[label]])
+    print table
 
 
 def run_cli():
@@ -96,8 +237,28 @@ classification demo")
                         default="data")
     parser.add_argument("-r", action="store_true",
                         help="shuffles notes so the test set is random")
+    parser.add_argument("-w", help="concurrent content downloads (default: 4)",
+                        type=int, default=4)
+    parser.add_argument("-p", type=int, default=1,
+                        help="worker processes for feature extraction, \
+evaluation and -v training (default: 1)")
+    parser.add_argument("-b", help="hash features into 2^B dimensions",
+                        type=int)
+    parser.add_argument("-k", help="keep the best K features", type=int)
+    parser.add_argument("-l", action="store_true",
+                        help="use the linear solver instead of LIBSVM")
+    parser.add_argument("-o", help="save the LIBSVM model to directory O")
+    parser.add_argument("-m", help="write pipeline metrics to file M")
+    parser.add_argument("-x", type=int,
+                        help="cross-validate a grid of C values with X folds")
+    parser.add_argument("-v", action="store_true",
+                        help="train one-vs-rest LIBSVM models in parallel")
+    parser.add_argument("-u", help="update the online classifier checkpoint "
+                        "U with the notes changed since the last run, and "
+                        "classify with it")
     args = parser.parse_args()
-    execute(args.auth_token, args.s, args.r, args.n, args.d)
+    execute(args.auth_token, args.s, args.r, args.n, args.d, args.w, args.p,
+            args.b, args.k, args.l, args.o, args.m, args.x, args.v, args.u)
 
 
 if __name__ == "__main__":
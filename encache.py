@@ -3,10 +3,217 @@ import thrift.transport.THttpClient as THttpClient
 import evernote.edam.userstore.UserStore as UserStore
 import evernote.edam.notestore.NoteStore as NoteStore
 from evernote.edam.notestore.ttypes import SyncChunkFilter
+from evernote.edam.error.ttypes import EDAMSystemException, EDAMErrorCode
+from metastore import PickleStore
+from contentstore import FileContentStore
+import metrics
 import os
-import pickle
-from collections import OrderedDict
 import logging
+import threading
+import time
+import Queue
+from collections import OrderedDict
+from StringIO import StringIO
+
+
+class SyncChanges(object):
+    """The net changes made to a cache by one call to ENCache.sync.
+
+    A note added and then updated within a sync is only reported as added,
+    and a note or notebook added and then expunged is not reported at all.
+
+    Attributes:
+        added: Set of GUIDs of new notes.
+        updated: Set of GUIDs of notes that were already in the cache and
+            have changed.
+        expunged: Set of GUIDs of notes removed from the cache.
+        expunged_notebooks: Set of GUIDs of notebooks removed from the cache.
+    """
+
+    def __init__(self):
+        self.added = set()
+        self.updated = set()
+        self.expunged = set()
+        self.expunged_notebooks = set()
+        self._added_notebooks = set()
+
+    def __len__(self):
+        return (len(self.added) + len(self.updated) + len(self.expunged) +
+                len(self.expunged_notebooks))
+
+    def note_added(self, guid):
+        """Record a new note."""
+        self.added.add(guid)
+
+    def note_updated(self, guid):
+        """Record a changed note."""
+        if guid not in self.added:
+            self.updated.add(guid)
+
+    def note_expunged(self, guid):
+        """Record a removed note."""
+        if guid in self.added:
+            self.added.discard(guid)
+        else:
+            self.updated.discard(guid)
+            self.expunged.add(guid)
+
+    def notebook_added(self, guid):
+        """Record a new notebook."""
+        self._added_notebooks.add(guid)
+
+    def notebook_expunged(self, guid):
+        """Record a removed notebook."""
+        if guid in self._added_notebooks:
+            self._added_notebooks.discard(guid)
+        else:
+            self.expunged_notebooks.add(guid)
+
+
+class SyncProgress(object):
+    """Progress of a call to ENCache.sync, reported after each chunk.
+
+    Rates are measured from the start of the call, so a resumed sync only
+    counts the chunks it has fetched itself.
+
+    Attributes:
+        start_usn: The last update count when the sync started.
+        usn: The chunkHighUSN of the latest chunk.
+        update_count: The account's update count reported by the server.
+        chunks: The number of chunks synced so far.
+        notes: The number of notes received so far.
+        elapsed: Seconds since the sync started.
+    """
+
+    def __init__(self, start_usn):
+        self.start_usn = start_usn
+        self.usn = start_usn
+        self.update_count = start_usn
+        self.chunks = 0
+        self.notes = 0
+        self._start = time.time()
+        self.elapsed = 0.0
+
+    def chunk_done(self, chunk):
+        """Record a synced chunk."""
+        self.usn = chunk.chunkHighUSN
+        self.update_count = chunk.updateCount
+        self.chunks += 1
+        if chunk.notes:
+            self.notes += len(chunk.notes)
+        self.elapsed = time.time() - self._start
+
+    @property
+    def fraction(self):
+        """The fraction of the USNs to sync that have been synced."""
+        total = self.update_count - self.start_usn
+        if total <= 0:
+            return 1.0
+        return float(self.usn - self.start_usn) / total
+
+    @property
+    def notes_per_second(self):
+        """The rate of notes received, or 0.0 before any time has passed."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.notes / self.elapsed
+
+    @property
+    def eta_seconds(self):
+        """Estimated seconds remaining, or None if there is no estimate yet.
+
+        The estimate extrapolates the rate at which USNs have been synced,
+        as the number of notes still to come is not known.
+        """
+        done = self.usn - self.start_usn
+        if done <= 0 or self.elapsed <= 0:
+            return None
+        return (self.update_count - self.usn) * self.elapsed / done
+
+    def __str__(self):
+        eta = self.eta_seconds
+        return "synced %d/%d (%.1f%%), %d notes, %.1f notes/s, eta %s" % (
+            self.usn, self.update_count, 100 * self.fraction, self.notes,
+            self.notes_per_second, "?" if eta is None else "%.0fs" % eta)
+
+
+class ContentLRU(object):
+    """In-memory cache of note content with a byte budget.
+
+    Entries are evicted least recently used first once the total size of
+    the cached content exceeds the budget. Content larger than the whole
+    budget is never cached. Safe for use from multiple threads.
+
+    Attributes:
+        max_bytes: The byte budget.
+        size: Total bytes of content currently cached.
+        hits: Number of get calls that found the content.
+        misses: Number of get calls that did not.
+    """
+
+    def __init__(self, max_bytes):
+        """Create an empty cache.
+
+        Args:
+            max_bytes: The byte budget.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, guid):
+        """Get cached content and mark it most recently used.
+
+        Args:
+            guid: A Note GUID.
+
+        Returns:
+            The content string, or None if it is not cached.
+        """
+        with self._lock:
+            content = self._entries.pop(guid, None)
+            if content is None:
+                self.misses += 1
+                return None
+            self._entries[guid] = content
+            self.hits += 1
+            return content
+
+    def put(self, guid, content):
+        """Cache content, evicting older entries to stay within budget.
+
+        Args:
+            guid: A Note GUID.
+            content: The content string.
+        """
+        if len(content) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(guid, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[guid] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, guid):
+        """Remove content from the cache, if present.
+
+        Args:
+            guid: A Note GUID.
+        """
+        with self._lock:
+            content = self._entries.pop(guid, None)
+            if content is not None:
+                self.size -= len(content)
 
 
 class ENCache(object):
@@ -15,23 +222,31 @@ class ENCache(object):
     Content is stored in a specified cache directory under the sub-path
     <evernote_host>/<username_id>.
 
-    Note contents are stored in flat, utf-8 encoded files named with the
-    note GUID.
-
-    EDAM Note and Notebook objects and the last update count are stored as a
-    pickled dictionary with the filename 'user.dat' and the form:
+    Note contents are held by a content store (see contentstore). The
+    default FileContentStore keeps them in flat, utf-8 encoded files named
+    with the note GUID. ShardedContentStore compresses each note into
+    sharded subdirectories, and PackedContentStore packs compressed notes
+    into a few large segment files, which suits large accounts best.
 
-    { "last_update_count": VALUE,
-      "notes": OrderedDict([(GUID, NOTE), (GUID, NOTE), ...]),
-      "notebooks": OrderedDict([(GUID, NOTEBOOK), (GUID, NOTEBOOK), ...)])
+    The search text of resources (attachments), i.e. the text recognised in
+    images and extracted from PDFs, is held by the same content store under
+    the resource GUID, prefixed with the resource USN it was fetched at.
 
-    The full set of Note objects (not note contents) is re-written to disk
-    after each call to sync that receives new data, so don't use this in high
-    performance scenarios.
+    EDAM Note and Notebook objects and the last update count are held by a
+    metadata store (see metastore). The default PickleStore keeps them in a
+    pickled dictionary with the filename 'user.dat' and re-writes the full set
+    of Note objects (not note contents) after each call to sync that receives
+    new data, so don't use it in high performance scenarios. JournalStore
+    instead appends one record per sync chunk, so the cost of a sync scales
+    with the number of changes. SqliteStore keeps them in an indexed database
+    and loads notes lazily.
 
     Attributes:
         notestore: NoteStore object.
+        notestore_url: URL of the user's NoteStore.
         userstore: UserStore object.
+        store: Metadata store object.
+        content_store: Content store object.
         last_update_count: The last USN successfully synced.
         notes: List of Note objects, ordered by ascending USN.
         notebooks: List of Notebook objects, ordered by ascending USN.
@@ -40,6 +255,12 @@ class ENCache(object):
         cache_path: Path to the cache directory for the user.
         dat_path: Path to the user.dat file for the user.
         user_id: The numeric user ID.
+        invalidation_listeners: Callables invoked with the GUID of each note
+            whose cached content or resources are cleared or changed by
+            sync. Use these to invalidate anything derived from note content
+            or resource text.
+        content_lru: ContentLRU holding recently read note content in
+            memory, or None.
 
     Raises:
         In addition to the exceptions listed, all methods can raise either of:
@@ -49,8 +270,15 @@ class ENCache(object):
 
     USERFILE_NAME = "user.dat"
     MAX_SYNC_OBJS = 256  # This is the maximum. See EDAM docs.
+    MAX_RATE_LIMIT_RETRIES = 5
+    CHECKPOINT_CHUNKS = 50
+    # Resources with these MIME types have search text even without a
+    # recognition index. Other resources are only fetched if they have one.
+    RESOURCE_TEXT_MIME_TYPES = ("application/pdf",)
 
-    def __init__(self, auth_token, host, cache_root="data"):
+    def __init__(self, auth_token, host, cache_root="data",
+                 store=PickleStore, content_cache_bytes=0,
+                 content_store=FileContentStore):
         """Authenticate to the API and read any cached notes and notebooks
         into memory.
 
@@ -58,144 +286,263 @@ class ENCache(object):
             auth_token: A string.
             host: "www.evernote.com" or "sandbox.evernote.com".
             cache_root: Path to cache root directory.
+            store: Metadata store class, or any callable that takes the user's
+                cache path and returns a metadata store.
+            content_cache_bytes: Budget in bytes for keeping recently read
+                note content in memory, so that repeated passes over the
+                same notes skip the disk. 0 disables this.
+            content_store: Content store class, or any callable that takes
+                the user's cache path and returns a content store.
 
         Raises:
             IOError: Connection or name resolution failed, or cache access
                 error.
         """
         # Get the UserStore object and user ID.
-        userstore_uri = "https://%s/edam/user" % host
-        userstore_httpclient = THttpClient.THttpClient(userstore_uri)
-        userstore_protocol = \
-            TBinaryProtocol.TBinaryProtocol(userstore_httpclient)
-        userstore = UserStore.Client(userstore_protocol)
+        userstore = self.new_userstore(host)
         user_id = userstore.getUser(auth_token).id
         # Get the NoteStore object.
-        notestore_url = userstore.getNoteStoreUrl(auth_token)
-        notestore_httpclient = THttpClient.THttpClient(notestore_url)
-        notestore_protocol = \
-            TBinaryProtocol.TBinaryProtocol(notestore_httpclient)
-        notestore = NoteStore.Client(notestore_protocol)
+        self.notestore_url = userstore.getNoteStoreUrl(auth_token)
+        notestore = self.new_notestore()
         # Prepare the cache and set attributes.
         cache_path = os.path.sep.join([cache_root, host, str(user_id)])
         userfile_path = os.path.sep.join([cache_path, self.USERFILE_NAME])
-        if os.path.exists(userfile_path):
-            cdata = pickle.load(open(userfile_path))
-            self.note_data = cdata["note_data"]
-            self.notebook_data = cdata["notebook_data"]
-            self.last_update_count = cdata["last_update_count"]
-        else:
-            if not os.path.exists(cache_path):
-                os.makedirs(cache_path)
-            self.note_data = OrderedDict()
-            self.notebook_data = OrderedDict()
-            self.last_update_count = 0
+        if not os.path.exists(cache_path):
+            os.makedirs(cache_path)
+        self.store = store(cache_path)
+        self.content_store = content_store(cache_path)
         self.userstore = userstore
         self.notestore = notestore
         self.auth_token = auth_token
         self.user_id = user_id
         self.cache_path = cache_path
         self.userfile_path = userfile_path
+        self.invalidation_listeners = []
+        self.content_lru = None
+        if content_cache_bytes > 0:
+            self.content_lru = ContentLRU(content_cache_bytes)
         self.logger = logging.getLogger("ENCache")
         self.logger.debug("connected")
 
+    def new_userstore(self, host):
+        """Create a UserStore client.
+
+        Override this, together with new_notestore, to run the cache against
+        a fake service.
+
+        Args:
+            host: As passed to __init__.
+
+        Returns:
+            UserStore object.
+        """
+        userstore_uri = "https://%s/edam/user" % host
+        userstore_httpclient = THttpClient.THttpClient(userstore_uri)
+        userstore_protocol = \
+            TBinaryProtocol.TBinaryProtocol(userstore_httpclient)
+        return UserStore.Client(userstore_protocol)
+
+    def new_notestore(self):
+        """Create a new NoteStore client for the user's shard.
+
+        Thrift clients are not thread-safe, so each prefetch worker uses its
+        own client. Override this to substitute a fake NoteStore in tests.
+
+        Returns:
+            NoteStore object.
+        """
+        notestore_httpclient = THttpClient.THttpClient(self.notestore_url)
+        notestore_protocol = \
+            TBinaryProtocol.TBinaryProtocol(notestore_httpclient)
+        return NoteStore.Client(notestore_protocol)
+
+    @property
+    def last_update_count(self):
+        """Get the last USN successfully synced."""
+        return self.store.last_update_count
+
     @property
     def notes(self):
         """Get the list of Notes, ordered by ascending USN."""
-        return self.note_data.values()
+        return self.store.notes()
 
     @property
     def notebooks(self):
         """Get the list of Notebooks, ordered by ascending USN."""
-        return self.notebook_data.values()
+        return self.store.notebooks()
+
+    def get_note(self, guid):
+        """Get a Note by GUID.
+
+        Args:
+            guid: A Note GUID.
+
+        Returns:
+            Note object, or None if the note is not in the cache.
+        """
+        return self.store.get_note(guid)
+
+    def notes_in_notebook(self, guid):
+        """Get the Notes in a notebook, ordered by ascending USN.
+
+        Args:
+            guid: A Notebook GUID.
+
+        Returns:
+            Sequence of Note objects.
+        """
+        return self.store.notes_in_notebook(guid)
+
+    def notes_updated_since(self, timestamp):
+        """Get the Notes updated at or after a given time, ordered by
+        ascending USN.
+
+        Args:
+            timestamp: Milliseconds since the epoch, as in Note.updated.
+
+        Returns:
+            Sequence of Note objects.
+        """
+        return self.store.notes_updated_since(timestamp)
 
     @property
     def notebook_map(self):
         """Get a mapping from Notebook GUIDs to titles."""
         return dict([(nb.guid, nb.name) for nb in self.notebooks])
 
-    def _write_userfile(self):
-        """Write the userfile to the cache."""
-        self.logger.debug("writing to cache")
-        cdata = {"note_data": self.note_data,
-                 "notebook_data": self.notebook_data,
-                 "last_update_count": self.last_update_count}
-        pickle.dump(cdata, open(self.userfile_path, "w"))
-
-    def sync(self):
+    def sync(self, checkpoint_chunks=None, progress=None):
         """Synchronise with the server.
 
         Read new and updated Note and Notebook objects. Delete expunged Notes
         and Notebooks.
 
         Note content for new and updated Notes is deleted if it already
-        exists in the cache, but it is not downloaded.
+        exists in the cache, but it is not downloaded. Likewise the search
+        text of updated resources is deleted, along with that of the
+        resources of updated and expunged Notes.
+
+        The stores are flushed every checkpoint_chunks chunks, so an
+        interrupted sync resumes from the last checkpoint on the next call
+        rather than from the start. Chunks are not retained once applied.
+
+        Args:
+            checkpoint_chunks: Number of chunks between checkpoints. Defaults
+                to CHECKPOINT_CHUNKS. JournalStore and SqliteStore are
+                already durable after every chunk, but PickleStore rewrites
+                the whole userfile at each checkpoint, so keep this large
+                for it.
+            progress: Callable invoked with a SyncProgress object after each
+                chunk, or None.
+
+        Returns:
+            SyncChanges object describing what changed.
 
         Raises:
             IOError: Cache access error.
         """
         scfilter = SyncChunkFilter(includeNotes=True,
                                    includeNoteAttributes=True,
+                                   includeNoteResources=True,
+                                   includeResources=True,
                                    includeNotebooks=True,
                                    includeExpunged=True)
-        after_usn = self.last_update_count
+        if checkpoint_chunks is None:
+            checkpoint_chunks = self.CHECKPOINT_CHUNKS
+        store = self.store
+        changes = SyncChanges()
+        last_update_count = store.last_update_count
+        after_usn = last_update_count
+        checkpoint_usn = last_update_count
+        status = SyncProgress(last_update_count)
         while True:
-            chunk = self.notestore.getFilteredSyncChunk(self.auth_token,
-                                                        after_usn,
-                                                        self.MAX_SYNC_OBJS,
-                                                        scfilter)
+            with metrics.timer("encache_sync_chunk_seconds"):
+                chunk = self.notestore.getFilteredSyncChunk(
+                    self.auth_token, after_usn, self.MAX_SYNC_OBJS, scfilter)
             if chunk.chunkHighUSN:
                 after_usn = chunk.chunkHighUSN
                 if chunk.notes:
+                    metrics.increment("encache_sync_notes_total",
+                                      len(chunk.notes))
                     for note in chunk.notes:
-                        if note.guid in self.note_data:
+                        if store.has_note(note.guid):
                             self.logger.debug("updating note %s", note.guid)
-                            del self.note_data[note.guid]
+                            self._clear_resource_text(
+                                store.get_note(note.guid))
                             self._clear_note_content(note.guid)
+                            changes.note_updated(note.guid)
                         else:
                             self.logger.debug("adding note %s", note.guid)
-                        self.note_data[note.guid] = note
+                            changes.note_added(note.guid)
+                        store.put_note(note)
+                if chunk.resources:
+                    for resource in chunk.resources:
+                        # Recognition often completes after a note is
+                        # created, so the note's features change even if
+                        # no text was cached for the resource.
+                        guid = resource.noteGuid
+                        if (store.has_note(guid) and
+                                guid not in changes.added):
+                            self.logger.debug("updating resource %s",
+                                              resource.guid)
+                            self._update_resource(resource)
+                            changes.note_updated(guid)
                 if chunk.notebooks:
                     for notebook in chunk.notebooks:
-                        if notebook.guid in self.notebook_data:
+                        if store.has_notebook(notebook.guid):
                             self.logger.debug("updating notebook %s",
                                               notebook.guid)
-                            del self.notebook_data[notebook.guid]
                         else:
                             self.logger.debug("adding notebook %s",
                                               notebook.guid)
-                        self.notebook_data[notebook.guid] = notebook
+                            changes.notebook_added(notebook.guid)
+                        store.put_notebook(notebook)
                 if chunk.expungedNotes:
                     for guid in chunk.expungedNotes:
-                        if guid in self.note_data:
+                        if store.has_note(guid):
                             self.logger.debug("expunging note %s", guid)
+                            self._clear_resource_text(store.get_note(guid))
                             self._clear_note_content(guid)
-                            del self.note_data[guid]
+                            store.expunge_note(guid)
+                            changes.note_expunged(guid)
                 if chunk.expungedNotebooks:
                     for guid in chunk.expungedNotebooks:
-                        if guid in self.notebook_data:
+                        if store.has_notebook(guid):
                             self.logger.debug("expunging notebook %s", guid)
-                            del self.notebook_data[guid]
-                self.logger.debug("synced %d/%d", chunk.chunkHighUSN,
-                                  chunk.updateCount)
+                            store.expunge_notebook(guid)
+                            changes.notebook_expunged(guid)
+                store.end_chunk(after_usn)
+                status.chunk_done(chunk)
+                self.logger.debug("%s", status)
+                if progress is not None:
+                    progress(status)
                 if after_usn == chunk.updateCount:
                     break
+                if status.chunks % checkpoint_chunks == 0:
+                    self._checkpoint()
+                    checkpoint_usn = after_usn
             else:
                 break
-        if after_usn != self.last_update_count:
-            self.last_update_count = after_usn
-            self._write_userfile()
-
-    def _note_content_fname(self, guid):
-        """Get the cache filename for the given note.
+        if after_usn != checkpoint_usn:
+            self._checkpoint()
+        else:
+            self.content_store.flush()
+        return changes
 
-        Args:
-            note: A Note GUID.
+    def _checkpoint(self):
+        """Make the synced chunks durable.
 
-        Returns:
-            Path string.
+        Content deletions are flushed before the metadata, so the metadata
+        never records a chunk whose stale content could reappear.
         """
-        return os.path.sep.join([self.cache_path, guid])
+        self.logger.debug("checkpointing at %d", self.store.last_update_count)
+        metrics.increment("encache_sync_checkpoints_total")
+        self.content_store.flush()
+        self.store.flush()
+
+    def close(self):
+        """Release the metadata and content stores."""
+        self.store.close()
+        self.content_store.close()
 
     def _clear_note_content(self, guid):
         """Clear the content from the cache for a note.
@@ -203,32 +550,260 @@ class ENCache(object):
         Args:
             note: A Note GUID.
         """
-        fname = self._note_content_fname(guid)
-        try:
-            os.unlink(fname)
-        except OSError:
-            pass
+        self.content_store.delete(guid)
+        if self.content_lru is not None:
+            self.content_lru.discard(guid)
+        for listener in self.invalidation_listeners:
+            listener(guid)
+
+    def _update_resource(self, resource):
+        """Apply a changed resource of a note already in the cache.
+
+        The resource replaces the one with the same GUID in the stored
+        Note, so that resource_text sees its new USN and recognition
+        index. Its cached text is cleared and the invalidation listeners
+        are called for the note.
+
+        Args:
+            resource: Resource object.
+        """
+        note = self.store.get_note(resource.noteGuid)
+        resources = list(note.resources or ())
+        for i, old in enumerate(resources):
+            if old.guid == resource.guid:
+                resources[i] = resource
+                break
+        else:
+            resources.append(resource)
+        note.resources = resources
+        self.store.put_note(note)
+        self.content_store.delete(resource.guid)
+        for listener in self.invalidation_listeners:
+            listener(note.guid)
+
+    def _clear_resource_text(self, note):
+        """Clear the search text from the cache for a note's resources.
+
+        Args:
+            note: Note object.
+        """
+        for resource in note.resources or ():
+            self.content_store.delete(resource.guid)
+
+    def _fetch_note_content(self, notestore, guid):
+        """Download note content into the content store.
+
+        Args:
+            notestore: NoteStore object to use for the request.
+            guid: A Note GUID.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        self.logger.debug("fetching content for %s", guid)
+        with metrics.timer("encache_fetch_seconds"):
+            content = notestore.getNoteContent(self.auth_token, guid)
+        metrics.increment("encache_fetched_bytes_total", len(content))
+        self.content_store.put(guid, content)
 
     def note_content(self, note):
         """Get the content of the given note.
 
-        Checks if the content is in the cache then calls the API if
-        necessary.
+        Checks if the content is in memory, if enabled, then in the content
+        store, then calls the API if necessary.
 
         Args:
             note: Note object.
 
         Returns:
-            File handle.
+            File-like object.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        lru = self.content_lru
+        if lru is not None:
+            content = lru.get(note.guid)
+            if content is not None:
+                metrics.increment("encache_memory_hits_total")
+                return StringIO(content)
+            metrics.increment("encache_memory_misses_total")
+        content_store = self.content_store
+        if content_store.has(note.guid):
+            metrics.increment("encache_content_hits_total")
+        else:
+            metrics.increment("encache_content_misses_total")
+            self._fetch_note_content(self.notestore, note.guid)
+        if lru is None:
+            return content_store.open(note.guid)
+        content = content_store.open(note.guid).read()
+        lru.put(note.guid, content)
+        return StringIO(content)
+
+    def has_resource_text(self, resource):
+        """Check whether a resource may have search text.
+
+        Args:
+            resource: Resource object.
+
+        Returns:
+            Boolean.
+        """
+        return (resource.recognition is not None or
+                resource.mime in self.RESOURCE_TEXT_MIME_TYPES)
+
+    def _cached_resource_text(self, resource):
+        """Get the cached search text of a resource.
+
+        Args:
+            resource: Resource object.
+
+        Returns:
+            The utf-8 encoded text, or None if it is not cached or was
+            fetched at an older USN than the resource's.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        if not self.content_store.has(resource.guid):
+            return None
+        usn, text = self.content_store.open(resource.guid).read().split(
+            "\n", 1)
+        if int(usn) < resource.updateSequenceNum:
+            return None
+        return text
+
+    def _fetch_resource_text(self, notestore, resource):
+        """Download the search text of a resource into the content store.
+
+        Args:
+            notestore: NoteStore object to use for the request.
+            resource: Resource object.
+
+        Returns:
+            The utf-8 encoded text.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        self.logger.debug("fetching search text for %s", resource.guid)
+        with metrics.timer("encache_resource_fetch_seconds"):
+            text = notestore.getResourceSearchText(self.auth_token,
+                                                   resource.guid)
+        metrics.increment("encache_fetched_bytes_total", len(text))
+        self.content_store.put(resource.guid, "%d\n%s" % (
+            resource.updateSequenceNum, text))
+        return text
+
+    def resource_text(self, note):
+        """Get the search text of the given note's resources.
+
+        Only resources for which has_resource_text is True are considered.
+        Text is read from the content store, and the API is called for any
+        resource whose text is missing or stale. Use prefetch with
+        resources=True to fetch the text for many notes at once.
+
+        Args:
+            note: Note object, with resources.
+
+        Returns:
+            Unicode string joining the text of each resource with newlines.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        texts = []
+        for resource in note.resources or ():
+            if not self.has_resource_text(resource):
+                continue
+            text = self._cached_resource_text(resource)
+            if text is None:
+                metrics.increment("encache_resource_misses_total")
+                text = self._fetch_resource_text(self.notestore, resource)
+            else:
+                metrics.increment("encache_resource_hits_total")
+            texts.append(unicode(text, "utf-8"))
+        return u"\n".join(texts)
+
+    def prefetch(self, notes, workers=4, resources=False):
+        """Download the content of any of the given notes not yet cached.
+
+        Content is fetched by a bounded pool of worker threads, each with its
+        own NoteStore client, so a cold cache costs roughly one round trip
+        per note divided by the number of workers. With resources=True, the
+        search text of their resources, as for resource_text, is fetched by
+        the same pool. A worker that hits the
+        API rate limit sleeps for the duration the server asks for, then
+        retries, up to MAX_RATE_LIMIT_RETRIES times.
+
+        Args:
+            notes: Iterable of Note objects.
+            workers: Maximum number of concurrent requests.
+            resources: Whether to also fetch resource search text.
+
+        Returns:
+            Number of notes and resources fetched.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        missing = Queue.Queue()
+        for note in notes:
+            if not self.content_store.has(note.guid):
+                missing.put((self._fetch_note_content, note.guid))
+            if not resources:
+                continue
+            for resource in note.resources or ():
+                if (self.has_resource_text(resource) and
+                        self._cached_resource_text(resource) is None):
+                    missing.put((self._fetch_resource_text, resource))
+        count = missing.qsize()
+        errors = []
+
+        def work():
+            notestore = self.new_notestore()
+            while not errors:
+                try:
+                    fetch, item = missing.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._fetch_with_backoff(fetch, notestore, item)
+                except Exception as exc:
+                    errors.append(exc)
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(workers, count))]
+        for worker in threads:
+            worker.daemon = True
+            worker.start()
+        for worker in threads:
+            worker.join()
+        self.content_store.flush()
+        if errors:
+            raise errors[0]
+        return count
+
+    def _fetch_with_backoff(self, fetch, notestore, item):
+        """Fetch an item, sleeping and retrying when rate limited.
+
+        Args:
+            fetch: _fetch_note_content or _fetch_resource_text.
+            notestore: NoteStore object to use for the request.
+            item: A Note GUID or a Resource object, as fetch expects.
 
         Raises:
             IOError: Cache access error.
         """
-        fname = self._note_content_fname(note.guid)
-        if not os.path.exists(fname):
-            self.logger.debug("fetching content for %s", note.guid)
-            content = self.notestore.getNoteContent(self.auth_token, note.guid)
-            handle = open(fname, "w")
-            handle.write(content)
-            handle.close()
-        return open(fname)
+        for attempt in range(self.MAX_RATE_LIMIT_RETRIES + 1):
+            try:
+                fetch(notestore, item)
+                return
+            except EDAMSystemException as exc:
+                if (exc.errorCode != EDAMErrorCode.RATE_LIMIT_REACHED or
+                        attempt == self.MAX_RATE_LIMIT_RETRIES):
+                    raise
+                duration = exc.rateLimitDuration or 2 ** attempt
+                metrics.increment("encache_rate_limited_total")
+                self.logger.debug("rate limited, sleeping for %ds", duration)
+                time.sleep(duration)
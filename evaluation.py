@@ -0,0 +1,265 @@
+"""Cross-validation and parameter grid search for notebook classifiers.
+
+Featuresets are extracted once and shared by every fold and configuration.
+Each (configuration, fold) pair is an independent job: a classifier is
+trained on the other folds and classifies the held-out fold. With
+processes > 1, jobs run on a process pool whose workers inherit the
+featuresets when they are forked, so only fold and configuration indices
+are sent with each job. Predictions from the held-out folds are pooled to
+compute accuracy and per-label precision and recall.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import random
+import time
+from classifier import SvmClassifier
+from selection import FeatureSelector
+
+# Configuration keys and their defaults. A configuration is a dictionary
+# with any of these keys: "params", the classifier's parameter string, or
+# None for its default; "hash_dim", as for SvmClassifier.build_indices; and
+# "max_features", the number of features to keep by Bi-Normal Separation,
+# or None to keep all.
+DEFAULT_CONFIG = {"params": None, "hash_dim": None, "max_features": None}
+
+# Set in each worker process by _init_worker.
+_shared = None
+
+
+class CVResult(object):
+    """Cross-validation results for one configuration.
+
+    Attributes:
+        config: The configuration dictionary.
+        accuracy: Fraction of featuresets whose held-out prediction was
+            correct.
+        fold_accuracies: List of the accuracy on each fold.
+        precision: Dictionary mapping labels to the fraction of predictions
+            of that label that were correct, or 0.0 if it was never
+            predicted.
+        recall: Dictionary mapping labels to the fraction of featuresets
+            with that label that were predicted correctly.
+        support: Dictionary mapping labels to the number of featuresets with
+            that label.
+        train_seconds: Total training time over the folds.
+        classify_seconds: Total classification time over the folds.
+    """
+
+    def __init__(self, config, labels, predictions, fold_accuracies,
+                 train_seconds, classify_seconds):
+        """Compute the scores from the pooled held-out predictions.
+
+        Args:
+            config: The configuration dictionary.
+            labels: List of the correct label of each featureset.
+            predictions: List of the held-out prediction for each
+                featureset.
+            fold_accuracies: List of the accuracy on each fold.
+            train_seconds: Total training time over the folds.
+            classify_seconds: Total classification time over the folds.
+        """
+        self.config = config
+        self.fold_accuracies = fold_accuracies
+        self.train_seconds = train_seconds
+        self.classify_seconds = classify_seconds
+        correct = {}
+        predicted = {}
+        self.support = {}
+        for label, prediction in zip(labels, predictions):
+            self.support[label] = self.support.get(label, 0) + 1
+            predicted[prediction] = predicted.get(prediction, 0) + 1
+            if label == prediction:
+                correct[label] = correct.get(label, 0) + 1
+        self.accuracy = float(sum(correct.values())) / max(len(labels), 1)
+        self.precision = {}
+        self.recall = {}
+        for label, count in self.support.iteritems():
+            hits = correct.get(label, 0)
+            self.recall[label] = float(hits) / count
+            self.precision[label] = (float(hits) / predicted[label]
+                                     if label in predicted else 0.0)
+
+    @property
+    def seconds(self):
+        """Total training and classification time over the folds."""
+        return self.train_seconds + self.classify_seconds
+
+    @property
+    def macro_precision(self):
+        """The mean of the per-label precisions."""
+        return sum(self.precision.values()) / max(len(self.precision), 1)
+
+    @property
+    def macro_recall(self):
+        """The mean of the per-label recalls."""
+        return sum(self.recall.values()) / max(len(self.recall), 1)
+
+
+def stratified_folds(labels, k, seed=0):
+    """Split featureset indices into k folds with similar label mixes.
+
+    The indices of each label are shuffled and dealt round-robin to the
+    folds, continuing from where the previous label left off, so fold sizes
+    differ by at most one.
+
+    Args:
+        labels: List of the label of each featureset.
+        k: Number of folds.
+        seed: Random seed for the shuffle.
+
+    Returns:
+        List of k lists of indices, each in ascending order.
+
+    Raises:
+        ValueError: k is less than 2 or greater than the number of
+            featuresets.
+    """
+    if k < 2 or k > len(labels):
+        raise ValueError("need 2 <= k <= %d folds" % len(labels))
+    by_label = {}
+    for i, label in enumerate(labels):
+        by_label.setdefault(label, []).append(i)
+    rand = random.Random(seed)
+    folds = [[] for _ in xrange(k)]
+    position = 0
+    for label in sorted(by_label):
+        indices = by_label[label]
+        rand.shuffle(indices)
+        for i in indices:
+            folds[position % k].append(i)
+            position += 1
+    return [sorted(fold) for fold in folds]
+
+
+def parameter_grid(grid):
+    """Expand a grid into the list of its configurations.
+
+    Args:
+        grid: Dictionary mapping configuration keys to lists of values.
+
+    Returns:
+        List of configuration dictionaries, one for each combination of
+        values, varying the last key (in sorted order) fastest.
+
+    Raises:
+        KeyError: Unknown configuration key.
+    """
+    for key in grid:
+        if key not in DEFAULT_CONFIG:
+            raise KeyError("unknown configuration key %s" % key)
+    keys = sorted(grid)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def _init_worker(shared):
+    """Make the featuresets and folds available to a worker process."""
+    global _shared
+    _shared = shared
+
+
+def _run_fold(job):
+    """Train on all folds but one and classify the held-out fold.
+
+    Args:
+        job: 2-tuple of the configuration index and the fold index.
+
+    Returns:
+        4-tuple of the job, the list of predictions for the held-out fold,
+        and the training and classification times.
+    """
+    config_index, fold_index = job
+    featuresets, folds, configs, classifier_class = _shared
+    config = dict(DEFAULT_CONFIG, **configs[config_index])
+    held_out = set(folds[fold_index])
+    train = [featuresets[i] for i in xrange(len(featuresets))
+             if i not in held_out]
+    test = [featuresets[i] for i in folds[fold_index]]
+    kwargs = {"hash_dim": config["hash_dim"]}
+    if config["params"] is not None:
+        kwargs["params"] = config["params"]
+    if config["max_features"]:
+        kwargs["selector"] = FeatureSelector("bns", k=config["max_features"])
+    start = time.time()
+    classifier = classifier_class.train(train, **kwargs)
+    trained = time.time()
+    predictions = classifier.classify(test)
+    return job, predictions, trained - start, time.time() - trained
+
+
+def cross_validate(featuresets, grid=None, k=5, processes=1,
+                   classifier_class=SvmClassifier, seed=0):
+    """Evaluate each configuration of a grid by stratified k-fold CV.
+
+    Args:
+        featuresets: List of labelled featuresets.
+        grid: Dictionary mapping configuration keys (see DEFAULT_CONFIG) to
+            lists of values, or a list of configuration dictionaries. None
+            evaluates the default configuration only.
+        k: Number of folds.
+        processes: Number of worker processes.
+        classifier_class: Class with the train and classify methods of
+            SvmClassifier, e.g. LinearClassifier.
+        seed: Random seed for assigning featuresets to folds.
+
+    Returns:
+        List of CVResult objects, one per configuration, in grid order.
+
+    Raises:
+        ValueError: Invalid number of folds or configuration.
+        KeyError: Unknown configuration key.
+    """
+    if grid is None:
+        configs = [{}]
+    elif isinstance(grid, dict):
+        configs = parameter_grid(grid)
+    else:
+        configs = list(grid)
+    for config in configs:
+        for key in config:
+            if key not in DEFAULT_CONFIG:
+                raise KeyError("unknown configuration key %s" % key)
+        if config.get("hash_dim") and config.get("max_features"):
+            raise ValueError("feature selection requires a feature index")
+    labels = [label for _, label in featuresets]
+    folds = stratified_folds(labels, k, seed)
+    shared = (featuresets, folds, configs, classifier_class)
+    jobs = [(c, f) for c in xrange(len(configs)) for f in xrange(k)]
+    logger = logging.getLogger("evaluation")
+    start = time.time()
+    if processes == 1:
+        _init_worker(shared)
+        try:
+            outputs = [_run_fold(job) for job in jobs]
+        finally:
+            _init_worker(None)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (shared,))
+        try:
+            outputs = pool.map(_run_fold, jobs, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    logger.debug("evaluated %d configurations in %.1fs", len(configs),
+                 time.time() - start)
+    results = []
+    for c, config in enumerate(configs):
+        predictions = [None] * len(featuresets)
+        fold_accuracies = []
+        train_seconds = classify_seconds = 0.0
+        for (_, f), fold_predictions, train_time, classify_time in \
+                outputs[c * k:(c + 1) * k]:
+            correct = 0
+            for i, prediction in zip(folds[f], fold_predictions):
+                predictions[i] = prediction
+                correct += prediction == labels[i]
+            fold_accuracies.append(float(correct) / len(folds[f]))
+            train_seconds += train_time
+            classify_seconds += classify_time
+        results.append(CVResult(config, labels, predictions,
+                                fold_accuracies, train_seconds,
+                                classify_seconds))
+    return results
@@ -0,0 +1,112 @@
+"""A persistent cache of note featuredicts."""
+
+import os
+import pickle
+import sqlite3
+import binascii
+import logging
+import features
+
+
+class FeatureCache(object):
+    """A persistent cache of featuredicts, keyed by note GUID.
+
+    Each entry is stored with a validation key made up of the feature model
+    version, the note's contentHash and its updateSequenceNum, so an entry
+    is only returned if it was computed from the same note revision by the
+    same feature model. Register invalidate as an ENCache invalidation
+    listener to drop entries as soon as sync clears the content they were
+    computed from.
+
+    Entries are pickled into an SQLite database with the filename
+    'features.db' in the ENCache directory for the user. Writes become
+    durable on commit or close.
+
+    Attributes:
+        db_path: Path to the database file.
+        version: Feature model version used in validation keys.
+        hits: Number of get calls that returned a featuredict.
+        misses: Number of get calls that returned None.
+    """
+
+    DBFILE_NAME = "features.db"
+
+    def __init__(self, cache_path, version=features.MODEL_VERSION):
+        """Open, and if necessary create, the cache.
+
+        Args:
+            cache_path: Path to the ENCache directory for the user.
+            version: Feature model version.
+
+        Raises:
+            sqlite3.Error: Database access error.
+        """
+        self.db_path = os.path.join(cache_path, self.DBFILE_NAME)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS features ("
+                          "guid TEXT PRIMARY KEY, key TEXT, data BLOB)")
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger("FeatureCache")
+
+    def _key(self, note):
+        """Get the validation key for a note.
+
+        Args:
+            note: Note object.
+
+        Returns:
+            A string.
+        """
+        content_hash = note.contentHash
+        if content_hash is not None:
+            content_hash = binascii.hexlify(content_hash)
+        return "%s:%s:%s" % (self.version, content_hash,
+                             note.updateSequenceNum)
+
+    def get(self, note):
+        """Get the cached featuredict for a note.
+
+        Args:
+            note: Note object.
+
+        Returns:
+            A featuredict, or None if there is no valid entry.
+        """
+        row = self.conn.execute("SELECT key, data FROM features "
+                                "WHERE guid = ?", (note.guid,)).fetchone()
+        if row is None or row[0] != self._key(note):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(str(row[1]))
+
+    def put(self, note, featuredict):
+        """Cache the featuredict for a note.
+
+        Args:
+            note: Note object.
+            featuredict: The featuredict computed for the note.
+        """
+        data = pickle.dumps(featuredict, pickle.HIGHEST_PROTOCOL)
+        self.conn.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?)",
+                          (note.guid, self._key(note), sqlite3.Binary(data)))
+
+    def invalidate(self, guid):
+        """Drop the entry for a note.
+
+        Args:
+            guid: A Note GUID.
+        """
+        self.logger.debug("invalidating features for %s", guid)
+        self.conn.execute("DELETE FROM features WHERE guid = ?", (guid,))
+
+    def commit(self):
+        """Make all changes durable."""
+        self.conn.commit()
+
+    def close(self):
+        """Commit and close the cache."""
+        self.conn.commit()
+        self.conn.close()
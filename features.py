@@ -2,10 +2,80 @@
 
 from urlparse import urlparse
 from lxml import etree
-from tokeniser import Tokeniser
+from tokeniser import Tokeniser, TokenSet
+from StringIO import StringIO
+import multiprocessing
+import time
+import metrics
 
+# Bump this whenever a change to this module alters the features produced for
+# a note, so that persisted featuredicts are recomputed.
+MODEL_VERSION = 4
 
-def add_metadata_features(featuredict, note):
+# Feature namespaces. A feature can be keyed either by its name, a string
+# such as "CONTENT-TOKEN-foo", or by an interned (namespace id, value) pair
+# such as (CONTENT_TOKEN, u"foo"). The name is the namespace prefix followed
+# by the value; features with no value use an empty value. Only append to
+# this table, since ids index into it.
+NAMESPACES = ("DEFAULT", "META-TITLETOKEN-", "META-URL-", "META-HASURL",
+              "META-HASLOCATION", "META-SOURCE-", "META-PLACE-",
+              "META-CONTENTCLASS-", "CONTENT-TOKEN-", "CONTENT-MEDIA-",
+              "CONTENT-HASLINK", "CONTENT-LINK-", "CONTENT-TODO",
+              "RESOURCE-TOKEN-")
+(DEFAULT, META_TITLETOKEN, META_URL, META_HASURL, META_HASLOCATION,
+ META_SOURCE, META_PLACE, META_CONTENTCLASS, CONTENT_TOKEN, CONTENT_MEDIA,
+ CONTENT_HASLINK, CONTENT_LINK, CONTENT_TODO,
+ RESOURCE_TOKEN) = range(len(NAMESPACES))
+
+
+def _key_maker(ids):
+    """Get a function mapping (namespace id, value) to a feature key."""
+    if ids:
+        return lambda namespace, value=u"": (namespace, value)
+    return lambda namespace, value=u"": NAMESPACES[namespace] + value
+
+
+def feature_name(key):
+    """Get the name of a feature.
+
+    Args:
+        key: A feature name or a (namespace id, value) pair.
+
+    Returns:
+        The feature name, e.g. "CONTENT-TOKEN-foo".
+    """
+    if isinstance(key, tuple):
+        return NAMESPACES[key[0]] + key[1]
+    return key
+
+
+def feature_key(name):
+    """Get the (namespace id, value) pair for a feature name.
+
+    This is the inverse of feature_name. Where prefixes overlap, the longest
+    matching prefix wins.
+
+    Args:
+        name: A feature name, e.g. "CONTENT-TOKEN-foo".
+
+    Returns:
+        A (namespace id, value) pair.
+
+    Raises:
+        ValueError: The name is not in any namespace.
+    """
+    best = None
+    for namespace, prefix in enumerate(NAMESPACES):
+        if (name.startswith(prefix) and
+                (prefix.endswith("-") or name == prefix) and
+                (best is None or len(prefix) > len(NAMESPACES[best]))):
+            best = namespace
+    if best is None:
+        raise ValueError("no namespace for feature %r" % name)
+    return best, name[len(NAMESPACES[best]):]
+
+
+def add_metadata_features(featuredict, note, ids=False):
     """Add features from note metadata.
 
     Derive the following features from the Note and add them to the
@@ -27,25 +97,131 @@ def add_metadata_features(featuredict, note):
     Args:
         featuredict: A dict.
         note: Note object.
+        ids: Whether to key features by (namespace id, value) pairs rather
+            than by name.
     """
-    for token in Tokeniser.split(unicode(note.title, encoding="utf-8")):
-        featuredict["META-TITLETOKEN-%s" % token.lower()] = 1
-    if note.attributes.sourceURL:
-        netloc = urlparse(note.attributes.sourceURL).netloc
+    key = _key_maker(ids)
+    title = unicode(note.title, encoding="utf-8")
+    for token in Tokeniser.unique(title):
+        featuredict[key(META_TITLETOKEN, token)] = 1
+    attributes = note.attributes
+    if attributes.sourceURL:
+        netloc = urlparse(attributes.sourceURL).netloc
         if netloc:
-            featuredict["META-URL-%s" % netloc] = 1
-            featuredict["META-HASURL"] = 1
-    if note.attributes.latitude is not None:
-        featuredict["META-HASLOCATION"] = 1
-    if note.attributes.source:
-        featuredict["META-SOURCE-%s" % note.attributes.source] = 1
-    if note.attributes.placeName:
-        featuredict["META-PLACE-%s" % note.attributes.placeName] = 1
-    if note.attributes.contentClass:
-        featuredict["META-CONTENTCLASS-%s" % note.attributes.contentClass] = 1
-
-
-def add_content_features(featuredict, content):
+            featuredict[key(META_URL, netloc)] = 1
+            featuredict[key(META_HASURL)] = 1
+    if attributes.latitude is not None:
+        featuredict[key(META_HASLOCATION)] = 1
+    if attributes.source:
+        featuredict[key(META_SOURCE, attributes.source)] = 1
+    if attributes.placeName:
+        featuredict[key(META_PLACE, attributes.placeName)] = 1
+    if attributes.contentClass:
+        featuredict[key(META_CONTENTCLASS, attributes.contentClass)] = 1
+
+
+class _ContentTarget(object):
+    """lxml parser target that derives content features in a single pass.
+
+    The parser calls start, end and data as it reads the document, so no
+    tree is built. Text is tokenised as it arrives: everything up to the
+    last whitespace character seen is tokenised, and the remainder is held
+    back until more text arrives, since no token spans whitespace. The
+    tokens are therefore the same as those of the full document text. Held
+    back pieces are only joined once whitespace arrives, so a long run
+    without whitespace, e.g. base64 or CJK text, costs linear time.
+
+    Distinct case-folded tokens are collected in a TokenSet, which may cap
+    them, and turned into feature keys when parsing ends. Text after a cap
+    is reached is not tokenised. Held back text counts towards max_chars
+    too, so a run that passes the cap is dropped, as TokenSet would drop
+    it, without being buffered further.
+    """
+
+    def __init__(self, featuredict, ids=False, max_tokens=None,
+                 max_chars=None):
+        self.featuredict = featuredict
+        self.key = _key_maker(ids)
+        self.pending = []
+        self.pending_chars = 0
+        self.tokens = TokenSet(max_tokens, max_chars)
+        # Only time tokenisation if it will be recorded, since data is
+        # called for every text run.
+        self.timed = metrics.enabled
+        self.tokenise_seconds = 0.0
+
+    def start(self, tag, attrib):
+        featuredict = self.featuredict
+        key = self.key
+        if tag == "en-media":
+            # A missing type has always been named "CONTENT-MEDIA-None".
+            featuredict[key(CONTENT_MEDIA, attrib.get("type", "None"))] = 1
+        elif tag == "a":
+            url = attrib.get("href")
+            if url is not None:
+                featuredict[key(CONTENT_HASLINK)] = 1
+                netloc = urlparse(url).netloc
+                if netloc:
+                    featuredict[key(CONTENT_LINK, netloc)] = 1
+        elif tag == "en-todo":
+            featuredict[key(CONTENT_TODO)] = 1
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        if self.tokens.full:
+            return
+        if not data:
+            return
+        data = unicode(data)
+        if data[-1].isspace():
+            tail = u""
+        else:
+            # rsplit only scans back from the end to the last whitespace.
+            tail = data.rsplit(None, 1)[-1]
+            if len(tail) == len(data):
+                self.pending_chars += len(data)
+                chars_left = self.tokens.chars_left
+                if chars_left is not None and self.pending_chars > chars_left:
+                    self.tokens.full = True
+                    self.pending = []
+                else:
+                    self.pending.append(data)
+                return
+        text = u"".join(self.pending) + data[:len(data) - len(tail)]
+        self.pending = [tail] if tail else []
+        self.pending_chars = len(tail)
+        if self.timed:
+            start = time.time()
+            self.tokens.update(text)
+            self.tokenise_seconds += time.time() - start
+        else:
+            self.tokens.update(text)
+
+    def close(self):
+        text = u"".join(self.pending)
+        if self.timed:
+            start = time.time()
+            self.tokens.update(text)
+            self.tokenise_seconds += time.time() - start
+            metrics.observe("features_tokenise_seconds",
+                            self.tokenise_seconds)
+        else:
+            self.tokens.update(text)
+        if self.tokens.full:
+            metrics.increment("features_capped_notes_total")
+        self.pending = []
+        self.pending_chars = 0
+        featuredict = self.featuredict
+        key = self.key
+        for token in self.tokens.tokens:
+            featuredict[key(CONTENT_TOKEN, token)] = 1
+        self.tokens = TokenSet()
+
+
+def add_content_features(featuredict, content, ids=False, max_tokens=None,
+                         max_chars=None):
     """Add features from note content.
 
     Derive the following features from note content and add them to the
@@ -59,23 +235,167 @@ def add_content_features(featuredict, content):
         CONTENT-LINK-<domain>: Set with the domain of each link in the note.
         CONTENT-TODO: Set if the note contains a todo.
 
+    The content is parsed in a single streaming pass without building a
+    document tree, so memory use is bounded by the largest text run rather
+    than the size of the note. Caps on the number of tokens or on the
+    length of the text tokenised bound the work for very long notes.
+
     Args:
         featuredict: A dict.
         content: File-like object containing the note content.
+        ids: Whether to key features by (namespace id, value) pairs rather
+            than by name.
+        max_tokens: Maximum number of CONTENT-TOKEN features, or None.
+        max_chars: Maximum number of characters of text to tokenise, or
+            None.
+    """
+    parser = etree.HTMLParser(target=_ContentTarget(featuredict, ids,
+                                                    max_tokens, max_chars))
+    with metrics.timer("features_content_seconds"):
+        etree.parse(content, parser)
+
+
+def add_resource_features(featuredict, text, ids=False, max_tokens=None,
+                          max_chars=None):
+    """Add features from the search text of note resources.
+
+    Derive the following features from the text and add them to the
+    featuredict with binary values:
+
+        RESOURCE-TOKEN-<token>: Set for each unique, case-folded token in
+            the text recognised in images or extracted from documents
+            attached to the note.
+
+    Args:
+        featuredict: A dict.
+        text: Unicode string, e.g. as returned by ENCache.resource_text.
+        ids: Whether to key features by (namespace id, value) pairs rather
+            than by name.
+        max_tokens: Maximum number of RESOURCE-TOKEN features, or None.
+        max_chars: Maximum number of characters of text to tokenise, or
+            None.
+    """
+    key = _key_maker(ids)
+    tokens = TokenSet(max_tokens, max_chars)
+    tokens.update(text)
+    for token in tokens.tokens:
+        featuredict[key(RESOURCE_TOKEN, token)] = 1
+
+
+def note_featuredict(note, content, ids=False, max_tokens=None,
+                     max_chars=None, resource_text=None):
+    """Generate a featuredict.
+
+    Args:
+        note: Note object.
+        content: File-like object containing the note content. Only read if
+            needs_content(note) is True.
+        ids: Whether to key features by (namespace id, value) pairs rather
+            than by name. Use feature_name to get the names back.
+        max_tokens: As for add_content_features. Applies separately to the
+            resource text.
+        max_chars: As for add_content_features. Applies separately to the
+            resource text.
+        resource_text: Unicode search text of the note's resources, or None
+            to add no resource features. Only used if needs_content(note)
+            is True.
+
+    Returns:
+        A dictionary where keys are feature names, or (namespace id, value)
+        pairs, and values are feature values.
+    """
+    with metrics.timer("features_extract_seconds"):
+        featuredict = {_key_maker(ids)(DEFAULT): 1}
+        add_metadata_features(featuredict, note, ids)
+        if needs_content(note):
+            add_content_features(featuredict, content, ids, max_tokens,
+                                 max_chars)
+            if resource_text:
+                add_resource_features(featuredict, resource_text, ids,
+                                      max_tokens, max_chars)
+    metrics.observe("features_per_note", len(featuredict),
+                    metrics.SIZE_BUCKETS)
+    return featuredict
+
+
+def needs_content(note):
+    """Check whether note_featuredict uses the content of a note.
+
+    Notes with a content class are created by special-purpose applications,
+    so only their metadata is used.
+
+    Args:
+        note: Note object.
+
+    Returns:
+        Boolean.
+    """
+    return note.attributes.contentClass is None
+
+
+def _extract(job):
+    """Generate a featuredict from a (Note, content string, kwargs) tuple."""
+    note, content, kwargs = job
+    if content is not None:
+        content = StringIO(content)
+    return note_featuredict(note, content, **kwargs)
+
+
+def _job(note, content_source, resource_source, kwargs):
+    """Read the inputs for extracting the features of a note."""
+    if not needs_content(note):
+        return note, None, kwargs
+    content = content_source(note).read()
+    if resource_source is not None:
+        kwargs = dict(kwargs, resource_text=resource_source(note))
+    return note, content, kwargs
+
+
+def extract_batch(notes, content_source, processes=1, chunksize=16,
+                  ids=False, max_tokens=None, max_chars=None,
+                  resource_source=None):
+    """Generate featuredicts for a batch of notes.
+
+    Feature extraction is CPU bound, so with processes > 1 the notes are
+    fanned out over a process pool. Content is read in the calling process
+    and sent to the workers as strings. Results are yielded as they become
+    available, in the same order as notes, and are identical to those of
+    calling note_featuredict on each note in turn.
+
+    Args:
+        notes: Iterable of Note objects.
+        content_source: Callable that takes a Note and returns a file-like
+            object containing its content, e.g. ENCache.note_content. With
+            processes > 1, it is called from a pool feeder thread.
+        processes: Number of worker processes. With 1, notes are processed
+            serially in the calling process.
+        chunksize: Number of notes sent to a worker at a time.
+        ids: As for note_featuredict.
+        max_tokens: As for note_featuredict.
+        max_chars: As for note_featuredict.
+        resource_source: Callable that takes a Note and returns the search
+            text of its resources, e.g. ENCache.resource_text, or None to
+            add no resource features. Called like content_source.
+
+    Yields:
+        One featuredict per note.
     """
-    parser = etree.HTMLParser()
-    root = etree.parse(content, parser).getroot()
-    string_content = unicode(root.xpath('string()'))
-    for token in Tokeniser.split(string_content):
-        featuredict["CONTENT-TOKEN-%s" % token.lower()] = 1
-    for media in root.iterfind(".//en-media"):
-        featuredict["CONTENT-MEDIA-%s" % media.get("type")] = 1
-    for link in root.iterfind(".//a"):
-        url = link.get("href")
-        if url is not None:
-            featuredict["CONTENT-HASLINK"] = 1
-            netloc = urlparse(link.get("href")).netloc
-            if netloc:
-                featuredict["CONTENT-LINK-%s" % netloc] = 1
-    if root.find(".//en-todo") is not None:
-        featuredict["CONTENT-TODO"] = 1
+    kwargs = {"ids": ids, "max_tokens": max_tokens, "max_chars": max_chars}
+    jobs = (_job(note, content_source, resource_source, kwargs)
+            for note in notes)
+    start = time.time()
+    if processes == 1:
+        for job in jobs:
+            metrics.increment("features_notes_total")
+            yield _extract(job)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for featuredict in pool.imap(_extract, jobs, chunksize):
+                metrics.increment("features_notes_total")
+                yield featuredict
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    metrics.observe("features_batch_seconds", time.time() - start)
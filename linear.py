@@ -0,0 +1,504 @@
+"""Linear classifiers with the SvmClassifier interface."""
+
+import os
+import json
+import numpy
+from scipy import sparse
+from classifier import SvmClassifier
+from calibration import PlattCalibrator, rank_labels
+import metrics
+from vectoriser import FeatureHasher, featuresets_to_csr
+
+# Weights are held in a dense (labels, features + 1) matrix, so their size
+# grows with both. Training or updating a model whose weights would exceed
+# this many bytes raises ValueError rather than exhausting memory.
+MAX_WEIGHT_BYTES = 2 ** 30
+
+
+def check_weight_bytes(labels, columns, dtype=numpy.float64):
+    """Check that a dense weight matrix fits within MAX_WEIGHT_BYTES.
+
+    Args:
+        labels: Number of rows, one per label.
+        columns: Number of columns, including the bias.
+        dtype: NumPy dtype of the weights.
+
+    Raises:
+        ValueError: The weights would exceed MAX_WEIGHT_BYTES.
+    """
+    size = labels * columns * numpy.dtype(dtype).itemsize
+    if size > MAX_WEIGHT_BYTES:
+        raise ValueError(
+            "weights for %d labels and %d features need %d MB, more than "
+            "the %d MB limit; use fewer hash dimensions or feature "
+            "selection" % (labels, columns - 1, size >> 20,
+                           MAX_WEIGHT_BYTES >> 20))
+
+
+class LinearClassifier(object):
+    """One-vs-rest linear SVM with the SvmClassifier interface.
+
+    LIBSVM solves linear problems with its general kernel solver, which
+    scales poorly with the number of notes. This class instead trains one
+    L2-regularised linear SVM per label with the dual coordinate descent
+    method of Hsieh et al. (2008), as used by LIBLINEAR, and keeps the
+    weight vectors in a dense matrix. Classifying a batch of featuresets is
+    then a single sparse matrix product.
+
+    The binary problems of all labels share each pass over the training
+    data: the update for a featureset is computed for every label at once
+    with NumPy. Training needs a dense float64 weight matrix of (labels,
+    features + 1), e.g. 800 MB for 100 notebooks hashed into 2^20
+    dimensions, and train raises ValueError above MAX_WEIGHT_BYTES.
+
+    Attributes:
+        featureindex: Dictionary mapping feature names to integers, or a
+            FeatureHasher.
+        labelindex: Dictionary mapping labels to integers.
+        labelindex_rev: Dictionary mapping integers to labels.
+        weights: Array of shape (number of labels, number of features + 1).
+            Row i holds the weights for the label with index i + 1, and the
+            last column holds the bias.
+        calibrator: PlattCalibrator object, or None.
+    """
+
+    def __init__(self, featureindex, labelindex, weights, calibrator=None):
+        """Accept the feature index, label index and trained weights.
+
+        This is not designed to be called directly. Use the train method
+        instead.
+
+        Args:
+            featureindex: Dictionary mapping feature names to integers, or a
+                FeatureHasher.
+            labelindex: Dictionary mapping labels to integers.
+            weights: Weight array, as described for the attribute.
+            calibrator: PlattCalibrator object, or None.
+        """
+        self.featureindex = featureindex
+        self.labelindex = labelindex
+        self.labelindex_rev = dict((v, k) for k, v in labelindex.iteritems())
+        self.weights = weights
+        self.calibrator = calibrator
+
+    @classmethod
+    def parse_params(cls, params):
+        """Parse a LIBLINEAR-style parameter string.
+
+        Recognised options are:
+
+            -s TYPE: 1 for L2-loss (the default) or 3 for L1-loss, as in
+                LIBLINEAR.
+            -c C: Cost parameter (default 1).
+            -e EPS: Stopping tolerance (default 0.1).
+            -B BIAS: Value of the bias feature, or a negative number for no
+                bias (default 1).
+            -q: Accepted and ignored.
+
+        Args:
+            params: Parameter string.
+
+        Returns:
+            Dictionary with the keys "loss", "C", "eps" and "bias".
+
+        Raises:
+            ValueError: Unrecognised option.
+        """
+        options = {"loss": 2, "C": 1.0, "eps": 0.1, "bias": 1.0}
+        argv = params.split()
+        i = 0
+        while i < len(argv):
+            if argv[i] == "-q":
+                i += 1
+                continue
+            if i + 1 >= len(argv):
+                raise ValueError("missing value for %s" % argv[i])
+            value = argv[i + 1]
+            if argv[i] == "-s":
+                if value not in ("1", "3"):
+                    raise ValueError("unsupported solver type %s" % value)
+                options["loss"] = 2 if value == "1" else 1
+            elif argv[i] == "-c":
+                options["C"] = float(value)
+            elif argv[i] == "-e":
+                options["eps"] = float(value)
+            elif argv[i] == "-B":
+                options["bias"] = float(value)
+            else:
+                raise ValueError("unrecognised option %s" % argv[i])
+            i += 2
+        return options
+
+    @classmethod
+    def _design_matrix(cls, featureindex, labelindex, featuresets, bias):
+        """Vectorise featuresets and append the bias column.
+
+        Returns:
+            2-tuple of a CSR matrix and a label array.
+        """
+        matrix, labels = featuresets_to_csr(featureindex, labelindex,
+                                            featuresets)
+        column = numpy.empty((matrix.shape[0], 1))
+        column.fill(max(bias, 0))
+        matrix = sparse.hstack([matrix, sparse.csr_matrix(column)],
+                               format="csr")
+        return matrix, labels
+
+    @classmethod
+    def _solve(cls, matrix, targets, C, loss, eps, max_iter, seed=0):
+        """Run dual coordinate descent for a set of binary problems.
+
+        Args:
+            matrix: CSR matrix of shape (instances, features).
+            targets: Array of shape (problems, instances) of +1 and -1.
+            C: Cost parameter.
+            loss: 1 or 2 for L1-loss or L2-loss.
+            eps: Stopping tolerance on the projected gradient.
+            max_iter: Maximum number of passes over the data.
+            seed: Seed for the order in which instances are visited.
+
+        Returns:
+            Weight array of shape (problems, features).
+        """
+        problems, instances = targets.shape
+        weights = numpy.zeros((problems, matrix.shape[1]))
+        alpha = numpy.zeros((problems, instances))
+        if loss == 2:
+            diag = 0.5 / C
+            upper = numpy.inf
+        else:
+            diag = 0.0
+            upper = C
+        sqnorms = numpy.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+        qd = sqnorms + diag
+        indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+        random = numpy.random.RandomState(seed)
+        for _ in xrange(max_iter):
+            pg_max = -numpy.inf
+            pg_min = numpy.inf
+            for i in random.permutation(instances):
+                if qd[i] <= 0:
+                    continue
+                idx = indices[indptr[i]:indptr[i + 1]]
+                val = data[indptr[i]:indptr[i + 1]]
+                y = targets[:, i]
+                a = alpha[:, i]
+                grad = y * weights[:, idx].dot(val) - 1 + diag * a
+                pgrad = numpy.where(a <= 0, numpy.minimum(grad, 0),
+                                    numpy.where(a >= upper,
+                                                numpy.maximum(grad, 0),
+                                                grad))
+                pg_max = max(pg_max, pgrad.max())
+                pg_min = min(pg_min, pgrad.min())
+                new = numpy.clip(a - grad / qd[i], 0, upper)
+                delta = (new - a) * y
+                if delta.any():
+                    weights[:, idx] += numpy.outer(delta, val)
+                    alpha[:, i] = new
+            if pg_max - pg_min <= eps:
+                break
+        return weights
+
+    @classmethod
+    def train(cls, featuresets, params="-c 1", hash_dim=None, selector=None,
+              max_iter=1000):
+        """Train a classifier using the given featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+            params: LIBLINEAR-style parameter string, see parse_params.
+            hash_dim: As for SvmClassifier.build_indices.
+            selector: As for SvmClassifier.build_indices.
+            max_iter: Maximum number of passes over the training data.
+
+        Returns:
+            LinearClassifier object.
+
+        Raises:
+            ValueError: Invalid parameters, or the weights would exceed
+                MAX_WEIGHT_BYTES.
+        """
+        options = cls.parse_params(params)
+        featureindex, labelindex = SvmClassifier.build_indices(
+            featuresets, hash_dim, selector)
+        check_weight_bytes(len(labelindex), len(featureindex) + 1)
+        matrix, labels = cls._design_matrix(featureindex, labelindex,
+                                            featuresets, options["bias"])
+        targets = -numpy.ones((len(labelindex), matrix.shape[0]))
+        targets[labels.astype(int) - 1, numpy.arange(matrix.shape[0])] = 1
+        with metrics.timer("linear_train_seconds"):
+            weights = cls._solve(matrix, targets, options["C"],
+                                 options["loss"], options["eps"], max_iter)
+        # Fold the bias feature value into its weights so classification
+        # can use a bias column of ones.
+        weights[:, -1] *= max(options["bias"], 0)
+        return cls(featureindex, labelindex, weights)
+
+    def classify(self, featuresets):
+        """Classify a list of featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+
+        Returns:
+            List of labels, one per featureset.
+        """
+        if not featuresets:
+            return []
+        scores = self.decision_function(featuresets)
+        return [self.labelindex_rev[int(i) + 1]
+                for i in numpy.argmax(scores, axis=1)]
+
+    def decision_function(self, featuresets):
+        """Score a list of featuresets against every label.
+
+        Args:
+            featuresets: List of featuresets.
+
+        Returns:
+            Array of shape (featuresets, labels). Column j holds the decision
+            values of the label with index j + 1.
+        """
+        if not featuresets:
+            return numpy.zeros((0, len(self.labelindex)))
+        with metrics.timer("linear_predict_seconds"):
+            matrix, _ = self._design_matrix(self.featureindex,
+                                            self.labelindex, featuresets, 1)
+            scores = matrix.dot(self.weights.T)
+        metrics.increment("linear_predict_notes_total", len(featuresets))
+        return scores
+
+    def calibrate(self, featuresets):
+        """Fit a PlattCalibrator to held-out featuresets.
+
+        Args:
+            featuresets: List of featuresets not used in training.
+        """
+        columns = [self.labelindex.get(label, 0) - 1
+                   for _, label in featuresets]
+        self.calibrator = PlattCalibrator.fit(
+            self.decision_function(featuresets), columns)
+
+    def classify_proba(self, featuresets, k=None):
+        """Rank the labels for a list of featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+            k: Maximum number of labels per featureset, or None for all.
+
+        Returns:
+            As for SvmClassifier.classify_proba.
+        """
+        scores = self.decision_function(featuresets)
+        if self.calibrator is not None:
+            scores = self.calibrator.probabilities(scores)
+        labels = [self.labelindex_rev[i + 1]
+                  for i in xrange(len(self.labelindex))]
+        return rank_labels(scores, labels, k)
+
+
+class OnlineClassifier(object):
+    """Multi-class passive-aggressive linear classifier with online updates.
+
+    Each update visits featuresets one at a time and, whenever the correct
+    label does not beat the best wrong label by a margin of 1, moves the
+    two weight vectors towards and away from the featureset by the smallest
+    step that would fix the margin, capped at C (the PA-I rule of Crammer
+    et al. 2006). The cost of an update is proportional to the size of the
+    featuresets in it, not to the amount of data seen before, so a model
+    can be kept current after each ENCache.sync by updating it with just
+    the added and updated notes:
+
+        changes = encache.sync()
+        guids = changes.added | changes.updated
+        notes = [encache.get_note(guid) for guid in guids]
+        classifier.update([(features.note_featuredict(
+            note, encache.note_content(note)), note.notebookGuid)
+            for note in notes])
+        classifier.discard_labels(changes.expunged_notebooks)
+        classifier.save(path)
+
+    Features are hashed, so the vocabulary can grow without bound. Labels
+    are added as they are first seen, and while there is only one, it is
+    learned against an implicit label that always scores 0. Expunged notes
+    cannot be unlearned, but their influence fades as later updates correct
+    the weights.
+
+    Weights are dense float32 rows of hash_dim + 1 values per label, 1 MB
+    per label at the default hash_dim, and adding a label beyond
+    MAX_WEIGHT_BYTES raises ValueError.
+
+    Attributes:
+        featureindex: FeatureHasher object.
+        labelindex: Dictionary mapping labels to integers.
+        labelindex_rev: Dictionary mapping integers to labels.
+        weights: float32 array of shape (number of labels, hash dimensions
+            + 1). Row i holds the weights for the label with index i + 1,
+            and the last column holds the bias.
+        C: Aggressiveness parameter.
+    """
+
+    def __init__(self, hash_dim=2 ** 18, C=1.0):
+        """Create an untrained classifier.
+
+        Args:
+            hash_dim: Number of hashed feature dimensions.
+            C: Aggressiveness parameter, capping the size of each step.
+        """
+        self.featureindex = FeatureHasher(hash_dim)
+        self.labelindex = {}
+        self.labelindex_rev = {}
+        self.weights = numpy.zeros((0, hash_dim + 1), numpy.float32)
+        self.C = C
+
+    def _add_label(self, label):
+        """Add a row of zero weights for a new label.
+
+        Raises:
+            ValueError: The weights would exceed MAX_WEIGHT_BYTES.
+        """
+        check_weight_bytes(len(self.labelindex) + 1, self.weights.shape[1],
+                           self.weights.dtype)
+        index = len(self.labelindex) + 1
+        self.labelindex[label] = index
+        self.labelindex_rev[index] = label
+        self.weights = numpy.vstack(
+            [self.weights,
+             numpy.zeros((1, self.weights.shape[1]), self.weights.dtype)])
+
+    def update(self, featuresets):
+        """Update the model with labelled featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+
+        Raises:
+            ValueError: A new label would take the weights beyond
+                MAX_WEIGHT_BYTES.
+        """
+        for _, label in featuresets:
+            if label not in self.labelindex:
+                self._add_label(label)
+        if not self.labelindex:
+            return
+        matrix, labels = LinearClassifier._design_matrix(
+            self.featureindex, self.labelindex, featuresets, 1)
+        indptr, indices, data = matrix.indptr, matrix.indices, matrix.data
+        weights = self.weights
+        for i in xrange(matrix.shape[0]):
+            idx = indices[indptr[i]:indptr[i + 1]]
+            val = data[indptr[i]:indptr[i + 1]]
+            correct = int(labels[i]) - 1
+            if len(weights) == 1:
+                # Until a second label is seen, learn the first against
+                # an implicit label whose scores are always 0, so early
+                # updates are not lost.
+                loss = 1 - weights[correct, idx].dot(val)
+                if loss > 0:
+                    tau = min(self.C, loss / val.dot(val))
+                    weights[correct, idx] += tau * val
+                continue
+            scores = weights[:, idx].dot(val)
+            scores[correct] = -numpy.inf
+            wrong = numpy.argmax(scores)
+            loss = 1 - weights[correct, idx].dot(val) + scores[wrong]
+            if loss > 0:
+                tau = min(self.C, loss / (2 * val.dot(val)))
+                weights[correct, idx] += tau * val
+                weights[wrong, idx] -= tau * val
+
+    def discard_labels(self, labels):
+        """Stop predicting the given labels, e.g. expunged notebooks.
+
+        Args:
+            labels: Iterable of labels. Unknown labels are ignored.
+        """
+        discard = set(labels)
+        keep = [self.labelindex_rev[i] for i in sorted(self.labelindex_rev)
+                if self.labelindex_rev[i] not in discard]
+        rows = [self.labelindex[label] - 1 for label in keep]
+        self.weights = self.weights[rows]
+        self.labelindex = dict(zip(keep, range(1, len(keep) + 1)))
+        self.labelindex_rev = dict((v, k)
+                                   for k, v in self.labelindex.iteritems())
+
+    def classify(self, featuresets):
+        """Classify a list of featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+
+        Returns:
+            List of labels, one per featureset. The labels are None if no
+            label is known, e.g. before the first update.
+        """
+        if not self.labelindex:
+            return [None] * len(featuresets)
+        if not featuresets:
+            return []
+        matrix, _ = LinearClassifier._design_matrix(
+            self.featureindex, {}, featuresets, 1)
+        scores = matrix.dot(self.weights.T)
+        return [self.labelindex_rev[int(i) + 1]
+                for i in numpy.argmax(scores, axis=1)]
+
+    @classmethod
+    def train(cls, featuresets, hash_dim=2 ** 18, C=1.0, epochs=5):
+        """Train a classifier from scratch using the given featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+            hash_dim: Number of hashed feature dimensions.
+            C: Aggressiveness parameter.
+            epochs: Number of passes over the featuresets.
+
+        Returns:
+            OnlineClassifier object.
+        """
+        classifier = cls(hash_dim, C)
+        for _ in range(epochs):
+            classifier.update(featuresets)
+        return classifier
+
+    def save(self, path):
+        """Checkpoint the classifier.
+
+        The checkpoint is written to a temporary file and renamed into
+        place, so an interrupted save leaves the previous checkpoint intact.
+
+        Args:
+            path: Checkpoint file path.
+
+        Raises:
+            IOError: File access error.
+        """
+        labels = [self.labelindex_rev[i] for i in sorted(self.labelindex_rev)]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as handle:
+            numpy.savez(handle, weights=self.weights,
+                        hash_dim=self.featureindex.dim, C=self.C,
+                        labels=json.dumps(labels))
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Load a checkpoint written by save.
+
+        Args:
+            path: Checkpoint file path.
+
+        Returns:
+            OnlineClassifier object.
+
+        Raises:
+            IOError: File access error.
+        """
+        with open(path, "rb") as handle:
+            data = numpy.load(handle)
+            classifier = cls(int(data["hash_dim"]), float(data["C"]))
+            classifier.weights = data["weights"]
+            labels = json.loads(str(data["labels"]))
+        classifier.labelindex = dict(zip(labels, range(1, len(labels) + 1)))
+        classifier.labelindex_rev = dict(
+            (v, k) for k, v in classifier.labelindex.iteritems())
+        return classifier
@@ -0,0 +1,525 @@
+"""Metadata stores for ENCache.
+
+A metadata store holds the EDAM Note and Notebook objects and the last
+update count for a single user. ENCache drives a store through a small set
+of methods, so the persistence strategy can be swapped without changing the
+sync logic:
+
+    has_note(guid), has_notebook(guid): Membership tests.
+    get_note(guid): The Note with the given GUID, or None.
+    put_note(note), put_notebook(notebook): Add or replace an object. A
+        replaced object moves to the end of the USN ordering.
+    expunge_note(guid), expunge_notebook(guid): Remove an object, if present.
+    end_chunk(high_usn): Mark the end of one sync chunk.
+    flush(): Make everything up to the last chunk durable.
+    notes(), notebooks(): Objects ordered by ascending USN.
+    notes_in_notebook(guid): Notes in the given notebook, by ascending USN.
+    notes_updated_since(timestamp): Notes with an updated time (in
+        milliseconds since the epoch) greater than or equal to timestamp, by
+        ascending USN.
+    close(): Release any resources.
+    last_update_count: The last USN recorded by end_chunk.
+
+Stores are constructed with the path to the user's cache directory.
+"""
+
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import zlib
+import logging
+from collections import OrderedDict
+
+
+class MemoryStore(object):
+    """A metadata store that keeps everything in memory and persists nothing.
+
+    This is also the base class for the file-backed stores, which keep the
+    same in-memory OrderedDicts and add persistence on top.
+
+    Attributes:
+        note_data: OrderedDict mapping Note GUIDs to Notes.
+        notebook_data: OrderedDict mapping Notebook GUIDs to Notebooks.
+        last_update_count: The last USN recorded by end_chunk.
+    """
+
+    def __init__(self, cache_path=None):
+        """Create an empty store.
+
+        Args:
+            cache_path: Ignored.
+        """
+        self.note_data = OrderedDict()
+        self.notebook_data = OrderedDict()
+        self.last_update_count = 0
+        self.logger = logging.getLogger("ENCache")
+
+    def has_note(self, guid):
+        """Check whether a note is in the store."""
+        return guid in self.note_data
+
+    def has_notebook(self, guid):
+        """Check whether a notebook is in the store."""
+        return guid in self.notebook_data
+
+    def get_note(self, guid):
+        """Get a note by GUID, or None if it is not in the store."""
+        return self.note_data.get(guid)
+
+    def put_note(self, note):
+        """Add or replace a note."""
+        self.note_data.pop(note.guid, None)
+        self.note_data[note.guid] = note
+
+    def put_notebook(self, notebook):
+        """Add or replace a notebook."""
+        self.notebook_data.pop(notebook.guid, None)
+        self.notebook_data[notebook.guid] = notebook
+
+    def expunge_note(self, guid):
+        """Remove a note, if present."""
+        self.note_data.pop(guid, None)
+
+    def expunge_notebook(self, guid):
+        """Remove a notebook, if present."""
+        self.notebook_data.pop(guid, None)
+
+    def end_chunk(self, high_usn):
+        """Record the end of a sync chunk.
+
+        Args:
+            high_usn: The chunkHighUSN of the chunk.
+        """
+        self.last_update_count = high_usn
+
+    def flush(self):
+        """Persist the store. Does nothing for an in-memory store."""
+        pass
+
+    def notes(self):
+        """Get the list of Notes, ordered by ascending USN."""
+        return self.note_data.values()
+
+    def notebooks(self):
+        """Get the list of Notebooks, ordered by ascending USN."""
+        return self.notebook_data.values()
+
+    def notes_in_notebook(self, guid):
+        """Get the list of Notes in a notebook, ordered by ascending USN."""
+        return [note for note in self.note_data.itervalues()
+                if note.notebookGuid == guid]
+
+    def notes_updated_since(self, timestamp):
+        """Get the list of Notes updated at or after timestamp, ordered by
+        ascending USN."""
+        return [note for note in self.note_data.itervalues()
+                if note.updated >= timestamp]
+
+    def close(self):
+        """Release resources. Does nothing for an in-memory store."""
+        pass
+
+
+class PickleStore(MemoryStore):
+    """The original ENCache store: a single pickled dictionary.
+
+    Data is stored with the filename 'user.dat' and the form:
+
+    { "last_update_count": VALUE,
+      "note_data": OrderedDict([(GUID, NOTE), (GUID, NOTE), ...]),
+      "notebook_data": OrderedDict([(GUID, NOTEBOOK), ...)])
+
+    The whole file is re-written on every flush, so the cost of a sync is
+    proportional to the size of the account rather than the size of the
+    change.
+    """
+
+    USERFILE_NAME = "user.dat"
+
+    def __init__(self, cache_path):
+        """Read the userfile, if there is one.
+
+        Args:
+            cache_path: Path to the cache directory for the user.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        super(PickleStore, self).__init__()
+        self.userfile_path = os.path.join(cache_path, self.USERFILE_NAME)
+        if os.path.exists(self.userfile_path):
+            cdata = pickle.load(open(self.userfile_path))
+            self.note_data = cdata["note_data"]
+            self.notebook_data = cdata["notebook_data"]
+            self.last_update_count = cdata["last_update_count"]
+
+    def flush(self):
+        """Write the userfile to the cache.
+
+        The userfile is written to a temporary file and renamed into place,
+        so a crash part way through leaves the previous userfile intact.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        self.logger.debug("writing to cache")
+        cdata = {"note_data": self.note_data,
+                 "notebook_data": self.notebook_data,
+                 "last_update_count": self.last_update_count}
+        tmp_path = self.userfile_path + ".tmp"
+        with open(tmp_path, "w") as handle:
+            pickle.dump(cdata, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(tmp_path, self.userfile_path)
+
+
+class JournalStore(MemoryStore):
+    """A store that appends per-chunk deltas to a journal.
+
+    State on disk is a snapshot file plus a journal of the changes made
+    since the snapshot was taken:
+
+        user.snap: A pickled dictionary in the same form as PickleStore's
+            userfile.
+        user.log: A sequence of records, one per sync chunk. Each record is
+            a 4-byte big-endian payload length, a 4-byte CRC32 of the
+            payload, and a pickled payload of the form
+            (HIGH_USN, [(OP, ARG), (OP, ARG), ...]).
+
+    end_chunk appends and fsyncs one record, so the I/O cost of a sync is
+    proportional to the number of changed objects. When the journal grows
+    beyond COMPACT_RATIO times the size of the snapshot, flush starts a
+    background thread that writes a new snapshot and drops the records it
+    covers.
+
+    On open, the snapshot is loaded and the journal is replayed. Replay stops
+    at the first short or corrupt record (e.g. one torn by a crash during
+    the write) and the journal is truncated at that point. Records whose USN
+    is not greater than the snapshot's are skipped, so a crash part way
+    through compaction is also safe.
+
+    Attributes:
+        snap_path: Path to the snapshot file.
+        log_path: Path to the journal file.
+    """
+
+    SNAPFILE_NAME = "user.snap"
+    LOGFILE_NAME = "user.log"
+    COMPACT_RATIO = 1.0
+    COMPACT_MIN_BYTES = 1 << 20
+    _HEADER = struct.Struct(">Ii")
+
+    def __init__(self, cache_path):
+        """Load the snapshot and replay the journal.
+
+        Args:
+            cache_path: Path to the cache directory for the user.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        super(JournalStore, self).__init__()
+        self.snap_path = os.path.join(cache_path, self.SNAPFILE_NAME)
+        self.log_path = os.path.join(cache_path, self.LOGFILE_NAME)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._compactor = None
+        self._snap_size = 0
+        if os.path.exists(self.snap_path):
+            with open(self.snap_path, "rb") as handle:
+                cdata = pickle.load(handle)
+            self.note_data = cdata["note_data"]
+            self.notebook_data = cdata["notebook_data"]
+            self.last_update_count = cdata["last_update_count"]
+            self._snap_size = os.path.getsize(self.snap_path)
+        self._replay()
+        self._log = open(self.log_path, "ab")
+
+    def _replay(self):
+        """Apply the journal to the snapshot state, truncating any torn
+        tail."""
+        if not os.path.exists(self.log_path):
+            return
+        good = 0
+        with open(self.log_path, "rb") as handle:
+            while True:
+                header = handle.read(self._HEADER.size)
+                if len(header) < self._HEADER.size:
+                    break
+                length, crc = self._HEADER.unpack(header)
+                payload = handle.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    self.logger.debug("discarding torn journal record")
+                    break
+                high_usn, ops = pickle.loads(payload)
+                if high_usn > self.last_update_count:
+                    for op, arg in ops:
+                        getattr(MemoryStore, op)(self, arg)
+                    self.last_update_count = high_usn
+                good = handle.tell()
+        if good != os.path.getsize(self.log_path):
+            with open(self.log_path, "r+b") as handle:
+                handle.truncate(good)
+
+    def put_note(self, note):
+        """Add or replace a note."""
+        with self._lock:
+            super(JournalStore, self).put_note(note)
+        self._pending.append(("put_note", note))
+
+    def put_notebook(self, notebook):
+        """Add or replace a notebook."""
+        with self._lock:
+            super(JournalStore, self).put_notebook(notebook)
+        self._pending.append(("put_notebook", notebook))
+
+    def expunge_note(self, guid):
+        """Remove a note, if present."""
+        with self._lock:
+            super(JournalStore, self).expunge_note(guid)
+        self._pending.append(("expunge_note", guid))
+
+    def expunge_notebook(self, guid):
+        """Remove a notebook, if present."""
+        with self._lock:
+            super(JournalStore, self).expunge_notebook(guid)
+        self._pending.append(("expunge_notebook", guid))
+
+    def end_chunk(self, high_usn):
+        """Append the changes made since the last chunk to the journal.
+
+        Args:
+            high_usn: The chunkHighUSN of the chunk.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        payload = pickle.dumps((high_usn, self._pending),
+                               pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._log.write(self._HEADER.pack(len(payload),
+                                              zlib.crc32(payload)))
+            self._log.write(payload)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self.last_update_count = high_usn
+        self._pending = []
+
+    def flush(self):
+        """Start a background compaction if the journal has grown large.
+
+        The journal is already durable after each end_chunk.
+        """
+        log_size = os.path.getsize(self.log_path)
+        if (log_size > self.COMPACT_MIN_BYTES and
+                log_size > self.COMPACT_RATIO * self._snap_size and
+                self._compactor is None):
+            self._compactor = threading.Thread(target=self._compact_bg)
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def compact(self):
+        """Write a new snapshot and drop the journal records it covers.
+
+        Raises:
+            IOError: Cache access error.
+        """
+        self.logger.debug("compacting journal")
+        with self._lock:
+            cdata = {"note_data": OrderedDict(self.note_data),
+                     "notebook_data": OrderedDict(self.notebook_data),
+                     "last_update_count": self.last_update_count}
+            offset = self._log.tell()
+        tmp_path = self.snap_path + ".tmp"
+        with open(tmp_path, "wb") as handle:
+            pickle.dump(cdata, handle, pickle.HIGHEST_PROTOCOL)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(tmp_path, self.snap_path)
+        self._snap_size = os.path.getsize(self.snap_path)
+        with self._lock:
+            # Carry over any records appended while the snapshot was being
+            # written.
+            tmp_path = self.log_path + ".tmp"
+            with open(self.log_path, "rb") as src:
+                src.seek(offset)
+                tail = src.read()
+            with open(tmp_path, "wb") as handle:
+                handle.write(tail)
+                handle.flush()
+                os.fsync(handle.fileno())
+            self._log.close()
+            os.rename(tmp_path, self.log_path)
+            self._log = open(self.log_path, "ab")
+
+    def _compact_bg(self):
+        """Run compact on the background thread started by flush."""
+        try:
+            self.compact()
+        except (IOError, OSError):
+            self.logger.exception("journal compaction failed")
+        finally:
+            self._compactor = None
+
+    def close(self):
+        """Wait for any compaction to finish and close the journal."""
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        self._log.close()
+
+
+class _NoteSequence(object):
+    """A lazily loaded, read-only sequence of Notes from a SqliteStore query.
+
+    Notes are unpickled one at a time as the sequence is iterated, so only
+    the Notes the caller is holding on to are resident in memory.
+    """
+
+    def __init__(self, conn, where="", args=()):
+        self._conn = conn
+        self._where = where
+        self._args = args
+
+    def __len__(self):
+        query = "SELECT COUNT(*) FROM notes %s" % self._where
+        return self._conn.execute(query, self._args).fetchone()[0]
+
+    def __iter__(self):
+        query = "SELECT data FROM notes %s ORDER BY usn" % self._where
+        for (data,) in self._conn.execute(query, self._args):
+            yield pickle.loads(str(data))
+
+
+class SqliteStore(object):
+    """A store backed by an SQLite database.
+
+    Notes and Notebooks are stored pickled, one per row, alongside indexed
+    columns for the GUID, notebook GUID, USN and updated time. Nothing is
+    read at open time except the last update count, and notes() returns a
+    lazily loaded sequence, so start-up time and resident memory do not
+    grow with the number of notes. Indexed queries such as
+    notes_in_notebook and notes_updated_since only read matching rows.
+
+    Each sync chunk is committed as one transaction by end_chunk.
+
+    Attributes:
+        db_path: Path to the database file.
+        last_update_count: The last USN recorded by end_chunk.
+    """
+
+    DBFILE_NAME = "user.db"
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY, value INTEGER);
+        CREATE TABLE IF NOT EXISTS notes (
+            guid TEXT PRIMARY KEY, notebook_guid TEXT, usn INTEGER,
+            updated INTEGER, data BLOB);
+        CREATE INDEX IF NOT EXISTS notes_notebook ON notes (notebook_guid);
+        CREATE INDEX IF NOT EXISTS notes_usn ON notes (usn);
+        CREATE INDEX IF NOT EXISTS notes_updated ON notes (updated);
+        CREATE TABLE IF NOT EXISTS notebooks (
+            guid TEXT PRIMARY KEY, usn INTEGER, data BLOB);
+        CREATE INDEX IF NOT EXISTS notebooks_usn ON notebooks (usn);
+    """
+
+    def __init__(self, cache_path):
+        """Open, and if necessary create, the database.
+
+        Args:
+            cache_path: Path to the cache directory for the user.
+
+        Raises:
+            sqlite3.Error: Database access error.
+        """
+        self.db_path = os.path.join(cache_path, self.DBFILE_NAME)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.executescript(self._SCHEMA)
+        row = self.conn.execute("SELECT value FROM meta "
+                                "WHERE key = 'last_update_count'").fetchone()
+        self.last_update_count = row[0] if row else 0
+        self.logger = logging.getLogger("ENCache")
+
+    def has_note(self, guid):
+        """Check whether a note is in the store."""
+        return self.conn.execute("SELECT 1 FROM notes WHERE guid = ?",
+                                 (guid,)).fetchone() is not None
+
+    def has_notebook(self, guid):
+        """Check whether a notebook is in the store."""
+        return self.conn.execute("SELECT 1 FROM notebooks WHERE guid = ?",
+                                 (guid,)).fetchone() is not None
+
+    def get_note(self, guid):
+        """Get a note by GUID, or None if it is not in the store."""
+        row = self.conn.execute("SELECT data FROM notes WHERE guid = ?",
+                                (guid,)).fetchone()
+        return pickle.loads(str(row[0])) if row else None
+
+    def put_note(self, note):
+        """Add or replace a note."""
+        data = pickle.dumps(note, pickle.HIGHEST_PROTOCOL)
+        self.conn.execute("INSERT OR REPLACE INTO notes "
+                          "VALUES (?, ?, ?, ?, ?)",
+                          (note.guid, note.notebookGuid,
+                           note.updateSequenceNum, note.updated,
+                           sqlite3.Binary(data)))
+
+    def put_notebook(self, notebook):
+        """Add or replace a notebook."""
+        data = pickle.dumps(notebook, pickle.HIGHEST_PROTOCOL)
+        self.conn.execute("INSERT OR REPLACE INTO notebooks VALUES (?, ?, ?)",
+                          (notebook.guid, notebook.updateSequenceNum,
+                           sqlite3.Binary(data)))
+
+    def expunge_note(self, guid):
+        """Remove a note, if present."""
+        self.conn.execute("DELETE FROM notes WHERE guid = ?", (guid,))
+
+    def expunge_notebook(self, guid):
+        """Remove a notebook, if present."""
+        self.conn.execute("DELETE FROM notebooks WHERE guid = ?", (guid,))
+
+    def end_chunk(self, high_usn):
+        """Commit the changes made since the last chunk.
+
+        Args:
+            high_usn: The chunkHighUSN of the chunk.
+
+        Raises:
+            sqlite3.Error: Database access error.
+        """
+        self.conn.execute("INSERT OR REPLACE INTO meta "
+                          "VALUES ('last_update_count', ?)", (high_usn,))
+        self.conn.commit()
+        self.last_update_count = high_usn
+
+    def flush(self):
+        """Does nothing; each chunk is committed by end_chunk."""
+        pass
+
+    def notes(self):
+        """Get a lazily loaded sequence of Notes, ordered by ascending USN."""
+        return _NoteSequence(self.conn)
+
+    def notebooks(self):
+        """Get the list of Notebooks, ordered by ascending USN."""
+        return [pickle.loads(str(data)) for (data,) in self.conn.execute(
+            "SELECT data FROM notebooks ORDER BY usn")]
+
+    def notes_in_notebook(self, guid):
+        """Get a lazily loaded sequence of the Notes in a notebook, ordered
+        by ascending USN."""
+        return _NoteSequence(self.conn, "WHERE notebook_guid = ?", (guid,))
+
+    def notes_updated_since(self, timestamp):
+        """Get a lazily loaded sequence of the Notes updated at or after
+        timestamp, ordered by ascending USN."""
+        return _NoteSequence(self.conn, "WHERE updated >= ?", (timestamp,))
+
+    def close(self):
+        """Close the database."""
+        self.conn.close()
@@ -0,0 +1,202 @@
+"""Lightweight process-wide metrics: counters, timers and histograms.
+
+Metrics are disabled by default, and every recording function then returns
+immediately, so instrumented code pays one function call and one global
+lookup. Call enable to start recording, and snapshot, to_json or
+to_prometheus to export what has been recorded.
+
+Metric names follow Prometheus conventions, e.g. "encache_fetch_seconds" or
+"encache_content_hits_total". Metrics recorded in worker processes, e.g. by
+features.extract_batch with processes > 1, stay in those processes.
+"""
+
+import json
+import threading
+import time
+
+# Histogram bucket upper bounds for durations in seconds and for sizes.
+TIME_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+SIZE_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+
+enabled = False
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+class _Histogram(object):
+    """Distribution of observed values over fixed buckets."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        """Get (upper bound, cumulative count) pairs, ending with +Inf."""
+        pairs = []
+        total = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            total += count
+            pairs.append((bound, total))
+        pairs.append((float("inf"), self.count))
+        return pairs
+
+
+class _Timer(object):
+    """Context manager that observes its duration in a histogram."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        observe(self.name, time.time() - self.start)
+
+
+class _NullTimer(object):
+    """Context manager that does nothing, used while disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+def enable():
+    """Start recording metrics."""
+    global enabled
+    enabled = True
+
+
+def disable():
+    """Stop recording metrics. Recorded values are kept."""
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Discard all recorded values."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def increment(name, value=1):
+    """Add to a counter.
+
+    Args:
+        name: Counter name.
+        value: Amount to add.
+    """
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value, buckets=TIME_BUCKETS):
+    """Record a value in a histogram.
+
+    Args:
+        name: Histogram name.
+        value: The value.
+        buckets: Bucket upper bounds, used when the histogram is created by
+            this call.
+    """
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = _Histogram(buckets)
+        histogram.observe(value)
+
+
+def timer(name):
+    """Get a context manager that records its duration in a histogram.
+
+    Args:
+        name: Histogram name. Durations are in seconds.
+
+    Returns:
+        Context manager.
+    """
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def snapshot():
+    """Get the recorded values.
+
+    Returns:
+        Dictionary with the keys "counters", mapping counter names to
+        values, and "histograms", mapping histogram names to dictionaries
+        with the keys "count", "sum", "min", "max" and "buckets", a list of
+        [upper bound, cumulative count] pairs excluding +Inf.
+    """
+    with _lock:
+        histograms = {}
+        for name, histogram in _histograms.iteritems():
+            histograms[name] = {
+                "count": histogram.count, "sum": histogram.sum,
+                "min": histogram.min, "max": histogram.max,
+                "buckets": [list(pair) for pair in histogram.cumulative()
+                            if pair[0] != float("inf")]}
+        return {"counters": dict(_counters), "histograms": histograms}
+
+
+def to_json():
+    """Export the recorded values as a JSON string, see snapshot."""
+    return json.dumps(snapshot(), indent=2, sort_keys=True)
+
+
+def _format_value(value):
+    """Format a number as a Prometheus sample value."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def to_prometheus():
+    """Export the recorded values in the Prometheus text format.
+
+    Returns:
+        A string.
+    """
+    lines = []
+    with _lock:
+        for name in sorted(_counters):
+            lines.append("# TYPE %s counter" % name)
+            lines.append("%s %s" % (name, _format_value(_counters[name])))
+        for name in sorted(_histograms):
+            histogram = _histograms[name]
+            lines.append("# TYPE %s histogram" % name)
+            for bound, count in histogram.cumulative():
+                lines.append('%s_bucket{le="%s"} %d' %
+                             (name, _format_value(bound), count))
+            lines.append("%s_sum %s" % (name, _format_value(histogram.sum)))
+            lines.append("%s_count %d" % (name, histogram.count))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,186 @@
+"""Feature selection for featuresets.
+
+Scores each feature by how well its presence separates the notes of one
+label from the rest, and keeps the best. Scorers follow the two-class
+notation of Forman (2003), "An Extensive Empirical Study of Feature
+Selection Metrics for Text Classification", where for a feature and a
+label:
+
+    tp: Number of featuresets with the label that contain the feature.
+    fp: Number of featuresets without the label that contain the feature.
+    pos: Number of featuresets with the label.
+    neg: Number of featuresets without the label.
+
+For more than two labels, a feature's score is its best score over all
+labels, treating each label in turn as the positive class.
+"""
+
+import math
+
+
+def chi2(tp, fp, pos, neg):
+    """Chi-squared statistic of the feature/label contingency table."""
+    fn = pos - tp
+    tn = neg - fp
+    denom = (tp + fp) * (fn + tn) * (tp + fn) * (fp + tn)
+    if not denom:
+        return 0.0
+    return (pos + neg) * float(tp * tn - fp * fn) ** 2 / denom
+
+
+def _entropy(x, y):
+    """Entropy in bits of a two-way split of x + y items."""
+    total = float(x + y)
+    result = 0.0
+    for count in (x, y):
+        if count:
+            result -= count / total * math.log(count / total, 2)
+    return result
+
+
+def information_gain(tp, fp, pos, neg):
+    """Information gain about the label from the feature's presence."""
+    total = float(pos + neg)
+    fn = pos - tp
+    tn = neg - fp
+    present = (tp + fp) / total
+    return (_entropy(pos, neg) - present * _entropy(tp, fp) -
+            (1 - present) * _entropy(fn, tn))
+
+
+def _norm_ppf(p):
+    """Inverse of the standard normal CDF.
+
+    Uses Acklam's rational approximation, which has a relative error below
+    1.15e-9 over the open interval (0, 1).
+    """
+    a = (-3.969683028665376e+01, 2.209460984245205e+02,
+         -2.759285104469687e+02, 1.383577518672690e+02,
+         -3.066479806614716e+01, 2.506628277459239e+00)
+    b = (-5.447609879822406e+01, 1.615858368580409e+02,
+         -1.556989798598866e+02, 6.680131188771972e+01,
+         -1.328068155288572e+01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01,
+         -2.400758277161838e+00, -2.549732539343734e+00,
+         4.374664141464968e+00, 2.938163982698783e+00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01,
+         2.445134137142996e+00, 3.754408661907416e+00)
+    if p < 0.02425:
+        q = math.sqrt(-2 * math.log(p))
+        return ((((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) *
+                 q + c[5]) /
+                ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1))
+    if p > 1 - 0.02425:
+        return -_norm_ppf(1 - p)
+    q = p - 0.5
+    r = q * q
+    return ((((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r +
+             a[5]) * q /
+            (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1))
+
+
+def bns(tp, fp, pos, neg):
+    """Bi-Normal Separation: |F^-1(tpr) - F^-1(fpr)| for the normal CDF F.
+
+    Rates are clipped to [0.0005, 0.9995] to keep the inverse CDF finite.
+    """
+    tpr = min(max(float(tp) / pos, 0.0005), 0.9995) if pos else 0.0005
+    fpr = min(max(float(fp) / neg, 0.0005), 0.9995) if neg else 0.0005
+    return abs(_norm_ppf(tpr) - _norm_ppf(fpr))
+
+
+def document_frequency(tp, fp, pos, neg):
+    """Number of featuresets containing the feature."""
+    return tp + fp
+
+
+SCORERS = {"chi2": chi2,
+           "ig": information_gain,
+           "bns": bns,
+           "df": document_frequency}
+
+
+class FeatureSelector(object):
+    """Selects the most discriminative features of a set of featuresets.
+
+    Features are scored with one of the functions in SCORERS, then either
+    the k best are kept, or those scoring at least threshold, or both.
+    Features are treated as binary: a feature is present in a featureset if
+    its value is non-zero.
+
+    Attributes:
+        scorer: Scoring function.
+        k: Maximum number of features to keep, or None.
+        threshold: Minimum score to keep, or None.
+    """
+
+    def __init__(self, scorer="chi2", k=None, threshold=None):
+        """Set the selection policy.
+
+        Args:
+            scorer: Name of a function in SCORERS, or a function with the
+                same signature.
+            k: Maximum number of features to keep, or None for no limit.
+            threshold: Minimum score to keep, or None for no minimum.
+
+        Raises:
+            KeyError: Unknown scorer name.
+        """
+        if isinstance(scorer, basestring):
+            scorer = SCORERS[scorer]
+        self.scorer = scorer
+        self.k = k
+        self.threshold = threshold
+
+    def scores(self, featuresets):
+        """Score every feature in the featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+
+        Returns:
+            Dictionary mapping feature names to scores.
+        """
+        label_counts = {}
+        feature_counts = {}
+        for featuredict, label in featuresets:
+            label_counts[label] = label_counts.get(label, 0) + 1
+            for ftr, ftrval in featuredict.iteritems():
+                if ftrval:
+                    counts = feature_counts.setdefault(ftr, {})
+                    counts[label] = counts.get(label, 0) + 1
+        total = sum(label_counts.itervalues())
+        labels = label_counts.keys()
+        scorer = self.scorer
+        scores = {}
+        for ftr, counts in feature_counts.iteritems():
+            present = sum(counts.itervalues())
+            best = None
+            for label in labels:
+                pos = label_counts[label]
+                tp = counts.get(label, 0)
+                score = scorer(tp, present - tp, pos, total - pos)
+                if best is None or score > best:
+                    best = score
+            scores[ftr] = best
+        return scores
+
+    def select(self, featuresets):
+        """Select features from the featuresets.
+
+        Args:
+            featuresets: List of featuresets.
+
+        Returns:
+            Set of selected feature names.
+        """
+        scores = self.scores(featuresets)
+        ranked = scores.items()
+        if self.threshold is not None:
+            ranked = [(ftr, score) for ftr, score in ranked
+                      if score >= self.threshold]
+        if self.k is not None and len(ranked) > self.k:
+            # Break ties by name so the selection is deterministic.
+            ranked.sort(key=lambda item: (-item[1], item[0]))
+            ranked = ranked[:self.k]
+        return set(ftr for ftr, score in ranked)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""Local HTTP prediction service for a saved classifier."""
+
+import argparse
+import json
+import logging
+from StringIO import StringIO
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from evernote.edam.type.ttypes import Note, NoteAttributes
+from classifier import SvmClassifier
+import features
+import metrics
+
+NOTE_ATTRIBUTES = ("sourceURL", "latitude", "source", "placeName",
+                   "contentClass")
+
+
+def note_from_json(obj):
+    """Build a Note and its content from a JSON note description.
+
+    Args:
+        obj: Dictionary with a "title", optional "content" (ENML) and
+            optional note attributes named as in NOTE_ATTRIBUTES.
+
+    Returns:
+        2-tuple of a Note object and a file-like object containing the
+        content.
+    """
+    attributes = NoteAttributes()
+    for name in NOTE_ATTRIBUTES:
+        value = obj.get(name)
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        setattr(attributes, name, value)
+    note = Note(title=obj.get("title", u"").encode("utf-8"),
+                attributes=attributes)
+    content = StringIO(obj.get("content", u"<en-note/>").encode("utf-8"))
+    return note, content
+
+
+class PredictHandler(BaseHTTPRequestHandler):
+    """Answers classification requests.
+
+    POST /classify accepts a JSON object with either of the keys:
+
+        featuredicts: A list of featuredicts.
+        notes: A list of note descriptions, see note_from_json.
+
+    and responds with {"labels": [LABEL, LABEL, ...]}, one per input. If
+    the object also has the key "k", the response instead holds the top k
+    labels and their scores for each input, as given by classify_proba:
+
+        {"ranked": [[[LABEL, SCORE], ...], ...]}
+
+    GET /health responds with {"status": "ok", "labels": N}.
+
+    GET /metrics responds with the metrics recorded so far, in the
+    Prometheus text format.
+    """
+
+    def _respond(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = metrics.to_prometheus()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != "/health":
+            self._respond(404, {"error": "not found"})
+            return
+        self._respond(200, {"status": "ok",
+                            "labels": len(self.server.classifier.labelindex)})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self._respond(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.getheader("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if "featuredicts" in request:
+                featuredicts = request["featuredicts"]
+            else:
+                featuredicts = [features.note_featuredict(*note_from_json(obj))
+                                for obj in request["notes"]]
+            k = request.get("k")
+            if k is not None and (not isinstance(k, int) or k < 1):
+                raise ValueError("k must be a positive integer")
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            self._respond(400, {"error": str(exc)})
+            return
+        metrics.increment("server_requests_total")
+        featuresets = [(featuredict, None) for featuredict in featuredicts]
+        with metrics.timer("server_classify_seconds"):
+            if k is None:
+                response = {"labels":
+                            self.server.classifier.classify(featuresets)}
+            else:
+                response = {"ranked": self.server.classifier.classify_proba(
+                    featuresets, k)}
+        self._respond(200, response)
+
+    def log_message(self, format, *args):
+        logging.getLogger("server").debug(format, *args)
+
+
+class PredictServer(HTTPServer):
+    """HTTP server holding a classifier loaded once at start-up.
+
+    Attributes:
+        classifier: Object with a classify method, e.g. SvmClassifier.
+    """
+
+    def __init__(self, classifier, port=8470, host="127.0.0.1"):
+        """Bind the server.
+
+        Args:
+            classifier: Object with a classify method.
+            port: TCP port. Use 0 to pick a free port.
+            host: Interface to bind. Defaults to localhost only.
+
+        Raises:
+            socket.error: The address could not be bound.
+        """
+        HTTPServer.__init__(self, (host, port), PredictHandler)
+        self.classifier = classifier
+
+
+def run_cli():
+    """Process a command line execution."""
+    parser = argparse.ArgumentParser(description="Notebook classification \
+prediction service")
+    parser.add_argument("model", help="directory of a saved SvmClassifier")
+    parser.add_argument("-p", help="port (default: 8470)", type=int,
+                        default=8470)
+    args = parser.parse_args()
+    metrics.enable()
+    server = PredictServer(SvmClassifier.load(args.model, mmap=True),
+                           args.p)
+    print "serving on http://%s:%d/" % server.server_address
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    run_cli()
@@ -0,0 +1,119 @@
+import unittest
+import os
+import random
+import tempfile
+import shutil
+import benchmark
+
+
+class TestSyntheticAccount(unittest.TestCase):
+
+    def setUp(self):
+        self.account = benchmark.SyntheticAccount(notes=300, notebooks=3,
+                                                  words=20)
+        self.testdir = tempfile.mkdtemp()
+
+    def test_reproducible(self):
+        other = benchmark.SyntheticAccount(notes=300, notebooks=3, words=20)
+        self.assertEqual(other.notes, self.account.notes)
+        self.assertEqual(other.content("n7"), self.account.content("n7"))
+        self.assertNotEqual(self.account.content("n7"),
+                            self.account.content("n8"))
+
+    def test_cjk(self):
+        account = benchmark.SyntheticAccount(notes=10, notebooks=2, words=20,
+                                             script="cjk")
+        content = unicode(account.content("n1"), "utf-8")
+        self.assertNotIn(u" ", content[content.index(u"<en-note>"):])
+        self.assertTrue(u"\u4e00" <= content[-20] <= u"\u9fff")
+
+    def test_mixed_zipf(self):
+        account = benchmark.SyntheticAccount(notes=10, notebooks=2, words=200,
+                                             script="mixed", zipf=1.0)
+        content = unicode(account.content("n1"), "utf-8")
+        body = content[content.index(u"<en-note>"):]
+        latin = body.count(u" w")
+        self.assertTrue(0 < latin < 100)
+        words = [account._word(random.Random(i), 0) for i in xrange(1000)]
+        common = max(set(words), key=words.count)
+        self.assertGreater(words.count(common), 20)
+
+    def test_chunks(self):
+        notestore = benchmark.FakeNoteStore(self.account)
+        chunk = notestore.getFilteredSyncChunk("token", 0, 100, None)
+        self.assertEqual(len(chunk.notebooks), 3)
+        self.assertEqual(len(chunk.notes), 97)
+        self.assertEqual(chunk.chunkHighUSN, 100)
+        chunk = notestore.getFilteredSyncChunk("token", 300, 100, None)
+        self.assertEqual(len(chunk.notes), 3)
+        self.assertEqual(chunk.chunkHighUSN, chunk.updateCount)
+        chunk = notestore.getFilteredSyncChunk("token", 303, 100, None)
+        self.assertEqual(chunk.chunkHighUSN, None)
+
+    def test_cache(self):
+        cache = benchmark.SyntheticCache(self.account, self.testdir)
+        changes = cache.sync()
+        self.assertEqual(len(changes.added), 300)
+        self.assertEqual(cache.last_update_count, 303)
+        self.assertEqual(cache.note_content(cache.notes[0]).read(),
+                         self.account.content(cache.notes[0].guid))
+
+    def test_stage_tokenise(self):
+        benchmark.SyntheticCache(self.account, self.testdir).sync()
+        count, seconds, latencies = benchmark._stage_tokenise(self.account,
+                                                              self.testdir)
+        self.assertEqual(count, 300)
+        self.assertEqual(len(latencies), 300)
+
+    def test_find_regressions(self):
+        baseline = {"sync": {"throughput": 100.0, "p95_ms": 10.0,
+                             "peak_rss_mb": 50.0}}
+        results = [("sync", {"throughput": 80.0, "p95_ms": 12.0,
+                             "peak_rss_mb": 70.0}),
+                   ("train", {"throughput": 1.0, "p95_ms": 1.0,
+                              "peak_rss_mb": 1.0})]
+        regressions = benchmark.find_regressions(results, baseline)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("sync: peak_rss_mb"))
+        self.assertEqual(len(benchmark.find_regressions(results, baseline,
+                                                        0.1)), 3)
+
+    def test_stage_crash(self):
+        self.addCleanup(setattr, benchmark, "STAGES", benchmark.STAGES)
+        benchmark.STAGES = [("crash", _crash_stage)]
+        self.assertRaisesRegexp(RuntimeError, "stage crash failed: exited "
+                                "with code 3", benchmark.run_suite,
+                                {"notes": 10}, self.testdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+
+def _crash_stage(account, workdir):
+    os._exit(3)
+
+
+class TestCompareTokenisers(unittest.TestCase):
+
+    def test_compare(self):
+        texts = [u"Hi there, hi THERE $5", u"U.S.A. caf\xe9"]
+        results = benchmark.compare_tokenisers(texts, repeat=2)
+        self.assertEqual([result[0] for result in results],
+                         ["split", "unique"])
+        self.assertEqual([result[3] for result in results], [6, 6])
+
+    def test_enml_text(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            path = testdir + "/note.enml"
+            with open(path, "w") as handle:
+                handle.write("<en-note><div>caf\xc3\xa9</div>"
+                             "<div>au lait</div></en-note>")
+            self.assertEqual(benchmark.enml_text(path).split(),
+                             [u"caf\xe9", u"au", u"lait"])
+        finally:
+            shutil.rmtree(testdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+import numpy
+from calibration import fit_sigmoid, PlattCalibrator, rank_labels
+
+
+class TestCalibration(unittest.TestCase):
+
+    def test_fit_sigmoid(self):
+        random = numpy.random.RandomState(0)
+        scores = random.uniform(-4, 4, 5000)
+        positive = random.uniform(size=5000) < 1 / (1 + numpy.exp(-2 * scores
+                                                                  + 1))
+        a, b = fit_sigmoid(scores, positive)
+        self.assertAlmostEqual(a, -2, delta=0.2)
+        self.assertAlmostEqual(b, 1, delta=0.2)
+
+    def test_fit_separable(self):
+        scores = numpy.array([-2.0, -1.0, 1.0, 2.0])
+        a, b = fit_sigmoid(scores, scores > 0)
+        self.assertTrue(a < 0)
+        self.assertTrue(numpy.isfinite([a, b]).all())
+
+    def test_probabilities(self):
+        calibrator = PlattCalibrator([-1, -2], [0, 0])
+        probs = calibrator.probabilities(numpy.array([[0.0, 0.0],
+                                                      [5.0, -5.0]]))
+        self.assertTrue(numpy.allclose(probs.sum(axis=1), 1))
+        self.assertTrue(numpy.allclose(probs[0], [0.5, 0.5]))
+        self.assertTrue(probs[1, 0] > 0.99)
+
+    def test_fit(self):
+        scores = numpy.array([[1.0, -1.0], [2.0, -2.0], [-1.0, 1.0],
+                              [-2.0, 2.0]])
+        calibrator = PlattCalibrator.fit(scores, [0, 0, 1, 1])
+        probs = calibrator.probabilities(scores)
+        self.assertEqual(probs.argmax(axis=1).tolist(), [0, 0, 1, 1])
+        copy = PlattCalibrator.from_json(calibrator.to_json())
+        self.assertTrue(numpy.allclose(copy.probabilities(scores), probs))
+
+    def test_rank_labels(self):
+        scores = numpy.array([[0.1, 0.7, 0.2], [0.5, 0.2, 0.3]])
+        self.assertEqual(rank_labels(scores, ["a", "b", "c"], 2),
+                         [[("b", 0.7), ("c", 0.2)], [("a", 0.5), ("c", 0.3)]])
+        self.assertEqual(len(rank_labels(scores, ["a", "b", "c"])[0]), 3)
+        self.assertEqual(rank_labels(scores, ["a", "b", "c"], 1)[1],
+                         [("a", 0.5)])
+        self.assertEqual(rank_labels(numpy.zeros((0, 3)), "abc", 2), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,24 @@
 import unittest
 import classifier
+import features
+from calibration import PlattCalibrator
+import tempfile
+import shutil
+import os
+import svmutil
 from mock import Mock
+from vectoriser import FeatureHasher
+from selection import FeatureSelector
+
+
+def svm_args(mock_call):
+    "Get LIBSVM-style labels and vectors from the args of a mock call."
+    labels, matrix = mock_call[0][:2]
+    vectors = []
+    for i in range(matrix.shape[0]):
+        row = matrix.getrow(i)
+        vectors.append(dict(zip(row.indices + 1, row.data)))
+    return list(labels), vectors
 
 
 class TestClassifier(unittest.TestCase):
@@ -18,6 +36,13 @@ class TestClassifier(unittest.TestCase):
         self.assertEqual(self.svm.featureindex, {"f1": 1, "f2": 2})
 
     def test_problem(self):
+        self.assertEqual(svm_args(classifier.svmutil.svm_problem.call_args),
+                         ([1, 2], [{1: 1}, {2: 1}]))
+
+    def test_problem_without_csr(self):
+        del classifier.svmutil.sparse
+        classifier.SvmClassifier.train([({"f1": 1}, "l1"),
+                                        ({"f2": 1}, "l2")], "param")
         classifier.svmutil.svm_problem.assert_called_with([1, 2],
                                                           [{1: 1}, {2: 1}])
 
@@ -28,6 +53,201 @@ class TestClassifier(unittest.TestCase):
         classifier.svmutil.svm_predict.return_value = ([2, 1], None, None)
         self.assertEqual(self.svm.classify([]), ["l2", "l1"])
 
+    def test_decision_function(self):
+        # One-vs-one values for the pair (l2, l1), in model label order.
+        self.svm.model.get_labels.return_value = [2, 1]
+        classifier.svmutil.svm_predict.return_value = (
+            [2, 1], None, [[0.5], [-1.5]])
+        scores = self.svm.decision_function([({}, None), ({}, None)])
+        self.assertEqual(scores.tolist(), [[-0.5, 0.5], [1.5, -1.5]])
+        self.assertEqual(classifier.svmutil.svm_predict.call_args[0][3], "-q")
+        self.assertEqual(self.svm.classify_proba([({}, None), ({}, None)],
+                                                 k=1),
+                         [[("l2", 0.5)], [("l1", 1.5)]])
+
+    def test_pair_matrix(self):
+        self.svm.labelindex = {"a": 1, "b": 2, "c": 3}
+        self.svm.model.get_labels.return_value = [3, 1, 2]
+        pairs = self.svm._pair_matrix()
+        self.assertEqual(pairs.toarray().tolist(),
+                         [[-0.5, 0, 0.5], [0, -0.5, 0.5], [0.5, -0.5, 0]])
+        self.assertEqual(pairs.nnz, 6)
+        self.assertIs(self.svm._pair_matrix(), pairs)
+        self.assertEqual(self.svm.model.get_labels.call_count, 1)
+
+    def test_save_load_calibration(self):
+        self.svm.calibrator = PlattCalibrator([-1, -2], [0.5, 0])
+        testdir = tempfile.mkdtemp()
+        try:
+            self.svm.save(testdir)
+            svm = classifier.SvmClassifier.load(testdir)
+        finally:
+            shutil.rmtree(testdir)
+        self.assertEqual(svm.calibrator.to_json(),
+                         {"a": [-1, -2], "b": [0.5, 0]})
+
+    def test_save_load(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            self.svm.save(testdir)
+            classifier.svmutil.svm_load_model.return_value = "model"
+            svm = classifier.SvmClassifier.load(testdir)
+        finally:
+            shutil.rmtree(testdir)
+        self.assertEqual(svm.featureindex, self.svm.featureindex)
+        self.assertEqual(svm.labelindex, self.svm.labelindex)
+        self.assertEqual(svm.model, "model")
+        self.assertEqual(classifier.svmutil.svm_save_model.call_args[0][1],
+                         self.svm.model)
+
+    def test_load_mmap(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            self.svm.save(testdir)
+            svm = classifier.SvmClassifier.load(testdir, mmap=True)
+            self.assertEqual(dict(svm.featureindex.iteritems()),
+                             self.svm.featureindex)
+        finally:
+            shutil.rmtree(testdir)
+
+    def test_save_load_ids(self):
+        featuresets = [({(features.CONTENT_TOKEN, u"a"): 1}, "l1"),
+                       ({(features.CONTENT_TODO, u""): 1}, "l2")]
+        svm = classifier.SvmClassifier.train(featuresets)
+        testdir = tempfile.mkdtemp()
+        try:
+            svm.save(testdir)
+            loaded = classifier.SvmClassifier.load(testdir)
+        finally:
+            shutil.rmtree(testdir)
+        self.assertEqual(loaded.featureindex, svm.featureindex)
+
+
+class TestOneVsRestClassifier(unittest.TestCase):
+
+    def setUp(self):
+        classifier.svmutil = Mock()
+        classifier.svmutil.svm_train.side_effect = lambda *args: Mock()
+        self.featuresets = [({"f1": 1}, "l1"), ({"f2": 1}, "l2"),
+                            ({"f3": 1}, "l3")]
+        self.svm = classifier.SvmClassifier.train(self.featuresets, "param",
+                                                  one_vs_rest=True)
+
+    def test_binary_problems(self):
+        calls = classifier.svmutil.svm_problem.call_args_list
+        self.assertEqual([svm_args(call)[0] for call in calls],
+                         [[1, -1, -1], [-1, 1, -1], [-1, -1, 1]])
+        self.assertTrue(self.svm.one_vs_rest)
+        self.assertEqual(len(self.svm.model), 3)
+
+    def test_two_labels(self):
+        svm = classifier.SvmClassifier.train(self.featuresets[:2],
+                                             one_vs_rest=True)
+        self.assertFalse(svm.one_vs_rest)
+
+    def test_classify(self):
+        # The second model saw the rest first, so its values are negated.
+        first_labels = [[1, -1], [-1, 1], [1, -1]]
+        for model, labels in zip(self.svm.model, first_labels):
+            model.get_labels.return_value = labels
+        classifier.svmutil.svm_predict.side_effect = [
+            (None, None, [[0.5], [-1]]), (None, None, [[1], [-2]]),
+            (None, None, [[0], [-3]])]
+        scores = self.svm.decision_function([({}, None), ({}, None)])
+        self.assertEqual(scores.tolist(), [[0.5, -1, 0], [-1, 2, -3]])
+        classifier.svmutil.svm_predict.side_effect = [
+            (None, None, [[0.5], [-1]]), (None, None, [[1], [-2]]),
+            (None, None, [[0], [-3]])]
+        self.assertEqual(self.svm.classify([({}, None), ({}, None)]),
+                         ["l1", "l2"])
+
+    def test_save_load(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            self.svm.save(testdir)
+            classifier.svmutil.svm_load_model.side_effect = lambda path: path
+            svm = classifier.SvmClassifier.load(testdir)
+        finally:
+            shutil.rmtree(testdir)
+        self.assertEqual([os.path.basename(path) for path in svm.model],
+                         ["model-1.svm", "model-2.svm", "model-3.svm"])
+
+    def test_processes(self):
+        classifier.svmutil = svmutil
+        featuresets = [({"f%d" % (i % 3): 1, "n%d" % i: 0.5}, "l%d" % (i % 3))
+                       for i in range(30)]
+        serial = classifier.SvmClassifier.train(featuresets,
+                                                one_vs_rest=True)
+        parallel = classifier.SvmClassifier.train(featuresets,
+                                                  one_vs_rest=True,
+                                                  processes=2)
+        self.assertEqual(len(parallel.model), 3)
+        self.assertEqual(parallel.classify(featuresets),
+                         [label for _, label in featuresets])
+        self.assertEqual(parallel.decision_function(featuresets).tolist(),
+                         serial.decision_function(featuresets).tolist())
+        # Compare the collapsed weights with LIBSVM's own predictions.
+        serial._weights = False
+        for row, expected in zip(
+                parallel.decision_function(featuresets).tolist(),
+                serial.decision_function(featuresets).tolist()):
+            for value, expected_value in zip(row, expected):
+                self.assertAlmostEqual(value, expected_value)
+
+
+class TestSelectedClassifier(unittest.TestCase):
+
+    def setUp(self):
+        classifier.svmutil = Mock()
+        selector = FeatureSelector("df", k=2)
+        self.svm = classifier.SvmClassifier.train(
+            [({"f1": 1, "f2": 1}, "l1"), ({"f2": 1, "f3": 1}, "l2"),
+             ({"f1": 1}, "l1")], "param", selector=selector)
+
+    def test_featureindex(self):
+        self.assertEqual(self.svm.featureindex, {"f1": 1, "f2": 2})
+
+    def test_problem(self):
+        self.assertEqual(svm_args(classifier.svmutil.svm_problem.call_args),
+                         ([1, 2, 1], [{1: 1, 2: 1}, {2: 1}, {1: 1}]))
+
+    def test_hashing(self):
+        self.assertRaises(ValueError, classifier.SvmClassifier.train,
+                          [({"f1": 1}, "l1")], hash_dim=2,
+                          selector=FeatureSelector())
+
+
+class TestHashedClassifier(unittest.TestCase):
+
+    def setUp(self):
+        classifier.svmutil = Mock()
+        self.svm = classifier.SvmClassifier.train([({"f1": 1}, "l1"),
+                                                   ({"f2": 1}, "l2")],
+                                                  "param", hash_dim=2 ** 8)
+
+    def test_featureindex(self):
+        self.assertEqual(self.svm.featureindex, FeatureHasher(2 ** 8))
+
+    def test_problem(self):
+        hasher = FeatureHasher(2 ** 8)
+        self.assertEqual(svm_args(classifier.svmutil.svm_problem.call_args),
+                         ([1, 2], [hasher.vector({"f1": 1}),
+                                   hasher.vector({"f2": 1})]))
+
+    def test_save_load(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            self.svm.save(testdir)
+            svm = classifier.SvmClassifier.load(testdir)
+        finally:
+            shutil.rmtree(testdir)
+        self.assertEqual(svm.featureindex, FeatureHasher(2 ** 8))
+
+    def test_classify_unseen(self):
+        classifier.svmutil.svm_predict.return_value = ([2], None, None)
+        self.assertEqual(self.svm.classify([({"f3": 1}, None)]), ["l2"])
+        _, vectors = svm_args(classifier.svmutil.svm_predict.call_args)
+        self.assertEqual(vectors, [FeatureHasher(2 ** 8).vector({"f3": 1})])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+import tempfile
+import shutil
+import os
+import threading
+from contentstore import FileContentStore, ShardedContentStore
+from contentstore import PackedContentStore
+
+
+class ContentStoreTests(object):
+    "Tests shared by every content store."
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.store = self.cls(self.testdir)
+
+    def test_put(self):
+        self.assertFalse(self.store.has("a1"))
+        self.store.put("a1", "<en-note>one</en-note>")
+        self.assertTrue(self.store.has("a1"))
+        self.assertEqual(self.store.open("a1").read(),
+                         "<en-note>one</en-note>")
+
+    def test_replace(self):
+        self.store.put("a1", "one")
+        self.store.put("a1", "two")
+        self.assertEqual(self.store.open("a1").read(), "two")
+
+    def test_delete(self):
+        self.store.put("a1", "one")
+        self.store.delete("a1")
+        self.store.delete("a2")
+        self.assertFalse(self.store.has("a1"))
+        self.assertRaises(IOError, self.store.open, "a1")
+
+    def test_reopen(self):
+        self.store.put("a1", "one")
+        self.store.put("a2", "two")
+        self.store.delete("a1")
+        self.store.flush()
+        self.store.close()
+        self.store = self.cls(self.testdir)
+        self.assertFalse(self.store.has("a1"))
+        self.assertEqual(self.store.open("a2").read(), "two")
+
+    def test_threads(self):
+        def work(i):
+            for j in range(50):
+                self.store.put("a%d-%d" % (i, j), "content %d %d" % (i, j))
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(4):
+            for j in range(50):
+                self.assertEqual(self.store.open("a%d-%d" % (i, j)).read(),
+                                 "content %d %d" % (i, j))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.testdir)
+
+
+class TestFileContentStore(ContentStoreTests, unittest.TestCase):
+    cls = FileContentStore
+
+    def test_layout(self):
+        self.store.put("a1", "one")
+        with open(os.path.join(self.testdir, "a1")) as handle:
+            self.assertEqual(handle.read(), "one")
+
+
+class TestShardedContentStore(ContentStoreTests, unittest.TestCase):
+    cls = ShardedContentStore
+
+    def test_layout(self):
+        content = "<div>hello</div>" * 100
+        self.store.put("ab12", content)
+        path = os.path.join(self.testdir, "content", "ab", "ab12")
+        self.assertTrue(os.path.getsize(path) < len(content) / 10)
+
+
+class TestPackedContentStore(ContentStoreTests, unittest.TestCase):
+    cls = PackedContentStore
+
+    def _segments(self):
+        return sorted(os.listdir(os.path.join(self.testdir, "packed")))
+
+    def test_torn_tail(self):
+        self.store.put("a1", "one")
+        self.store.put("a2", "two")
+        self.store.close()
+        path = os.path.join(self.testdir, "packed", self._segments()[-1])
+        size = os.path.getsize(path)
+        with open(path, "r+b") as handle:
+            handle.truncate(size - 3)
+        self.store = PackedContentStore(self.testdir)
+        self.assertEqual(self.store.open("a1").read(), "one")
+        self.assertFalse(self.store.has("a2"))
+        self.store.put("a3", "three")
+        self.store.close()
+        self.store = PackedContentStore(self.testdir)
+        self.assertEqual(self.store.open("a3").read(), "three")
+
+    def test_corrupt(self):
+        self.store.put("a1", "one")
+        self.store.close()
+        path = os.path.join(self.testdir, "packed", self._segments()[-1])
+        with open(path, "r+b") as handle:
+            handle.seek(-2, os.SEEK_END)
+            handle.write("xx")
+        self.store = PackedContentStore(self.testdir)
+        self.assertRaises(IOError, self.store.open, "a1")
+
+    def test_segments(self):
+        self.store.SEGMENT_BYTES = 100
+        for i in range(20):
+            self.store.put("a%d" % i, os.urandom(50))
+        self.store.put("a0", "zero")
+        self.assertTrue(len(self._segments()) > 5)
+        self.store.close()
+        self.store = PackedContentStore(self.testdir)
+        self.assertEqual(self.store.open("a0").read(), "zero")
+        self.assertEqual(len(self.store.open("a19").read()), 50)
+
+    def test_compact(self):
+        self.store.SEGMENT_BYTES = 100
+        self.store.COMPACT_MIN_BYTES = 0
+        for i in range(20):
+            self.store.put("a%d" % i, "content %d" % i)
+        for i in range(15):
+            self.store.delete("a%d" % i)
+        before = len(self._segments())
+        self.store.flush()
+        self.assertTrue(len(self._segments()) < before)
+        for i in range(15, 20):
+            self.assertEqual(self.store.open("a%d" % i).read(),
+                             "content %d" % i)
+        self.store.close()
+        self.store = PackedContentStore(self.testdir)
+        self.assertFalse(self.store.has("a0"))
+        self.assertEqual(self.store.open("a19").read(), "content 19")
+
+if __name__ == '__main__':
+    unittest.main()
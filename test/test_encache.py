@@ -1,19 +1,25 @@
 import unittest
 import random
 import encache
+import metastore
+import contentstore
+import metrics
 from mock import Mock
 import tempfile
 import os
 import shutil
+from evernote.edam.error.ttypes import EDAMSystemException, EDAMErrorCode
+from evernote.edam.type.ttypes import Data, Resource
 
 
 class Guid(object):
     "Mock object for notes and notebooks."
 
-    def __init__(self, guid, title=None, name=None):
+    def __init__(self, guid, title=None, name=None, resources=None):
         self.guid = guid
         self.title = title
         self.name = name
+        self.resources = resources
 
     def __eq__(self, other):
         return self.guid == other.guid
@@ -22,6 +28,27 @@ class Guid(object):
         return "guid: %s title=%s name=%s" % (self.guid, self.title, self.name)
 
 
+class FakeNoteStore(object):
+    "Local NoteStore that serves content and can simulate rate limiting."
+
+    def __init__(self, rate_limited=()):
+        self.rate_limited = set(rate_limited)
+        self.fetched = []
+
+    def getNoteContent(self, auth_token, guid):
+        if guid in self.rate_limited:
+            self.rate_limited.remove(guid)
+            raise EDAMSystemException(
+                errorCode=EDAMErrorCode.RATE_LIMIT_REACHED,
+                rateLimitDuration=3)
+        self.fetched.append(guid)
+        return "content %s" % guid
+
+    def getResourceSearchText(self, auth_token, guid):
+        return self.getNoteContent(auth_token, guid).replace("content",
+                                                             "text")
+
+
 class TestENCache(unittest.TestCase):
 
     def setUp(self):
@@ -46,6 +73,28 @@ class TestENCache(unittest.TestCase):
         self._sync()
         self.assertEqual(self.cache.last_update_count, 5)
 
+    def test_sync_changes(self):
+        changes = self._sync()
+        self.assertEqual(changes.added, set(["a2"]))
+        self.assertEqual(changes.updated, set())
+        self.assertEqual(changes.expunged, set())
+        self.assertEqual(changes.expunged_notebooks, set())
+        changes = self._sync()
+        self.assertEqual(changes.added, set())
+        self.assertEqual(changes.updated, set(["a2"]))
+        self.assertEqual(changes.expunged, set())
+        self.assertEqual(len(changes), 1)
+
+    def test_sync_changes_expunged(self):
+        self._sync()
+        chunk = Mock(chunkHighUSN=6, updateCount=6, notes=None,
+                     notebooks=None, resources=None, expungedNotes=["a2"],
+                     expungedNotebooks=["b2"])
+        self.cache.notestore.getFilteredSyncChunk.return_value = chunk
+        changes = self.cache.sync()
+        self.assertEqual(changes.expunged, set(["a2"]))
+        self.assertEqual(changes.expunged_notebooks, set(["b2"]))
+
     def test_notes(self):
         self._sync()
         self.assertEqual(self.cache.notes, [Guid("a2", title="c1")])
@@ -59,17 +108,319 @@ class TestENCache(unittest.TestCase):
         newcache = encache.ENCache("token", "host", self.testdir)
         self.assertEqual(newcache.notes, [Guid("a2", title="c1")])
 
+    def test_invalidation_listeners(self):
+        invalidated = []
+        self.cache.invalidation_listeners.append(invalidated.append)
+        self._sync()
+        self.assertEqual(invalidated, ["a1"])
+        self._sync()
+        self.assertEqual(invalidated, ["a1", "a2", "a1"])
+
+    def test_load_from_journal(self):
+        self.cache = encache.ENCache("token", "host", self.testdir,
+                                     store=metastore.JournalStore)
+        self._sync()
+        self.cache.close()
+        newcache = encache.ENCache("token", "host", self.testdir,
+                                   store=metastore.JournalStore)
+        self.assertEqual(newcache.notes, [Guid("a2", title="c1")])
+        self.assertEqual(newcache.last_update_count, 5)
+        newcache.close()
+
+    def test_note_content(self):
+        self.cache.notestore = FakeNoteStore()
+        content = self.cache.note_content(Guid("a1")).read()
+        self.assertEqual(content, "content a1")
+        self.cache.note_content(Guid("a1"))
+        self.assertEqual(self.cache.notestore.fetched, ["a1"])
+
+    def test_prefetch(self):
+        notestores = []
+
+        def new_notestore():
+            notestores.append(FakeNoteStore(rate_limited=["n3"]))
+            return notestores[-1]
+        self.cache.new_notestore = new_notestore
+        self.addCleanup(setattr, encache, "time", encache.time)
+        encache.time = Mock()
+        self.cache.notestore = FakeNoteStore()
+        self.cache.note_content(Guid("n0"))
+        notes = [Guid("n%d" % i) for i in range(10)]
+        self.assertEqual(self.cache.prefetch(notes, workers=3), 9)
+        self.assertEqual(len(notestores), 3)
+        fetched = sum([ns.fetched for ns in notestores], [])
+        self.assertEqual(sorted(fetched), ["n%d" % i for i in range(1, 10)])
+        encache.time.sleep.assert_called_with(3)
+        for note in notes:
+            self.assertEqual(self.cache.note_content(note).read(),
+                             "content %s" % note.guid)
+
+    def test_content_lru(self):
+        self.cache = encache.ENCache("token", "host", self.testdir,
+                                     content_cache_bytes=100)
+        notestore = FakeNoteStore()
+        self.cache.notestore = notestore
+        self.cache.notestore.getFilteredSyncChunk = Mock()
+        self.assertEqual(self.cache.note_content(Guid("a2")).read(),
+                         "content a2")
+        os.unlink(os.path.join(self.cache.cache_path, "a2"))
+        self.assertEqual(self.cache.note_content(Guid("a2")).read(),
+                         "content a2")
+        self.assertEqual(notestore.fetched, ["a2"])
+        self.assertEqual((self.cache.content_lru.hits,
+                          self.cache.content_lru.misses), (1, 1))
+        self._sync()
+        self.assertEqual(len(self.cache.content_lru), 1)
+        self._sync()
+        self.assertEqual(len(self.cache.content_lru), 0)
+        self.cache.note_content(Guid("a2"))
+        self.assertEqual(notestore.fetched, ["a2", "a2"])
+
+    def test_packed_content(self):
+        self.cache = encache.ENCache(
+            "token", "host", self.testdir,
+            content_store=contentstore.PackedContentStore)
+        self.cache.new_notestore = FakeNoteStore
+        self.cache.notestore = FakeNoteStore()
+        self.cache.notestore.getFilteredSyncChunk = Mock()
+        self.cache.prefetch([Guid("a1"), Guid("a2")])
+        self.assertEqual(self.cache.note_content(Guid("a2")).read(),
+                         "content a2")
+        self._sync()
+        self.assertFalse(self.cache.content_store.has("a1"))
+        self.assertTrue(self.cache.content_store.has("a2"))
+        self.cache.close()
+
+    def test_content_metrics(self):
+        metrics.reset()
+        metrics.enable()
+        try:
+            self.cache.notestore = FakeNoteStore()
+            self.cache.note_content(Guid("n0"))
+            self.cache.note_content(Guid("n0"))
+            snapshot = metrics.snapshot()
+        finally:
+            metrics.disable()
+            metrics.reset()
+        self.assertEqual(snapshot["counters"],
+                         {"encache_content_hits_total": 1,
+                          "encache_content_misses_total": 1,
+                          "encache_fetched_bytes_total": 10})
+        self.assertEqual(
+            snapshot["histograms"]["encache_fetch_seconds"]["count"], 1)
+
+    def test_prefetch_error(self):
+        notestore = Mock()
+        notestore.getNoteContent.side_effect = EDAMSystemException(
+            errorCode=EDAMErrorCode.INTERNAL_ERROR)
+        self.cache.new_notestore = lambda: notestore
+        self.assertRaises(EDAMSystemException, self.cache.prefetch,
+                          [Guid("n1")])
+
+    def _resource_note(self, usn=1):
+        return Guid("a2", resources=[
+            Resource(guid="r1", noteGuid="a2", updateSequenceNum=usn,
+                     mime="image/png", recognition=Data(size=1)),
+            Resource(guid="r2", noteGuid="a2", updateSequenceNum=usn,
+                     mime="application/pdf"),
+            Resource(guid="r3", noteGuid="a2", updateSequenceNum=usn,
+                     mime="audio/wav")])
+
+    def test_resource_text(self):
+        self.cache.notestore = FakeNoteStore()
+        note = self._resource_note()
+        self.assertEqual(self.cache.resource_text(note), u"text r1\ntext r2")
+        self.assertEqual(self.cache.resource_text(note), u"text r1\ntext r2")
+        self.assertEqual(self.cache.notestore.fetched, ["r1", "r2"])
+        self.cache.resource_text(self._resource_note(usn=2))
+        self.assertEqual(self.cache.notestore.fetched,
+                         ["r1", "r2", "r1", "r2"])
+        self.assertEqual(self.cache.resource_text(Guid("a1")), u"")
+
+    def test_prefetch_resources(self):
+        notestores = []
+
+        def new_notestore():
+            notestores.append(FakeNoteStore())
+            return notestores[-1]
+        self.cache.new_notestore = new_notestore
+        self.cache.notestore = FakeNoteStore()
+        notes = [Guid("a1"), self._resource_note()]
+        self.assertEqual(self.cache.prefetch(notes), 2)
+        self.assertEqual(self.cache.prefetch(notes, workers=2,
+                                             resources=True), 2)
+        fetched = sum([ns.fetched for ns in notestores], [])
+        self.assertEqual(sorted(fetched), ["a1", "a2", "r1", "r2"])
+        self.assertEqual(self.cache.prefetch(notes, resources=True), 0)
+        self.cache.resource_text(notes[1])
+        self.assertEqual(self.cache.notestore.fetched, [])
+
+    def test_sync_resources(self):
+        invalidated = []
+        self.cache.invalidation_listeners.append(invalidated.append)
+        self.cache.notestore = FakeNoteStore()
+        self.cache.notestore.getFilteredSyncChunk = Mock()
+        self._sync()
+        note = self._resource_note()
+        self.cache.resource_text(note)
+        chunk = Mock(chunkHighUSN=6, updateCount=6, notes=None,
+                     notebooks=None, resources=note.resources[:1],
+                     expungedNotes=None, expungedNotebooks=None)
+        self.cache.notestore.getFilteredSyncChunk.return_value = chunk
+        del invalidated[:]
+        changes = self.cache.sync()
+        self.assertEqual(changes.updated, set(["a2"]))
+        self.assertEqual(invalidated, ["a2"])
+        self.assertFalse(self.cache.content_store.has("r1"))
+        self.assertTrue(self.cache.content_store.has("r2"))
+        self.cache.store.put_note(note)
+        chunk.resources = None
+        chunk.chunkHighUSN = chunk.updateCount = 7
+        chunk.expungedNotes = ["a2"]
+        self.cache.sync()
+        self.assertFalse(self.cache.content_store.has("r2"))
+
+    def test_sync_late_recognition(self):
+        self.cache.notestore = FakeNoteStore()
+        self.cache.notestore.getFilteredSyncChunk = Mock()
+        note = Guid("a2", resources=[
+            Resource(guid="r1", noteGuid="a2", updateSequenceNum=1,
+                     mime="image/png"),
+            Resource(guid="r2", noteGuid="a2", updateSequenceNum=1,
+                     mime="application/pdf")])
+        chunk = Mock(chunkHighUSN=1, updateCount=1, notes=[note],
+                     notebooks=None, resources=None, expungedNotes=None,
+                     expungedNotebooks=None)
+        self.cache.notestore.getFilteredSyncChunk.return_value = chunk
+        self.cache.sync()
+        stored = self.cache.get_note("a2")
+        self.assertEqual(self.cache.resource_text(stored), u"text r2")
+        recognised = Resource(guid="r1", noteGuid="a2", updateSequenceNum=2,
+                              mime="image/png", recognition=Data(size=1))
+        chunk = Mock(chunkHighUSN=2, updateCount=2, notes=None,
+                     notebooks=None, resources=[recognised],
+                     expungedNotes=None, expungedNotebooks=None)
+        self.cache.notestore.getFilteredSyncChunk.return_value = chunk
+        changes = self.cache.sync()
+        self.assertEqual(changes.updated, set(["a2"]))
+        stored = self.cache.get_note("a2")
+        self.assertEqual([r.updateSequenceNum for r in stored.resources],
+                         [2, 1])
+        self.assertEqual(self.cache.resource_text(stored),
+                         u"text r1\ntext r2")
+        self.assertEqual(self.cache.notestore.fetched, ["r2", "r1"])
+
+    def _chunks(self, count):
+        return [Mock(chunkHighUSN=usn, updateCount=count,
+                     notes=[Guid("n%d" % usn)], notebooks=None, resources=None,
+                     expungedNotes=None, expungedNotebooks=None)
+                for usn in xrange(1, count + 1)]
+
+    def test_sync_checkpoint_resume(self):
+        chunks = self._chunks(5)
+        self.cache.notestore.getFilteredSyncChunk.side_effect = \
+            chunks[:3] + [EDAMSystemException(
+                errorCode=EDAMErrorCode.INTERNAL_ERROR)]
+        self.assertRaises(EDAMSystemException, self.cache.sync,
+                          checkpoint_chunks=2)
+        self.cache.close()
+        cache = encache.ENCache("token", "host", self.testdir)
+        self.assertEqual(cache.last_update_count, 2)
+        cache.notestore.getFilteredSyncChunk.reset_mock()
+        cache.notestore.getFilteredSyncChunk.side_effect = chunks[2:]
+        changes = cache.sync(checkpoint_chunks=2)
+        self.assertEqual(
+            cache.notestore.getFilteredSyncChunk.call_args_list[0][0][1], 2)
+        self.assertEqual(changes.added, set(["n3", "n4", "n5"]))
+        self.assertEqual(len(cache.notes), 5)
+        cache.close()
+        cache = encache.ENCache("token", "host", self.testdir)
+        self.assertEqual(cache.last_update_count, 5)
+
+    def test_sync_progress(self):
+        self.cache.notestore.getFilteredSyncChunk.side_effect = \
+            self._chunks(4)
+        reports = []
+        self.cache.sync(progress=lambda status: reports.append(
+            (status.usn, status.update_count, status.chunks, status.notes,
+             status.fraction, status.eta_seconds is not None)))
+        self.assertEqual(reports, [(1, 4, 1, 1, 0.25, True),
+                                   (2, 4, 2, 2, 0.5, True),
+                                   (3, 4, 3, 3, 0.75, True),
+                                   (4, 4, 4, 4, 1.0, True)])
+
     def _sync(self):
         chunk = Mock(chunkHighUSN=5, updateCount=5,
                      notes=[Guid("a1"), Guid("a2", title="c1")],
                      notebooks=[Guid("b1"), Guid("b2", name="d1")],
+                     resources=None,
                      expungedNotes=["a1"],
                      expungedNotebooks=["b1"])
         self.cache.notestore.getFilteredSyncChunk.return_value = chunk
-        self.cache.sync()
+        return self.cache.sync()
 
     def tearDown(self):
         shutil.rmtree(self.testdir)
 
+class TestSyncProgress(unittest.TestCase):
+
+    def test_rates(self):
+        status = encache.SyncProgress(100)
+        status.chunk_done(Mock(chunkHighUSN=150, updateCount=300,
+                               notes=[None] * 20))
+        status.elapsed = 10.0
+        self.assertEqual(status.fraction, 0.25)
+        self.assertEqual(status.notes_per_second, 2.0)
+        self.assertEqual(status.eta_seconds, 30.0)
+        self.assertEqual(str(status), "synced 150/300 (25.0%), 20 notes, "
+                         "2.0 notes/s, eta 30s")
+
+    def test_no_estimate(self):
+        status = encache.SyncProgress(0)
+        self.assertEqual(status.fraction, 1.0)
+        self.assertEqual(status.notes_per_second, 0.0)
+        self.assertIsNone(status.eta_seconds)
+        self.assertIn("eta ?", str(status))
+
+
+class TestContentLRU(unittest.TestCase):
+
+    def setUp(self):
+        self.lru = encache.ContentLRU(10)
+
+    def test_get(self):
+        self.assertEqual(self.lru.get("a"), None)
+        self.lru.put("a", "1234")
+        self.assertEqual(self.lru.get("a"), "1234")
+        self.assertEqual((self.lru.hits, self.lru.misses), (1, 1))
+
+    def test_eviction(self):
+        self.lru.put("a", "1234")
+        self.lru.put("b", "1234")
+        self.lru.get("a")
+        self.lru.put("c", "1234")
+        self.assertEqual(self.lru.get("b"), None)
+        self.assertEqual(self.lru.get("a"), "1234")
+        self.assertEqual(self.lru.size, 8)
+
+    def test_replace(self):
+        self.lru.put("a", "1234")
+        self.lru.put("a", "123456")
+        self.assertEqual(self.lru.size, 6)
+        self.assertEqual(len(self.lru), 1)
+
+    def test_oversized(self):
+        self.lru.put("a", "1234")
+        self.lru.put("b", "12345678901")
+        self.assertEqual(self.lru.get("b"), None)
+        self.assertEqual(self.lru.get("a"), "1234")
+
+    def test_discard(self):
+        self.lru.put("a", "1234")
+        self.lru.discard("a")
+        self.lru.discard("b")
+        self.assertEqual(self.lru.size, 0)
+        self.assertEqual(self.lru.get("a"), None)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import evaluation
+
+
+class FakeClassifier(object):
+    "Predicts the 'label' feature, or the majority training label."
+
+    def __init__(self, majority, kwargs):
+        self.majority = majority
+        self.kwargs = kwargs
+
+    @classmethod
+    def train(cls, featuresets, params="cheat", **kwargs):
+        labels = [label for _, label in featuresets]
+        majority = None
+        if params == "majority":
+            majority = max(sorted(set(labels)), key=labels.count)
+        return cls(majority, kwargs)
+
+    def classify(self, featuresets):
+        return [self.majority or featuredict["label"]
+                for featuredict, _ in featuresets]
+
+
+class TestEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        self.featuresets = [({"label": label}, label)
+                            for label in ["a"] * 6 + ["b"] * 3 + ["c"]]
+
+    def test_stratified_folds(self):
+        labels = [label for _, label in self.featuresets]
+        folds = evaluation.stratified_folds(labels, 3)
+        self.assertEqual(sorted(sum(folds, [])), range(10))
+        self.assertEqual(sorted(len(fold) for fold in folds), [3, 3, 4])
+        for fold in folds:
+            self.assertEqual([labels[i] for i in fold].count("a"), 2)
+            self.assertEqual([labels[i] for i in fold].count("b"), 1)
+        self.assertEqual(folds, evaluation.stratified_folds(labels, 3))
+
+    def test_stratified_folds_invalid(self):
+        self.assertRaises(ValueError, evaluation.stratified_folds, ["a"], 1)
+        self.assertRaises(ValueError, evaluation.stratified_folds,
+                          ["a", "b"], 3)
+
+    def test_parameter_grid(self):
+        grid = evaluation.parameter_grid({"params": ["-c 1", "-c 10"],
+                                          "hash_dim": [None, 1024]})
+        self.assertEqual(grid, [{"hash_dim": None, "params": "-c 1"},
+                                {"hash_dim": None, "params": "-c 10"},
+                                {"hash_dim": 1024, "params": "-c 1"},
+                                {"hash_dim": 1024, "params": "-c 10"}])
+        self.assertRaises(KeyError, evaluation.parameter_grid, {"C": [1]})
+
+    def test_cross_validate(self):
+        results = evaluation.cross_validate(
+            self.featuresets, {"params": ["cheat", "majority"]}, k=3,
+            classifier_class=FakeClassifier)
+        self.assertEqual([result.config for result in results],
+                         [{"params": "cheat"}, {"params": "majority"}])
+        perfect, majority = results
+        self.assertEqual(perfect.accuracy, 1.0)
+        self.assertEqual(perfect.fold_accuracies, [1.0, 1.0, 1.0])
+        self.assertEqual(perfect.precision, {"a": 1.0, "b": 1.0, "c": 1.0})
+        self.assertEqual(majority.accuracy, 0.6)
+        self.assertEqual(majority.support, {"a": 6, "b": 3, "c": 1})
+        self.assertEqual(majority.precision, {"a": 0.6, "b": 0.0, "c": 0.0})
+        self.assertEqual(majority.recall, {"a": 1.0, "b": 0.0, "c": 0.0})
+        self.assertAlmostEqual(majority.macro_recall, 1.0 / 3)
+        self.assertGreaterEqual(majority.seconds, 0)
+
+    def test_cross_validate_processes(self):
+        grid = [{"params": "majority"}, {"max_features": 5}]
+        serial = evaluation.cross_validate(
+            self.featuresets, grid, k=5, classifier_class=FakeClassifier)
+        parallel = evaluation.cross_validate(
+            self.featuresets, grid, k=5, processes=2,
+            classifier_class=FakeClassifier)
+        self.assertEqual([result.accuracy for result in parallel],
+                         [result.accuracy for result in serial])
+        self.assertEqual(parallel[1].fold_accuracies, [1.0] * 5)
+
+    def test_cross_validate_invalid(self):
+        self.assertRaises(KeyError, evaluation.cross_validate,
+                          self.featuresets, [{"C": 1}])
+        self.assertRaises(ValueError, evaluation.cross_validate,
+                          self.featuresets,
+                          [{"hash_dim": 16, "max_features": 5}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import featurecache
+import tempfile
+import shutil
+from evernote.edam.type.ttypes import Note
+
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.cache = featurecache.FeatureCache(self.testdir)
+        self.note = Note(guid="a1", contentHash="\x01\xff",
+                         updateSequenceNum=3)
+        self.cache.put(self.note, {"f1": 1})
+
+    def test_get(self):
+        self.assertEqual(self.cache.get(self.note), {"f1": 1})
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_missing(self):
+        self.assertEqual(self.cache.get(Note(guid="a2")), None)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_updated_note(self):
+        note = Note(guid="a1", contentHash="\x01\xff", updateSequenceNum=4)
+        self.assertEqual(self.cache.get(note), None)
+
+    def test_model_version(self):
+        self.cache.close()
+        self.cache = featurecache.FeatureCache(self.testdir, version=-1)
+        self.assertEqual(self.cache.get(self.note), None)
+
+    def test_invalidate(self):
+        self.cache.invalidate("a1")
+        self.assertEqual(self.cache.get(self.note), None)
+
+    def test_persistence(self):
+        self.cache.close()
+        self.cache = featurecache.FeatureCache(self.testdir)
+        self.assertEqual(self.cache.get(self.note), {"f1": 1})
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.testdir)
+
+if __name__ == '__main__':
+    unittest.main()
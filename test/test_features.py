@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import time
 import features
+import metrics
 from mock import Mock
 from evernote.edam.type.ttypes import Note, NoteAttributes
 from StringIO import StringIO
@@ -105,5 +107,194 @@ class TestFeatures(unittest.TestCase):
         features.add_content_features(featuredict, content)
         self.assertEqual(featuredict, expected)
 
+    def test_token_across_elements(self):
+        content = StringIO("<en-note><div>ab<b>cd</b> caf&eacute;</div>"
+                           "</en-note>")
+        expected_keys = ("CONTENT-TOKEN-abcd", u"CONTENT-TOKEN-caf\xe9")
+        expected = dict.fromkeys(expected_keys, 1)
+        featuredict = {}
+        features.add_content_features(featuredict, content)
+        self.assertEqual(featuredict, expected)
+
+    def test_large_content(self):
+        words = ["w%d" % (i % 1000) for i in range(100000)]
+        content = StringIO("<en-note><div>%s</div></en-note>" %
+                           " ".join(words))
+        expected_keys = ["CONTENT-TOKEN-%s" % word for word in set(words)]
+        expected = dict.fromkeys(expected_keys, 1)
+        featuredict = {}
+        features.add_content_features(featuredict, content)
+        self.assertEqual(featuredict, expected)
+
+    def test_cjk_content(self):
+        content = StringIO(u'<?xml version="1.0" encoding="UTF-8"?>'
+                           u"<en-note><div>東京都</div></en-note>"
+                           .encode("utf-8"))
+        featuredict = {}
+        features.add_content_features(featuredict, content)
+        self.assertEqual(featuredict, {u"CONTENT-TOKEN-東京": 1,
+                                       u"CONTENT-TOKEN-京都": 1})
+
+    def test_tokenise_timing(self):
+        self.addCleanup(setattr, features, "time", features.time)
+        features.time = Mock()
+        features.time.time.return_value = 0.0
+        features.add_content_features({}, StringIO("<p>a b</p>"))
+        self.assertFalse(features.time.time.called)
+        metrics.reset()
+        metrics.enable()
+        try:
+            features.add_content_features({}, StringIO("<p>a b</p>"))
+            snapshot = metrics.snapshot()
+        finally:
+            metrics.disable()
+            metrics.reset()
+        self.assertTrue(features.time.time.called)
+        self.assertEqual(snapshot["histograms"][
+            "features_tokenise_seconds"]["count"], 1)
+
+    def test_capped_content(self):
+        content = StringIO("<en-note><div>one two</div> <div>three</div>"
+                           "<en-todo/></en-note>")
+        featuredict = {}
+        features.add_content_features(featuredict, content, max_tokens=2)
+        self.assertEqual(featuredict, {"CONTENT-TOKEN-one": 1,
+                                       "CONTENT-TOKEN-two": 1,
+                                       "CONTENT-TODO": 1})
+        content.seek(0)
+        featuredict = {}
+        features.add_content_features(featuredict, content, max_chars=5)
+        self.assertEqual(featuredict, {"CONTENT-TOKEN-one": 1,
+                                       "CONTENT-TODO": 1})
+
+    def test_long_unbroken_run(self):
+        featuredict = {}
+        target = features._ContentTarget(featuredict)
+        start = time.time()
+        for _ in xrange(4000):
+            target.data(u"a" * 1000)
+        target.data(u"b c")
+        target.close()
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(featuredict, {u"CONTENT-TOKEN-" + u"a" * 4000000 +
+                                       u"b": 1, u"CONTENT-TOKEN-c": 1})
+
+    def test_capped_unbroken_run(self):
+        featuredict = {}
+        target = features._ContentTarget(featuredict, max_chars=1000)
+        target.data(u"one ")
+        for _ in xrange(10):
+            target.data(u"a" * 500)
+            self.assertLessEqual(target.pending_chars, 1000)
+        self.assertTrue(target.tokens.full)
+        self.assertEqual(target.pending, [])
+        target.data(u" two")
+        target.close()
+        self.assertEqual(featuredict, {u"CONTENT-TOKEN-one": 1})
+        featuredict = {}
+        target = features._ContentTarget(featuredict, max_chars=9)
+        for data in (u"ab cd", u"ef", u"g h"):
+            target.data(data)
+        target.close()
+        self.assertEqual(featuredict, {u"CONTENT-TOKEN-ab": 1,
+                                       u"CONTENT-TOKEN-cdefg": 1})
+
+    def test_note_featuredict(self):
+        note = Note(title="title", attributes=NoteAttributes())
+        featuredict = features.note_featuredict(note, StringIO("<a>b</a>"))
+        expected_keys = ("DEFAULT", "META-TITLETOKEN-title",
+                         "CONTENT-TOKEN-b")
+        self.assertEqual(featuredict, dict.fromkeys(expected_keys, 1))
+
+    def test_note_featuredict_content_class(self):
+        note = Note(title="title",
+                    attributes=NoteAttributes(contentClass="cls"))
+        featuredict = features.note_featuredict(note, None)
+        expected_keys = ("DEFAULT", "META-TITLETOKEN-title",
+                         "META-CONTENTCLASS-cls")
+        self.assertEqual(featuredict, dict.fromkeys(expected_keys, 1))
+
+    def test_note_featuredict_ids(self):
+        note = Note(title="Title title",
+                    attributes=NoteAttributes(sourceURL="http://host/path"))
+        content = StringIO("<en-note>Hi <en-todo/></en-note>")
+        featuredict = features.note_featuredict(note, content, ids=True)
+        expected_keys = ((features.DEFAULT, u""),
+                         (features.META_TITLETOKEN, u"title"),
+                         (features.META_URL, "host"),
+                         (features.META_HASURL, u""),
+                         (features.CONTENT_TOKEN, u"hi"),
+                         (features.CONTENT_TODO, u""))
+        self.assertEqual(featuredict, dict.fromkeys(expected_keys, 1))
+
+    def test_note_featuredict_resources(self):
+        note = Note(title="title", attributes=NoteAttributes())
+        featuredict = features.note_featuredict(
+            note, StringIO("<a>b</a>"), resource_text=u"Scan B\nscan")
+        expected_keys = ("DEFAULT", "META-TITLETOKEN-title",
+                         "CONTENT-TOKEN-b", "RESOURCE-TOKEN-scan",
+                         "RESOURCE-TOKEN-b")
+        self.assertEqual(featuredict, dict.fromkeys(expected_keys, 1))
+        featuredict = features.note_featuredict(
+            note, StringIO("<a>b</a>"), ids=True, max_tokens=1,
+            resource_text=u"scan b")
+        self.assertIn((features.RESOURCE_TOKEN, u"scan"), featuredict)
+        self.assertNotIn((features.RESOURCE_TOKEN, u"b"), featuredict)
+        self.assertEqual(features.feature_key("RESOURCE-TOKEN-scan"),
+                         (features.RESOURCE_TOKEN, "scan"))
+
+    def test_feature_name(self):
+        self.assertEqual(features.feature_name((features.CONTENT_TOKEN,
+                                                u"hi")),
+                         u"CONTENT-TOKEN-hi")
+        self.assertEqual(features.feature_name((features.META_HASURL, u"")),
+                         "META-HASURL")
+        self.assertEqual(features.feature_name("DEFAULT"), "DEFAULT")
+
+    def test_feature_key(self):
+        self.assertEqual(features.feature_key(u"CONTENT-TOKEN-hi"),
+                         (features.CONTENT_TOKEN, u"hi"))
+        self.assertEqual(features.feature_key("META-HASURL"),
+                         (features.META_HASURL, ""))
+        self.assertEqual(features.feature_key("META-URL-host"),
+                         (features.META_URL, "host"))
+        self.assertRaises(ValueError, features.feature_key, "META-HASURLS")
+        self.assertRaises(ValueError, features.feature_key, "OTHER")
+
+    def test_extract_batch(self):
+        notes = []
+        contents = {}
+        for i in range(40):
+            attributes = NoteAttributes()
+            if i % 7 == 0:
+                attributes.contentClass = "cls"
+            notes.append(Note(guid=str(i), title="note %d" % i,
+                              attributes=attributes))
+            contents[str(i)] = "<en-note>word%d word%d</en-note>" % (i, i % 3)
+        content_source = lambda note: StringIO(contents[note.guid])
+        expected = [features.note_featuredict(note, content_source(note))
+                    for note in notes]
+        serial = features.extract_batch(notes, content_source)
+        self.assertEqual(list(serial), expected)
+        parallel = features.extract_batch(notes, content_source,
+                                          processes=3, chunksize=4)
+        self.assertEqual(list(parallel), expected)
+        expected = [features.note_featuredict(note, content_source(note),
+                                              ids=True)
+                    for note in notes]
+        parallel = features.extract_batch(notes, content_source,
+                                          processes=3, ids=True)
+        self.assertEqual(list(parallel), expected)
+        resource_source = lambda note: u"scan%s" % note.guid
+        expected = [features.note_featuredict(
+            note, content_source(note), resource_text=resource_source(note))
+            for note in notes]
+        parallel = features.extract_batch(notes, content_source,
+                                          processes=3,
+                                          resource_source=resource_source)
+        self.assertEqual(list(parallel), expected)
+        self.assertNotIn("RESOURCE-TOKEN-scan0", expected[0])
+        self.assertIn("RESOURCE-TOKEN-scan1", expected[1])
+
 if __name__ == '__main__':
     unittest.main()
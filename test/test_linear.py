@@ -0,0 +1,156 @@
+import unittest
+import numpy
+import tempfile
+import shutil
+import os
+import linear
+from linear import LinearClassifier, OnlineClassifier
+from vectoriser import FeatureHasher
+
+
+class TestLinearClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.featuresets = []
+        for i in range(30):
+            label = "l%d" % (i % 3)
+            featuredict = {"DEFAULT": 1, "f%d" % (i % 3): 1,
+                           "noise%d" % (i % 5): 1}
+            self.featuresets.append((featuredict, label))
+
+    def test_classify(self):
+        svm = LinearClassifier.train(self.featuresets)
+        labels = svm.classify([({"f2": 1, "noise1": 1}, None),
+                               ({"f0": 1, "unseen": 1}, None),
+                               ({"f1": 1}, None)])
+        self.assertEqual(labels, ["l2", "l0", "l1"])
+
+    def test_weight_limit(self):
+        self.addCleanup(setattr, linear, "MAX_WEIGHT_BYTES",
+                        linear.MAX_WEIGHT_BYTES)
+        linear.MAX_WEIGHT_BYTES = 3 * 1025 * 8
+        LinearClassifier.train(self.featuresets, hash_dim=2 ** 10)
+        self.assertRaises(ValueError, LinearClassifier.train,
+                          self.featuresets, hash_dim=2 ** 11)
+
+    def test_weights(self):
+        svm = LinearClassifier.train(self.featuresets)
+        self.assertEqual(svm.weights.shape, (3, len(svm.featureindex) + 1))
+        self.assertEqual(svm.labelindex, {"l0": 1, "l1": 2, "l2": 3})
+
+    def test_l1_loss(self):
+        svm = LinearClassifier.train(self.featuresets, "-s 3 -c 10 -B 2")
+        self.assertEqual(svm.classify([({"f1": 1}, None)]), ["l1"])
+
+    def test_no_bias(self):
+        svm = LinearClassifier.train(self.featuresets, "-B -1")
+        self.assertTrue(numpy.all(svm.weights[:, -1] == 0))
+
+    def test_hashing(self):
+        svm = LinearClassifier.train(self.featuresets, hash_dim=2 ** 10)
+        self.assertEqual(svm.featureindex, FeatureHasher(2 ** 10))
+        self.assertEqual(svm.classify([({"f0": 1}, None)]), ["l0"])
+
+    def test_classify_empty(self):
+        svm = LinearClassifier.train(self.featuresets)
+        self.assertEqual(svm.classify([]), [])
+
+    def test_classify_proba(self):
+        svm = LinearClassifier.train(self.featuresets)
+        featuresets = [({"f2": 1}, None), ({"f0": 1}, None)]
+        scores = svm.decision_function(featuresets)
+        self.assertEqual(scores.shape, (2, 3))
+        ranked = svm.classify_proba(featuresets, k=2)
+        self.assertEqual([row[0][0] for row in ranked], ["l2", "l0"])
+        self.assertEqual(ranked[0][0][1], scores[0].max())
+        self.assertEqual(len(ranked[0]), 2)
+        svm.calibrate(self.featuresets)
+        ranked = svm.classify_proba(featuresets)
+        self.assertEqual([row[0][0] for row in ranked], ["l2", "l0"])
+        self.assertAlmostEqual(sum(score for _, score in ranked[0]), 1)
+
+    def test_params(self):
+        options = LinearClassifier.parse_params("-s 3 -c 2 -e 0.01 -B 0 -q")
+        self.assertEqual(options, {"loss": 1, "C": 2.0, "eps": 0.01,
+                                   "bias": 0.0})
+        self.assertRaises(ValueError, LinearClassifier.parse_params, "-t 0")
+        self.assertRaises(ValueError, LinearClassifier.parse_params, "-s 0")
+        self.assertRaises(ValueError, LinearClassifier.parse_params, "-c")
+
+
+class TestOnlineClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.svm = OnlineClassifier(hash_dim=2 ** 10)
+        self.svm.update([({"f0": 1}, "l0"), ({"f1": 1}, "l1"),
+                         ({"f0": 1, "x": 1}, "l0")])
+
+    def test_classify(self):
+        self.assertEqual(self.svm.classify([({"f1": 1}, None),
+                                            ({"f0": 1}, None)]),
+                         ["l1", "l0"])
+
+    def test_new_label(self):
+        self.svm.update([({"f2": 1}, "l2")])
+        self.assertEqual(self.svm.weights.shape, (3, 2 ** 10 + 1))
+        self.assertEqual(self.svm.classify([({"f2": 1}, None)]), ["l2"])
+        self.assertEqual(self.svm.classify([({"f1": 1}, None)]), ["l1"])
+
+    def test_update_moves_prediction(self):
+        for _ in range(3):
+            self.svm.update([({"f1": 1, "y": 1}, "l0")])
+        self.assertEqual(self.svm.classify([({"f1": 1, "y": 1}, None)]),
+                         ["l0"])
+
+    def test_discard_labels(self):
+        self.svm.update([({"f2": 1}, "l2")])
+        self.svm.discard_labels(["l1", "unknown"])
+        self.assertEqual(self.svm.labelindex, {"l0": 1, "l2": 2})
+        self.assertEqual(self.svm.weights.shape[0], 2)
+        self.assertEqual(self.svm.classify([({"f2": 1}, None)]), ["l2"])
+
+    def test_weight_limit(self):
+        self.addCleanup(setattr, linear, "MAX_WEIGHT_BYTES",
+                        linear.MAX_WEIGHT_BYTES)
+        linear.MAX_WEIGHT_BYTES = 1025 * 4
+        svm = OnlineClassifier(hash_dim=2 ** 10)
+        svm.update([({"f0": 1}, "l0")])
+        self.assertEqual(svm.weights.dtype, numpy.float32)
+        self.assertRaises(ValueError, svm.update, [({"f0": 1}, "l1")])
+
+    def test_single_label_updates(self):
+        svm = OnlineClassifier(hash_dim=2 ** 10)
+        for _ in range(5):
+            svm.update([({"f0": 1}, "l0")])
+        self.assertTrue(svm.weights.any())
+        self.assertEqual(svm.classify([({"f0": 1}, None)]), ["l0"])
+        svm.update([({"f1": 1}, "l1")])
+        self.assertEqual(svm.classify([({"f0": 1}, None),
+                                       ({"f1": 1}, None)]), ["l0", "l1"])
+
+    def test_no_labels(self):
+        svm = OnlineClassifier(hash_dim=2 ** 10)
+        self.assertEqual(svm.classify([({"f0": 1}, None)]), [None])
+        self.svm.discard_labels(["l0", "l1"])
+        self.assertEqual(self.svm.classify([({"f0": 1}, None),
+                                            ({}, None)]), [None, None])
+
+    def test_train(self):
+        svm = OnlineClassifier.train([({"f0": 1}, "l0"), ({"f1": 1}, "l1")],
+                                     hash_dim=2 ** 10)
+        self.assertEqual(svm.classify([({"f1": 1}, None)]), ["l1"])
+
+    def test_checkpoint(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(testdir, "model.npz")
+            self.svm.save(path)
+            svm = OnlineClassifier.load(path)
+        finally:
+            shutil.rmtree(testdir)
+        self.assertEqual(svm.labelindex, self.svm.labelindex)
+        self.assertEqual(svm.featureindex, self.svm.featureindex)
+        self.assertTrue(numpy.all(svm.weights == self.svm.weights))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import unittest
+import metastore
+import tempfile
+import os
+import shutil
+from evernote.edam.type.ttypes import Note, Notebook
+
+
+class TestJournalStore(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.store = metastore.JournalStore(self.testdir)
+
+    def test_reload(self):
+        self._sync()
+        self.store.close()
+        store = metastore.JournalStore(self.testdir)
+        self.assertEqual(store.last_update_count, 7)
+        self.assertEqual([n.guid for n in store.notes()], ["a3", "a1"])
+        self.assertEqual([nb.guid for nb in store.notebooks()], ["b1"])
+        self.assertEqual(store.notes()[1].title, "new")
+        self.assertEqual(store.get_note("a1").title, "new")
+        self.assertEqual(store.get_note("a2"), None)
+        store.close()
+
+    def test_torn_record(self):
+        self._sync()
+        self.store.close()
+        size = os.path.getsize(self.store.log_path)
+        with open(self.store.log_path, "r+b") as handle:
+            handle.truncate(size - 3)
+        store = metastore.JournalStore(self.testdir)
+        self.assertEqual(store.last_update_count, 5)
+        self.assertEqual([n.guid for n in store.notes()], ["a1", "a2"])
+        store.put_note(Note(guid="a4"))
+        store.end_chunk(9)
+        store.close()
+        store = metastore.JournalStore(self.testdir)
+        self.assertEqual(store.last_update_count, 9)
+        self.assertEqual([n.guid for n in store.notes()], ["a1", "a2", "a4"])
+        store.close()
+
+    def test_compact(self):
+        self._sync()
+        self.store.compact()
+        self.assertEqual(os.path.getsize(self.store.log_path), 0)
+        self.store.put_note(Note(guid="a4"))
+        self.store.end_chunk(9)
+        self.store.close()
+        store = metastore.JournalStore(self.testdir)
+        self.assertEqual(store.last_update_count, 9)
+        self.assertEqual([n.guid for n in store.notes()], ["a3", "a1", "a4"])
+        store.close()
+
+    def test_stale_records_skipped(self):
+        self._sync()
+        with open(self.store.log_path, "rb") as handle:
+            journal = handle.read()
+        self.store.compact()
+        self.store.close()
+        # Simulate a crash between writing the snapshot and truncating the
+        # journal.
+        with open(self.store.log_path, "wb") as handle:
+            handle.write(journal)
+        store = metastore.JournalStore(self.testdir)
+        self.assertEqual([n.guid for n in store.notes()], ["a3", "a1"])
+        store.close()
+
+    def _sync(self):
+        self.store.put_note(Note(guid="a1", title="old"))
+        self.store.put_note(Note(guid="a2"))
+        self.store.put_notebook(Notebook(guid="b1"))
+        self.store.end_chunk(5)
+        self.store.put_note(Note(guid="a3"))
+        self.store.put_note(Note(guid="a1", title="new"))
+        self.store.expunge_note("a2")
+        self.store.end_chunk(7)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.testdir)
+
+
+class TestPickleStore(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def test_reload(self):
+        store = metastore.PickleStore(self.testdir)
+        store.put_note(Note(guid="a1"))
+        store.put_notebook(Notebook(guid="b1"))
+        store.end_chunk(3)
+        store.flush()
+        store = metastore.PickleStore(self.testdir)
+        self.assertEqual(store.last_update_count, 3)
+        self.assertEqual([n.guid for n in store.notes()], ["a1"])
+        self.assertEqual([nb.guid for nb in store.notebooks()], ["b1"])
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+class TestSqliteStore(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.store = metastore.SqliteStore(self.testdir)
+        self.store.put_note(Note(guid="a1", notebookGuid="b1",
+                                 updateSequenceNum=1, updated=100))
+        self.store.put_note(Note(guid="a2", notebookGuid="b2",
+                                 updateSequenceNum=2, updated=300))
+        self.store.put_note(Note(guid="a3", notebookGuid="b1",
+                                 updateSequenceNum=3, updated=200))
+        self.store.put_notebook(Notebook(guid="b1", updateSequenceNum=4))
+        self.store.end_chunk(4)
+        self.store.put_note(Note(guid="a1", notebookGuid="b2",
+                                 updateSequenceNum=5, updated=400))
+        self.store.expunge_note("a2")
+        self.store.end_chunk(5)
+
+    def test_notes(self):
+        notes = self.store.notes()
+        self.assertEqual(len(notes), 2)
+        self.assertEqual([n.guid for n in notes], ["a3", "a1"])
+
+    def test_get_note(self):
+        self.assertEqual(self.store.get_note("a1").updated, 400)
+        self.assertEqual(self.store.get_note("a2"), None)
+
+    def test_notes_in_notebook(self):
+        notes = self.store.notes_in_notebook("b2")
+        self.assertEqual([n.guid for n in notes], ["a1"])
+
+    def test_notes_updated_since(self):
+        notes = self.store.notes_updated_since(200)
+        self.assertEqual([n.guid for n in notes], ["a3", "a1"])
+
+    def test_reload(self):
+        self.store.close()
+        self.store = metastore.SqliteStore(self.testdir)
+        self.assertEqual(self.store.last_update_count, 5)
+        self.assertTrue(self.store.has_note("a3"))
+        self.assertFalse(self.store.has_note("a2"))
+        self.assertEqual([nb.guid for nb in self.store.notebooks()], ["b1"])
+
+    def test_uncommitted_chunk(self):
+        self.store.put_note(Note(guid="a4", updateSequenceNum=6))
+        self.store.close()
+        self.store = metastore.SqliteStore(self.testdir)
+        self.assertFalse(self.store.has_note("a4"))
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.testdir)
+
+if __name__ == '__main__':
+    unittest.main()
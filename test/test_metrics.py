@@ -0,0 +1,67 @@
+import unittest
+import json
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        metrics.enable()
+
+    def test_disabled(self):
+        metrics.disable()
+        metrics.increment("c_total")
+        metrics.observe("h_seconds", 1)
+        with metrics.timer("t_seconds"):
+            pass
+        self.assertEqual(metrics.snapshot(),
+                         {"counters": {}, "histograms": {}})
+
+    def test_counter(self):
+        metrics.increment("c_total")
+        metrics.increment("c_total", 4)
+        self.assertEqual(metrics.snapshot()["counters"], {"c_total": 5})
+
+    def test_histogram(self):
+        for value in [5, 50, 500, 500000]:
+            metrics.observe("size", value, metrics.SIZE_BUCKETS)
+        histogram = metrics.snapshot()["histograms"]["size"]
+        self.assertEqual(histogram["count"], 4)
+        self.assertEqual(histogram["sum"], 500555)
+        self.assertEqual(histogram["min"], 5)
+        self.assertEqual(histogram["max"], 500000)
+        self.assertEqual(histogram["buckets"][:4],
+                         [[10, 1], [30, 1], [100, 2], [300, 2]])
+        self.assertEqual(histogram["buckets"][-1], [100000, 3])
+
+    def test_timer(self):
+        with metrics.timer("t_seconds"):
+            pass
+        histogram = metrics.snapshot()["histograms"]["t_seconds"]
+        self.assertEqual(histogram["count"], 1)
+        self.assertTrue(0 <= histogram["sum"] < 1)
+
+    def test_json(self):
+        metrics.increment("c_total")
+        self.assertEqual(json.loads(metrics.to_json())["counters"],
+                         {"c_total": 1})
+
+    def test_prometheus(self):
+        metrics.increment("c_total", 2)
+        metrics.observe("t_seconds", 0.002)
+        lines = metrics.to_prometheus().splitlines()
+        self.assertEqual(lines[:3], ["# TYPE c_total counter", "c_total 2",
+                                     "# TYPE t_seconds histogram"])
+        self.assertTrue('t_seconds_bucket{le="0.001"} 0' in lines)
+        self.assertTrue('t_seconds_bucket{le="0.005"} 1' in lines)
+        self.assertTrue('t_seconds_bucket{le="+Inf"} 1' in lines)
+        self.assertTrue("t_seconds_sum 0.002" in lines)
+        self.assertTrue("t_seconds_count 1" in lines)
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import selection
+
+
+class TestScorers(unittest.TestCase):
+
+    def test_chi2(self):
+        self.assertAlmostEqual(selection.chi2(10, 0, 10, 10), 20.0)
+        self.assertAlmostEqual(selection.chi2(5, 5, 10, 10), 0.0)
+
+    def test_information_gain(self):
+        self.assertAlmostEqual(selection.information_gain(10, 0, 10, 10), 1.0)
+        self.assertAlmostEqual(selection.information_gain(5, 5, 10, 10), 0.0)
+
+    def test_bns(self):
+        self.assertAlmostEqual(selection.bns(5, 5, 10, 10), 0.0)
+        self.assertAlmostEqual(selection.bns(10, 0, 10, 10), 6.581, places=3)
+
+    def test_norm_ppf(self):
+        self.assertAlmostEqual(selection._norm_ppf(0.5), 0.0)
+        self.assertAlmostEqual(selection._norm_ppf(0.975), 1.959964,
+                               places=6)
+        self.assertAlmostEqual(selection._norm_ppf(0.001), -3.090232,
+                               places=6)
+
+    def test_document_frequency(self):
+        self.assertEqual(selection.document_frequency(3, 4, 10, 10), 7)
+
+
+class TestFeatureSelector(unittest.TestCase):
+
+    def setUp(self):
+        self.featuresets = [({"good": 1, "common": 1, "rare": 1}, "l1"),
+                            ({"good": 1, "common": 1}, "l1"),
+                            ({"common": 1, "noise": 1}, "l2"),
+                            ({"common": 1, "zero": 0}, "l2")]
+
+    def test_scores(self):
+        scores = selection.FeatureSelector().scores(self.featuresets)
+        self.assertEqual(set(scores), set(["good", "common", "rare",
+                                           "noise"]))
+        self.assertAlmostEqual(scores["good"], 4.0)
+        self.assertAlmostEqual(scores["common"], 0.0)
+
+    def test_top_k(self):
+        selector = selection.FeatureSelector("ig", k=1)
+        self.assertEqual(selector.select(self.featuresets), set(["good"]))
+
+    def test_threshold(self):
+        selector = selection.FeatureSelector("df", threshold=2)
+        self.assertEqual(selector.select(self.featuresets),
+                         set(["good", "common"]))
+
+    def test_unknown_scorer(self):
+        self.assertRaises(KeyError, selection.FeatureSelector, "bogus")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import json
+import threading
+import urllib2
+import server
+import metrics
+from mock import Mock
+
+
+class TestPredictServer(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = Mock()
+        self.classifier.labelindex = {"l1": 1, "l2": 2}
+        self.classifier.classify.side_effect = \
+            lambda featuresets: ["l1"] * len(featuresets)
+        self.server = server.PredictServer(self.classifier, port=0)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://%s:%d" % self.server.server_address
+
+    def _post(self, path, obj):
+        request = urllib2.Request(self.url + path, json.dumps(obj),
+                                  {"Content-Type": "application/json"})
+        return json.loads(urllib2.urlopen(request).read())
+
+    def test_featuredicts(self):
+        response = self._post("/classify", {"featuredicts": [{"f1": 1}]})
+        self.assertEqual(response, {"labels": ["l1"]})
+        self.classifier.classify.assert_called_with([({"f1": 1}, None)])
+
+    def test_notes(self):
+        response = self._post("/classify", {"notes": [
+            {"title": u"hi", "content": "<en-note>there</en-note>",
+             "sourceURL": "http://host/path"}]})
+        self.assertEqual(response, {"labels": ["l1"]})
+        featureset = self.classifier.classify.call_args[0][0][0]
+        self.assertEqual(featureset[0],
+                         dict.fromkeys(["DEFAULT", "META-TITLETOKEN-hi",
+                                        "META-URL-host", "META-HASURL",
+                                        "CONTENT-TOKEN-there"], 1))
+
+    def test_ranked(self):
+        self.classifier.classify_proba.return_value = [[("l2", 0.75),
+                                                        ("l1", 0.25)]]
+        response = self._post("/classify", {"featuredicts": [{"f1": 1}],
+                                            "k": 2})
+        self.assertEqual(response, {"ranked": [[["l2", 0.75],
+                                                ["l1", 0.25]]]})
+        self.classifier.classify_proba.assert_called_with(
+            [({"f1": 1}, None)], 2)
+
+    def test_bad_request(self):
+        try:
+            self._post("/classify", {"other": []})
+            self.fail()
+        except urllib2.HTTPError as exc:
+            self.assertEqual(exc.code, 400)
+        try:
+            self._post("/classify", {"featuredicts": [], "k": 0})
+            self.fail()
+        except urllib2.HTTPError as exc:
+            self.assertEqual(exc.code, 400)
+
+    def test_health(self):
+        response = json.loads(urllib2.urlopen(self.url + "/health").read())
+        self.assertEqual(response, {"status": "ok", "labels": 2})
+
+    def test_metrics(self):
+        metrics.reset()
+        metrics.enable()
+        try:
+            self._post("/classify", {"featuredicts": [{"f1": 1}]})
+            text = urllib2.urlopen(self.url + "/metrics").read()
+        finally:
+            metrics.disable()
+            metrics.reset()
+        self.assertTrue("server_requests_total 1\n" in text)
+        self.assertTrue("server_classify_seconds_count 1\n" in text)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
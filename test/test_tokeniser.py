@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 import random
-from tokeniser import Tokeniser
+from tokeniser import Tokeniser, TokenSet, cjk_ngrams
 
 class TestTokeniser(unittest.TestCase):
 
@@ -21,5 +21,60 @@ class TestTokeniser(unittest.TestCase):
         tokens = Tokeniser.split(u'hi theré')
         self.assertEqual(tokens, ["hi", u'theré'])
 
+    def test_unique(self):
+        text = u"Hi hi U.S.A. $12.50, théâtre ÉCOLE 100abc -- hi... x_y a-b"
+        tokens = list(Tokeniser.unique(text))
+        self.assertEqual(len(tokens), len(set(tokens)))
+        self.assertEqual(set(tokens),
+                         set(token.lower() for token in Tokeniser.split(text)))
+
+    def test_unique_random(self):
+        alphabet = u"aAbZ.$1,-_ \t\n\xa0\u3000e\u0301U.S.\u65e5\u20ac9"
+        rand = random.Random(0)
+        for _ in range(1000):
+            text = u"".join(rand.choice(alphabet)
+                            for _ in range(rand.randrange(30)))
+            self.assertEqual(set(Tokeniser.unique(text, ngrams=None)),
+                             set(token.lower()
+                                 for token in Tokeniser.split(text)))
+
+    def test_cjk_ngrams(self):
+        self.assertEqual(list(cjk_ngrams(u"東京都")), [u"東京", u"京都"])
+        self.assertEqual(list(cjk_ngrams(u"東京都", (2, 3))),
+                         [u"東京", u"京都", u"東京都"])
+        self.assertEqual(list(cjk_ngrams(u"東")), [u"東"])
+
+    def test_unique_cjk(self):
+        tokens = set(Tokeniser.unique(u"iPhone手机很好。 ok カタカナ"))
+        self.assertEqual(tokens, set([u"iphone", u"手机", u"机很", u"很好",
+                                      u"。", u"ok", u"カタ", u"タカ",
+                                      u"カナ"]))
+        self.assertEqual(set(Tokeniser.unique(u"서울 날씨가 좋다")),
+                         set([u"서울", u"날씨가", u"좋다"]))
+        self.assertEqual(set(Tokeniser.unique(u"手机很好", ngrams=None)),
+                         set([u"手机很好"]))
+
+    def test_max_tokens(self):
+        tokens = TokenSet(max_tokens=2)
+        tokens.update(u"a b a c")
+        self.assertEqual(tokens.tokens, set([u"a", u"b"]))
+        self.assertTrue(tokens.full)
+        tokens = TokenSet(max_tokens=2)
+        tokens.update(u"a b a")
+        self.assertFalse(tokens.full)
+
+    def test_max_chars(self):
+        self.assertEqual(list(Tokeniser.unique(u"ab cd ef", max_chars=4)),
+                         [u"ab"])
+        self.assertEqual(list(Tokeniser.unique(u"ab cd ef", max_chars=5)),
+                         [u"ab", u"cd"])
+
+    def test_pieces(self):
+        tokens = TokenSet(max_chars=8)
+        self.assertEqual(list(tokens.iter_update(u"Ab cd ")), [u"ab", u"cd"])
+        self.assertEqual(list(tokens.iter_update(u"AB ef")), [])
+        self.assertTrue(tokens.full)
+        self.assertEqual(list(tokens.iter_update(u"gh")), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import tempfile
+import shutil
+from vectoriser import FeatureHasher, featuresets_to_csr
+from vectoriser import CompactFeatureIndex, save_feature_table
+from vectoriser import load_feature_table
+from features import feature_key, CONTENT_TOKEN, META_HASURL
+
+
+class TestFeatureHasher(unittest.TestCase):
+
+    def setUp(self):
+        self.hasher = FeatureHasher(2 ** 10)
+
+    def test_range(self):
+        for i in range(1000):
+            self.assertTrue(1 <= self.hasher["f%d" % i] <= 2 ** 10)
+
+    def test_stable(self):
+        self.assertEqual(self.hasher["feature"],
+                         FeatureHasher(2 ** 10)["feature"])
+
+    def test_unicode(self):
+        self.assertEqual(self.hasher[u"abcdé"],
+                         self.hasher[u"abcdé".encode("utf-8")])
+
+    def test_namespace_keys(self):
+        for ftr in [u"CONTENT-TOKEN-caf\u00e9", "META-HASURL", "DEFAULT"]:
+            key = feature_key(ftr)
+            self.assertEqual(self.hasher[key], self.hasher[ftr])
+
+    def test_vector(self):
+        vector = self.hasher.vector({"f1": 1, "f2": 1})
+        self.assertEqual(sorted(vector.keys()),
+                         sorted([self.hasher["f1"], self.hasher["f2"]]))
+        self.assertEqual(set(abs(v) for v in vector.values()), set([1]))
+
+    def test_signed_collisions(self):
+        hasher = FeatureHasher(1)
+        featuredict = dict(("f%d" % i, 1) for i in range(100))
+        vector = hasher.vector(featuredict)
+        self.assertTrue(abs(vector.get(1, 0)) < 100)
+        unsigned = FeatureHasher(1, signed=False).vector(featuredict)
+        self.assertEqual(unsigned, {1: 100})
+
+    def test_dict_protocol(self):
+        self.assertEqual(len(self.hasher), 2 ** 10)
+        self.assertTrue("anything" in self.hasher)
+
+    def test_dim(self):
+        self.assertRaises(ValueError, FeatureHasher, 0)
+        self.assertRaises(ValueError, FeatureHasher, 2 ** 32)
+
+
+class TestFeaturesetsToCsr(unittest.TestCase):
+
+    def test_index(self):
+        featureindex = {"a": 1, "b": 2, "c": 3}
+        matrix, labels = featuresets_to_csr(
+            featureindex, {"l1": 1, "l2": 2},
+            [({"c": 1, "a": 2, "x": 1}, "l2"), ({}, "l1"), ({"b": 1}, "l3")])
+        self.assertEqual(matrix.shape, (3, 3))
+        self.assertEqual(matrix.toarray().tolist(),
+                         [[2, 0, 1], [0, 0, 0], [0, 1, 0]])
+        self.assertEqual(list(matrix.indices), [0, 2, 1])
+        self.assertEqual(list(labels), [2, 1, -1])
+
+    def test_hasher(self):
+        hasher = FeatureHasher(16)
+        featuredict = {"a": 1, "b": 1, "c": 1}
+        matrix, _ = featuresets_to_csr(hasher, {}, [(featuredict, None)])
+        self.assertEqual(matrix.shape, (1, 16))
+        row = matrix.getrow(0)
+        self.assertEqual(dict(zip(row.indices + 1, row.data)),
+                         hasher.vector(featuredict))
+
+
+class TestCompactFeatureIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.featureindex = {"b": 1, "a": 2, u"\u00e9t\u00e9": 3, "ab": 4}
+        save_feature_table(self.featureindex, self.testdir)
+        self.index = CompactFeatureIndex(self.testdir)
+
+    def test_load_feature_table(self):
+        self.assertEqual(load_feature_table(self.testdir), self.featureindex)
+
+    def test_byte_string_names(self):
+        place = u"META-PLACE-Z\u00fcrich"
+        featureindex = {place.encode("utf-8"): 1,
+                        u"CONTENT-TOKEN-z\u00fcrich": 2, "a": 3}
+        save_feature_table(featureindex, self.testdir)
+        self.assertEqual(load_feature_table(self.testdir), featureindex)
+        matrix, _ = featuresets_to_csr(load_feature_table(self.testdir), {},
+                                       [({place.encode("utf-8"): 1}, None)])
+        self.assertEqual(matrix.indices.tolist(), [0])
+
+    def test_lookup(self):
+        self.assertEqual(len(self.index), 4)
+        for ftr, index in self.featureindex.items():
+            self.assertTrue(ftr in self.index)
+            self.assertEqual(self.index[ftr], index)
+        self.assertEqual(self.index[u"\u00e9t\u00e9".encode("utf-8")], 3)
+        for ftr in ["", "0", "aa", "abc", "c", u"\u00e9"]:
+            self.assertFalse(ftr in self.index)
+            self.assertEqual(self.index.get(ftr, -1), -1)
+        self.assertRaises(KeyError, self.index.__getitem__, "c")
+
+    def test_iteritems(self):
+        self.assertEqual(dict(self.index.iteritems()), self.featureindex)
+
+    def test_namespace_keys(self):
+        save_feature_table({(CONTENT_TOKEN, u"hi"): 1, (META_HASURL, u""): 2},
+                           self.testdir)
+        index = CompactFeatureIndex(self.testdir)
+        self.assertEqual(index["CONTENT-TOKEN-hi"], 1)
+        self.assertEqual(index[(META_HASURL, u"")], 2)
+
+    def test_vector(self):
+        self.assertEqual(self.index.vector({"a": 1, "c": 1, "ab": 2}),
+                         {2: 1, 4: 2})
+
+    def test_csr(self):
+        matrix, _ = featuresets_to_csr(self.index, {}, [({"ab": 1}, None)])
+        self.assertEqual(matrix.shape, (1, 4))
+        self.assertEqual(matrix.indices.tolist(), [3])
+
+    def test_empty(self):
+        save_feature_table({}, self.testdir)
+        index = CompactFeatureIndex(self.testdir)
+        self.assertEqual(len(index), 0)
+        self.assertFalse("a" in index)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
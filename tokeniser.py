@@ -1,5 +1,39 @@
 import re
 
+# Chinese and Japanese characters: the iteration mark, kana, CJK ideographs
+# and halfwidth katakana. These scripts do not separate words with spaces,
+# so their runs are tokenised into character n-grams. Hangul is left out,
+# since Korean does separate words with spaces and its words are already
+# tokens. CJK punctuation is left to the tokeniser.
+_CJK_RANGES = (u"\u3005\u3040-\u30ff\u31f0-\u31ff\u3400-\u4dbf"
+               u"\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f")
+_CJK_CHAR = re.compile(u"[%s]" % _CJK_RANGES)
+_CJK_RUN = re.compile(u"([%s]+)" % _CJK_RANGES)
+
+# Lengths of the character n-grams generated for CJK runs. Bigrams match
+# most Chinese and Japanese words; adding trigrams, e.g. (2, 3), more than
+# doubles the vocabulary.
+CJK_NGRAMS = (2,)
+
+
+def cjk_ngrams(run, ngrams=CJK_NGRAMS):
+    """Generate the character n-grams of a run of CJK characters.
+
+    Args:
+        run: A unicode string of CJK characters.
+        ngrams: Sequence of n-gram lengths.
+
+    Returns:
+        Iterator of unicode n-grams. A run shorter than every n-gram length
+        is generated whole.
+    """
+    if len(run) < min(ngrams):
+        yield run
+        return
+    for n in ngrams:
+        for i in xrange(len(run) - n + 1):
+            yield run[i:i + n]
+
 
 class Tokeniser(object):
     """Simple tokeniser."""
@@ -22,3 +56,138 @@ class Tokeniser(object):
             List of tokens.
         """
         return cls.regexp.findall(string)
+
+    @classmethod
+    def unique(cls, string, max_tokens=None, max_chars=None,
+               ngrams=CJK_NGRAMS):
+        """Generate the distinct, case-folded tokens of a string.
+
+        The tokens are those of split, lowercased, each generated once,
+        except that runs of CJK characters are split into character n-grams.
+        See TokenSet.
+
+        Args:
+            string: A unicode string.
+            max_tokens: Maximum number of tokens to generate, or None.
+            max_chars: Maximum number of characters to tokenise, or None.
+            ngrams: Sequence of n-gram lengths for CJK runs, or None to
+                tokenise them like other text.
+
+        Returns:
+            Iterator of unicode tokens.
+        """
+        tokens = TokenSet(max_tokens, max_chars, ngrams)
+        return tokens.iter_update(string)
+
+
+class TokenSet(object):
+    """The distinct, case-folded tokens of a text given in one or more pieces.
+
+    No token spans whitespace, so the text is first split on whitespace and
+    each distinct chunk is tokenised once. A chunk made only of letters is a
+    single token, and the regular expression only runs on the others. For
+    long texts, which repeat most words many times, this is several times
+    faster than split.
+
+    Chinese and Japanese do not separate words with spaces, so split would
+    return a whole CJK sentence as one token. Unless ngrams is None, runs of
+    CJK characters are instead split into overlapping character n-grams,
+    which approximate words without a dictionary. Each piece of text is
+    checked for CJK characters in a single scan first, so other text takes
+    the fast path unchanged.
+
+    The text may be fed in pieces, as long as each piece ends at whitespace
+    or at the end of the text. Optional caps bound the work per text: once
+    max_chars characters have been read or max_tokens tokens found, further
+    text is ignored and full is set. A chunk cut by max_chars is dropped.
+
+    Attributes:
+        tokens: Set of the tokens found so far.
+        full: Whether a cap has been reached.
+        max_tokens: Maximum number of tokens, or None.
+        max_chars: Maximum number of characters to read, or None.
+        ngrams: Sequence of n-gram lengths for CJK runs, or None.
+    """
+
+    def __init__(self, max_tokens=None, max_chars=None, ngrams=CJK_NGRAMS):
+        self.tokens = set()
+        self.full = False
+        self.max_tokens = max_tokens
+        self.max_chars = max_chars
+        self.ngrams = ngrams
+        self._chunks = set()
+        self._chars = 0
+
+    @property
+    def chars_left(self):
+        """Number of characters that can still be read, or None."""
+        if self.max_chars is None:
+            return None
+        return self.max_chars - self._chars
+
+    def update(self, string):
+        """Add the tokens of the next piece of text.
+
+        Args:
+            string: A unicode string.
+        """
+        for _ in self.iter_update(string):
+            pass
+
+    def iter_update(self, string):
+        """Add the tokens of the next piece of text, generating new ones.
+
+        Args:
+            string: A unicode string.
+
+        Returns:
+            Iterator of the unicode tokens not seen before.
+        """
+        if self.full:
+            return
+        if self.max_chars is not None:
+            remaining = self.max_chars - self._chars
+            if len(string) > remaining:
+                self.full = True
+                end = remaining
+                if not string[end].isspace():
+                    # Drop the chunk that the cap cuts through.
+                    while end > 0 and not string[end - 1].isspace():
+                        end -= 1
+                string = string[:end]
+        self._chars += len(string)
+        chunks = self._chunks
+        tokens = self.tokens
+        max_tokens = self.max_tokens
+        findall = Tokeniser.regexp.findall
+        cjk = self.ngrams and _CJK_CHAR.search(string) is not None
+        for chunk in string.split():
+            if chunk in chunks:
+                continue
+            chunks.add(chunk)
+            if cjk and _CJK_CHAR.search(chunk):
+                found = self._split_cjk(chunk)
+            elif chunk.isalpha():
+                found = (chunk,)
+            else:
+                found = findall(chunk)
+            for token in found:
+                token = token.lower()
+                if token not in tokens:
+                    if max_tokens is not None and len(tokens) >= max_tokens:
+                        self.full = True
+                        return
+                    tokens.add(token)
+                    yield token
+
+    def _split_cjk(self, chunk):
+        """Tokenise a chunk containing CJK characters."""
+        # Splitting on a pattern with a group alternates other text with
+        # CJK runs, starting with (possibly empty) other text.
+        for i, part in enumerate(_CJK_RUN.split(chunk)):
+            if i % 2:
+                for ngram in cjk_ngrams(part, self.ngrams):
+                    yield ngram
+            elif part:
+                for token in Tokeniser.regexp.findall(part):
+                    yield token
@@ -0,0 +1,344 @@
+"""Mappings from featuredicts to sparse LIBSVM-style vectors and matrices."""
+
+import zlib
+import os
+import mmap
+from array import array
+from features import NAMESPACES, feature_name
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = None
+    sparse = None
+
+
+class FeatureHasher(object):
+    """Maps feature names to vector indices with the hashing trick.
+
+    Rather than building an index of every feature seen in training, each
+    feature name is hashed into one of a fixed number of dimensions. The
+    mapping needs no state beyond its parameters, so memory use does not
+    grow with the vocabulary and the hasher can be shared freely between
+    processes. Unseen features at classification time are hashed like any
+    other.
+
+    With signed hashing, a second hash bit decides whether a feature adds or
+    subtracts its value, so collisions tend to cancel out rather than bias
+    the colliding dimension upwards.
+
+    Instances can be used in place of a feature index dictionary, e.g. as
+    SvmClassifier.featureindex: len() gives the number of dimensions and
+    every feature is 'in' the hasher.
+
+    Features may be keyed by name or by (namespace id, value) pair, as
+    produced by features.note_featuredict with ids=True. Both forms of the
+    same feature hash to the same index, without formatting the name.
+
+    Attributes:
+        dim: Number of dimensions. Indices run from 1 to dim.
+        signed: Whether signed hashing is used.
+    """
+
+    MAX_DIM = 2 ** 31
+
+    # CRC state after each namespace prefix, from which the hash of a
+    # (namespace id, value) pair continues.
+    _PREFIX_CRCS = [zlib.crc32(prefix) for prefix in NAMESPACES]
+
+    def __init__(self, dim=2 ** 20, signed=True):
+        """Set the parameters.
+
+        Args:
+            dim: Number of dimensions, at most MAX_DIM. Powers of two give
+                the most even spread.
+            signed: Whether to use signed hashing.
+
+        Raises:
+            ValueError: dim is out of range.
+        """
+        if not 0 < dim <= self.MAX_DIM:
+            raise ValueError("dim must be between 1 and %d" % self.MAX_DIM)
+        self.dim = dim
+        self.signed = signed
+
+    def __len__(self):
+        return self.dim
+
+    def __contains__(self, feature):
+        return True
+
+    def __eq__(self, other):
+        return (isinstance(other, FeatureHasher) and
+                (self.dim, self.signed) == (other.dim, other.signed))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def _hash(self, feature):
+        """Get an unsigned 32-bit hash of a feature name or key."""
+        if isinstance(feature, tuple):
+            namespace, value = feature
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            return zlib.crc32(value, self._PREFIX_CRCS[namespace]) & 0xffffffff
+        if isinstance(feature, unicode):
+            feature = feature.encode("utf-8")
+        return zlib.crc32(feature) & 0xffffffff
+
+    def __getitem__(self, feature):
+        """Get the vector index for a feature name."""
+        return self._hash(feature) % self.dim + 1
+
+    def vector(self, featuredict):
+        """Map a featuredict to a sparse vector.
+
+        Args:
+            featuredict: A dict from feature names to values.
+
+        Returns:
+            Dictionary mapping indices to values.
+        """
+        vector = {}
+        dim = self.dim
+        signed = self.signed
+        for ftr, ftrval in featuredict.iteritems():
+            hashval = self._hash(ftr)
+            index = hashval % dim + 1
+            if signed and hashval & 0x80000000:
+                ftrval = -ftrval
+            vector[index] = vector.get(index, 0) + ftrval
+        return dict((k, v) for k, v in vector.iteritems() if v)
+
+
+def featuresets_to_csr(featureindex, labelindex, featuresets):
+    """Map featuresets straight to a CSR matrix and label array.
+
+    Column j of the matrix holds feature index j + 1, which is how LIBSVM
+    numbers the columns of scipy matrices. Rows are assembled in flat typed
+    arrays, with no per-featureset dict or node array.
+
+    Args:
+        featureindex: Dictionary mapping feature names to integers, or an
+            object such as FeatureHasher with a vector method.
+        labelindex: Dictionary mapping labels to integers. Labels not in the
+            index map to -1.
+        featuresets: List of featuresets.
+
+    Returns:
+        2-tuple of a scipy.sparse.csr_matrix with one row per featureset and
+        len(featureindex) columns, and a numpy array of labels.
+
+    Raises:
+        ImportError: numpy or scipy is not installed.
+    """
+    if sparse is None:
+        raise ImportError("featuresets_to_csr requires numpy and scipy")
+    indices = array("i")
+    data = array("d")
+    indptr = array("i", [0])
+    labels = array("d")
+    is_dict = isinstance(featureindex, dict)
+    for featuredict, label in featuresets:
+        if is_dict:
+            for ftr, ftrval in featuredict.iteritems():
+                index = featureindex.get(ftr)
+                if index is not None:
+                    indices.append(index - 1)
+                    data.append(ftrval)
+        else:
+            for index, ftrval in featureindex.vector(featuredict).iteritems():
+                indices.append(index - 1)
+                data.append(ftrval)
+        indptr.append(len(indices))
+        labels.append(labelindex.get(label, -1))
+    matrix = sparse.csr_matrix((numpy.frombuffer(data, dtype=numpy.float64),
+                                numpy.frombuffer(indices, dtype=numpy.intc),
+                                numpy.frombuffer(indptr, dtype=numpy.intc)),
+                               shape=(len(indptr) - 1, len(featureindex)))
+    matrix.sort_indices()
+    return matrix, numpy.frombuffer(labels, dtype=numpy.float64)
+
+
+def _encode_key(feature):
+    """Encode a feature name or key as UTF-8 name bytes."""
+    feature = feature_name(feature)
+    if isinstance(feature, unicode):
+        return feature.encode("utf-8")
+    return feature
+
+
+def _is_byte_name(feature):
+    """Check whether a feature name is a non-ASCII byte string."""
+    feature = feature_name(feature)
+    if not isinstance(feature, str):
+        return False
+    try:
+        feature.decode("ascii")
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def save_feature_table(featureindex, path):
+    """Write a feature index dictionary as flat arrays.
+
+    Four files are written to the directory path:
+
+        features.dat: The UTF-8 encoded feature names, sorted bytewise and
+            concatenated.
+        features_offsets.npy: An int64 array of n + 1 offsets into
+            features.dat. Name i spans offsets[i] to offsets[i + 1].
+        features_values.npy: An int32 array of the n feature indices, in the
+            same order as the names.
+        features_bytes.npy: An int64 array of the positions of the names
+            that were non-ASCII byte strings rather than unicode, e.g.
+            those built from EDAM string attributes. In Python 2 these do
+            not compare equal to the decoded names.
+
+    Args:
+        featureindex: Dictionary mapping feature names to integers.
+        path: Directory path.
+
+    Raises:
+        IOError: File access error.
+    """
+    items = sorted((_encode_key(ftr), index, _is_byte_name(ftr))
+                   for ftr, index in featureindex.iteritems())
+    offsets = numpy.zeros(len(items) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(key) for key, _, _ in items], out=offsets[1:])
+    values = numpy.array([index for _, index, _ in items], dtype=numpy.int32)
+    byte_names = numpy.array([i for i, (_, _, is_bytes) in enumerate(items)
+                              if is_bytes], dtype=numpy.int64)
+    with open(os.path.join(path, "features.dat"), "wb") as handle:
+        for key, _, _ in items:
+            handle.write(key)
+    numpy.save(os.path.join(path, "features_offsets.npy"), offsets)
+    numpy.save(os.path.join(path, "features_values.npy"), values)
+    numpy.save(os.path.join(path, "features_bytes.npy"), byte_names)
+
+
+def load_feature_table(path):
+    """Read a feature index dictionary written by save_feature_table.
+
+    Args:
+        path: Directory path.
+
+    Names are decoded to unicode, except those saved as non-ASCII byte
+    strings, so the keys are equal to those that were saved. Tables saved
+    without features_bytes.npy are decoded throughout.
+
+    Returns:
+        Dictionary mapping feature names to integers.
+
+    Raises:
+        IOError: File access error.
+    """
+    with open(os.path.join(path, "features.dat"), "rb") as handle:
+        block = handle.read()
+    offsets = numpy.load(os.path.join(path, "features_offsets.npy")).tolist()
+    values = numpy.load(os.path.join(path, "features_values.npy")).tolist()
+    bytes_path = os.path.join(path, "features_bytes.npy")
+    byte_names = set()
+    if os.path.exists(bytes_path):
+        byte_names = set(numpy.load(bytes_path).tolist())
+    featureindex = {}
+    for i, value in enumerate(values):
+        name = block[offsets[i]:offsets[i + 1]]
+        if i not in byte_names:
+            name = name.decode("utf-8")
+        featureindex[name] = value
+    return featureindex
+
+
+class CompactFeatureIndex(object):
+    """Read-only feature index over the files written by save_feature_table.
+
+    The names block is memory-mapped and the offsets and values arrays are
+    loaded with numpy's mmap_mode, so opening an index costs no parsing and
+    the pages are shared by every process that maps the same files. Lookups
+    binary search the sorted names, which takes O(log n) comparisons.
+
+    Instances can be used in place of a feature index dictionary, e.g. as
+    SvmClassifier.featureindex.
+    """
+
+    def __init__(self, path):
+        """Map the index files.
+
+        Args:
+            path: Directory path, as passed to save_feature_table.
+
+        Raises:
+            IOError: File access error.
+        """
+        with open(os.path.join(path, "features.dat"), "rb") as handle:
+            if os.fstat(handle.fileno()).st_size:
+                self._block = mmap.mmap(handle.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            else:
+                self._block = ""
+        self._offsets = numpy.load(os.path.join(path, "features_offsets.npy"),
+                                   mmap_mode="r")
+        self._values = numpy.load(os.path.join(path, "features_values.npy"),
+                                  mmap_mode="r")
+
+    def __len__(self):
+        return len(self._values)
+
+    def _key(self, i):
+        """Get the encoded name at position i."""
+        offsets = self._offsets
+        return self._block[offsets.item(i):offsets.item(i + 1)]
+
+    def _find(self, feature):
+        """Get the position of a feature name, or -1 if absent."""
+        key = _encode_key(feature)
+        lo, hi = 0, len(self._values)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._values) and self._key(lo) == key:
+            return lo
+        return -1
+
+    def get(self, feature, default=None):
+        """Get the index for a feature name, or default if absent."""
+        pos = self._find(feature)
+        if pos < 0:
+            return default
+        return self._values.item(pos)
+
+    def __getitem__(self, feature):
+        index = self.get(feature)
+        if index is None:
+            raise KeyError(feature)
+        return index
+
+    def __contains__(self, feature):
+        return self._find(feature) >= 0
+
+    def iteritems(self):
+        """Iterate over (feature name, index) pairs in name order."""
+        for i in xrange(len(self._values)):
+            yield self._key(i).decode("utf-8"), self._values.item(i)
+
+    def vector(self, featuredict):
+        """Map a featuredict to a sparse vector.
+
+        Args:
+            featuredict: A dict from feature names to values.
+
+        Returns:
+            Dictionary mapping indices to values. Features not in the index
+            are ignored.
+        """
+        vector = {}
+        for ftr, ftrval in featuredict.iteritems():
+            index = self.get(ftr)
+            if index is not None:
+                vector[index] = ftrval
+        return vector